@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""
+Backtest autosell exits (see extras/autosell.py) against a pair's recorded reserve history.
+
+Record once (needs a node):
+    python3 extras/backtest.py -N arbitrum record -p 0xPAIR --from 70000000 --to 80000000 -f data/arb_weth.csv
+Then run any number of grids offline:
+    python3 extras/backtest.py run -f data/arb_weth.csv -a 1000000000000000000000 --tp 1.1:3:0.05 --sl 0,0.5:0.95:0.05
+"""
+import argparse
+import os
+import sys
+import time
+
+import dotenv
+import web3
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from lib import style
+from lib.backtest import AutosellBacktest, load_history, parse_range, record_sync_history
+from lib.multi_provider import endpoints_from_env, make_http_provider
+
+dotenv.load_dotenv()
+
+
+def record(_args, s):
+    w3 = web3.Web3(make_http_provider(endpoints_from_env(_args.network_name)))
+    to_block = _args.to_block or w3.eth.block_number
+    rows = record_sync_history(w3, web3.Web3.toChecksumAddress(_args.pair), _args.file, _args.from_block, to_block,
+                               chunk=_args.chunk, on_progress=lambda b, n: s.normal(f'Block {b}, {n} rows'))
+    s.good(f'Wrote {rows} rows to {_args.file}')
+
+
+def run(_args, s):
+    start = time.perf_counter()
+    blocks, reserve_in, reserve_out = load_history(_args.file, sell_token0=not _args.sell_token1)
+    loaded = time.perf_counter()
+    bt = AutosellBacktest(blocks, reserve_in, reserve_out, _args.amount, fee_bps=_args.fee_bps,
+                          delay_blocks=_args.delay, slippage_bps=_args.slippage_bps, gas_cost=_args.gas_cost)
+    tp, sl, tr = parse_range(_args.tp), parse_range(_args.sl), parse_range(_args.trail)
+    results = bt.run(tp, sl, tr, top=_args.top)
+    done = time.perf_counter()
+    s.data(results, 'Best parameters:')
+    s.normal(f'{len(tp) * len(sl) * len(tr)} combinations over {bt.n} blocks: load {loaded - start:.2f}s, '
+             f'backtest {done - loaded:.2f}s')
+
+
+if __name__ == '__main__':
+    s = style.PrettyText()
+    args = argparse.ArgumentParser()
+    args.add_argument('-N', '--network', dest='network_name', default='ethereum', help='The network to record from.')
+    subparsers = args.add_subparsers(dest='command')
+    cmd_record = subparsers.add_parser('record', help='Save the Sync history of a pair.')
+    cmd_record.add_argument('-p', '--pair', required=True, help='Pair address.')
+    cmd_record.add_argument('--from', dest='from_block', type=int, required=True, help='First block.')
+    cmd_record.add_argument('--to', dest='to_block', type=int, default=None, help='Last block, latest by default.')
+    cmd_record.add_argument('-f', '--file', required=True, help='Csv file to append to.')
+    cmd_record.add_argument('-c', '--chunk', type=int, default=2000, help='Blocks per eth_getLogs.')
+    cmd_run = subparsers.add_parser('run', help='Backtest a parameter grid.')
+    cmd_run.add_argument('-f', '--file', required=True, help='Recorded csv file.')
+    cmd_run.add_argument('-a', '--amount', type=int, required=True, help='Raw position size.')
+    cmd_run.add_argument('-1', '--sell-token1', dest='sell_token1', action='store_true',
+                         help='The position is in token1 of the pair, not token0.')
+    cmd_run.add_argument('--tp', default='0', help='Take profit multipliers, list or start:stop:step. 0 is off.')
+    cmd_run.add_argument('--sl', default='0', help='Stop loss multipliers, list or start:stop:step. 0 is off.')
+    cmd_run.add_argument('--trail', default='0', help='Trailing stop fractions, list or start:stop:step. 0 is off.')
+    cmd_run.add_argument('--delay', type=int, default=1, help='Blocks between trigger and fill.')
+    cmd_run.add_argument('--slippage-bps', dest='slippage_bps', type=float, default=0.0,
+                         help='Extra slippage on the fill.')
+    cmd_run.add_argument('--gas-cost', dest='gas_cost', type=int, default=0, help='Raw output token per fill.')
+    cmd_run.add_argument('--fee-bps', dest='fee_bps', type=int, default=30, help='Pool fee.')
+    cmd_run.add_argument('--top', type=int, default=20, help='Results to print.')
+    args = args.parse_args()
+    if args.command == 'record':
+        record(args, s)
+    elif args.command == 'run':
+        run(args, s)
+    else:
+        s.warning('No command given. Please run %s --help' % sys.argv[0])
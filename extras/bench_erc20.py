@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+Microbenchmark: per call CPU of the ERC-20 reads with and without lib/erc20.py.
+Runs offline against a provider that answers every request instantly, so the
+numbers are pure client side overhead (ABI processing, encoding, decoding).
+
+    python3 extras/bench_erc20.py -n 2000
+"""
+import argparse
+import os
+import sys
+import timeit
+
+import web3
+from web3.providers.base import BaseProvider
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import lib.abi_lib
+from lib.erc20 import ContractCache, Erc20Reader, balance_of_data
+
+TOKEN = '0x6B175474E89094C44Da98b954EedeAC495271d0F'
+OWNER = '0xBeefeE3Eda347239505D47E1af09ed6316B9e0B0'
+
+
+class InstantProvider(BaseProvider):
+    def make_request(self, method, params):
+        if method == 'eth_chainId':
+            return {'jsonrpc': '2.0', 'id': 1, 'result': '0x1'}
+        return {'jsonrpc': '2.0', 'id': 1, 'result': '0x' + format(10 ** 18, '064x')}
+
+    def isConnected(self):
+        return True
+
+
+def main(_args):
+    w3 = web3.Web3(InstantProvider())
+    cache = ContractCache(w3)
+    reader = Erc20Reader(w3)
+
+    def uncached():
+        contract = w3.eth.contract(TOKEN, abi=lib.abi_lib.EIP20_ABI)
+        return contract.functions.balanceOf(OWNER).call()
+
+    def cached_contract():
+        return cache.get(TOKEN, lib.abi_lib.EIP20_ABI).functions.balanceOf(OWNER).call()
+
+    def precompiled():
+        return reader.balance_of(TOKEN, OWNER)
+
+    def raw_call():
+        return w3.eth.call({'to': TOKEN, 'data': '0x'})
+
+    def encode_contract():
+        return cache.get(TOKEN, lib.abi_lib.EIP20_ABI).encodeABI('balanceOf', args=(OWNER,))
+
+    def encode_precompiled():
+        return balance_of_data(OWNER)
+
+    assert uncached() == cached_contract() == precompiled()
+    assert encode_contract() == encode_precompiled()
+    for title, cases in [('balanceOf() round trip', [('contract per call', uncached),
+                                                      ('cached contract', cached_contract),
+                                                      ('precompiled calldata', precompiled),
+                                                      ('bare eth_call floor', raw_call)]),
+                         ('calldata encoding only', [('contract.encodeABI', encode_contract),
+                                                     ('balance_of_data', encode_precompiled)])]:
+        print(title)
+        base = None
+        for name, fn in cases:
+            best = min(timeit.repeat(fn, number=_args.number, repeat=_args.repeat))
+            usec = best / _args.number * 1e6
+            base = base or usec
+            print(f'  {name:<22} {usec:9.1f} us/call  {base / usec:6.1f}x')
+
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser()
+    args.add_argument('-n', '--number', type=int, default=1000, help='Calls per timing run.')
+    args.add_argument('-r', '--repeat', type=int, default=5, help='Timing runs, best is reported.')
+    main(args.parse_args())
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for a bundle relay, to try private submission without a real one:
+
+    python3 extras/mock_relay.py --upstream http://127.0.0.1:8545
+    ./swapper.py --relay http://127.0.0.1:8547 swap -i WETH -o USDC -q 0.1
+
+It checks the X-Flashbots-Signature header and every transaction's signature, keeps the bundles by
+target block, and when the upstream node is about to build a targeted block sends the bundle's
+transactions to it in order. That is not atomic like a real builder: point it at a local fork
+(anvil, hardhat) that mines them together, not at a public node. Without --upstream bundles are
+only accepted and logged, with --drop they are accepted and never forwarded, to exercise the
+retry and give up paths of lib/bundles.py.
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+from eth_account import Account
+from eth_account.messages import encode_defunct
+from eth_utils import keccak, to_hex
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from lib import style
+
+
+class MockRelay:
+    def __init__(self, upstream: str = None, drop: bool = False, poll: float = 0.5):
+        self.upstream = upstream
+        self.drop = drop
+        self.poll = poll
+        self.bundles = {}
+        self.forwarded = set()
+        self.stats = {'received': 0, 'rejected': 0, 'forwarded': 0}
+        self._lock = threading.Lock()
+        self._ids = 0
+        self._print = style.PrettyText()
+
+    def _upstream(self, method: str, params: list):
+        self._ids += 1
+        reply = requests.post(self.upstream, json={'jsonrpc': '2.0', 'id': self._ids, 'method': method,
+                                                   'params': params}, timeout=10).json()
+        if reply.get('error'):
+            raise ValueError(reply['error'])
+        return reply.get('result')
+
+    def send_bundle(self, params: list) -> dict:
+        bundle = params[0]
+        txs = bundle.get('txs') or []
+        if not txs:
+            raise ValueError('empty bundle')
+        # every transaction must at least be signed, the relay cannot run them without a sender
+        senders = [Account.recover_transaction(raw) for raw in txs]
+        block = int(bundle['blockNumber'], 16)
+        bundle_hash = to_hex(keccak(b''.join(keccak(hexstr=raw) for raw in txs)))
+        with self._lock:
+            self.bundles.setdefault(block, {})[bundle_hash] = txs
+            self.stats['received'] += 1
+        self._print.normal(f'Bundle {bundle_hash[:10]} of {len(txs)} from {senders[0]} for block {block}')
+        return {'bundleHash': bundle_hash}
+
+    def handle(self, method: str, params: list):
+        if method == 'eth_sendBundle':
+            return self.send_bundle(params)
+        if method == 'mock_bundles':
+            with self._lock:
+                return {hex(block): list(bundles) for block, bundles in self.bundles.items()}
+        raise NotImplementedError(method)
+
+    def forward_loop(self) -> None:
+        """
+        Before each upstream block, send the bundles targeting it.
+        """
+        last = None
+        while True:
+            try:
+                head = int(self._upstream('eth_blockNumber', []), 16)
+            except (requests.exceptions.RequestException, ValueError) as err:
+                self._print.warning(f'Upstream unavailable: {err}')
+                time.sleep(self.poll * 4)
+                continue
+            if head != last:
+                last = head
+                with self._lock:
+                    for block in [b for b in self.bundles if b <= head]:
+                        del self.bundles[block]
+                    due = [(h, txs) for h, txs in self.bundles.get(head + 1, {}).items() if h not in self.forwarded]
+                for bundle_hash, txs in due:
+                    self.forwarded.add(bundle_hash)
+                    try:
+                        for raw in txs:
+                            self._upstream('eth_sendRawTransaction', [raw])
+                    except ValueError as err:
+                        self._print.error(f'Bundle {bundle_hash[:10]} failed upstream: {err}')
+                        continue
+                    self.stats['forwarded'] += 1
+                    self._print.good(f'Bundle {bundle_hash[:10]} forwarded for block {head + 1}')
+            time.sleep(self.poll)
+
+
+def make_handler(relay: MockRelay):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def reply(self, request_id, result=None, error=None):
+            body = {'jsonrpc': '2.0', 'id': request_id}
+            body.update({'error': error} if error else {'result': result})
+            data = json.dumps(body).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            try:
+                request = json.loads(body)
+            except ValueError:
+                return self.reply(None, error={'code': -32700, 'message': 'parse error'})
+            header = self.headers.get('X-Flashbots-Signature', '')
+            address, _, signature = header.partition(':')
+            try:
+                signer = Account.recover_message(encode_defunct(text=to_hex(keccak(body))), signature=signature)
+            except (ValueError, TypeError):
+                signer = None
+            if not signer or signer.lower() != address.lower():
+                relay.stats['rejected'] += 1
+                return self.reply(request.get('id'), error={'code': -32600, 'message': 'invalid signature'})
+            try:
+                result = relay.handle(request.get('method'), request.get('params') or [])
+            except NotImplementedError as err:
+                return self.reply(request.get('id'), error={'code': -32601, 'message': f'unsupported: {err}'})
+            except (ValueError, KeyError, TypeError) as err:
+                relay.stats['rejected'] += 1
+                return self.reply(request.get('id'), error={'code': -32602, 'message': str(err)})
+            self.reply(request.get('id'), result)
+    return Handler
+
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser()
+    args.add_argument('-p', '--port', type=int, default=8547)
+    args.add_argument('-u', '--upstream', type=str, default=None, help='Node to forward due bundles to.')
+    args.add_argument('--drop', action='store_true', help='Accept bundles and never forward them.')
+    args = args.parse_args()
+    mock = MockRelay(upstream=args.upstream, drop=args.drop)
+    if args.upstream and not args.drop:
+        threading.Thread(target=mock.forward_loop, daemon=True).start()
+    server = ThreadingHTTPServer(('127.0.0.1', args.port), make_handler(mock))
+    mock._print.good(f'Mock relay on http://127.0.0.1:{args.port}, upstream: {args.upstream}, drop: {args.drop}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        mock._print.normal(f'Mock relay stats: {mock.stats}')
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""
+Replay a recorded quote flow offline in a loop, to profile Swapper without touching the network.
+Record the cassette once, then replay it as often as needed:
+
+    ./swapper.py --record data/quote.jsonl.gz quote -i WETH -o USDC -q 1
+    python3 extras/replay_bench.py data/quote.jsonl.gz -i WETH -o USDC -q 1 -n 1000 --profile
+"""
+import argparse
+import cProfile
+import os
+import pstats
+import sys
+import time
+
+import web3
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from lib import style
+from lib.cassette import Cassette
+from swapper import Swapper
+
+# any key will do, quotes never sign and requests made for another account fall back to the recorded ones
+KEY = '0x' + '11' * 32
+
+
+def main(_args):
+    style.configure(quiet=True)
+    cassette = Cassette(_args.cassette, mode='replay', strict=False)
+    uni = Swapper(KEY, web3.Account.from_key(KEY).address, version=_args.uniswap_version,
+                  network=_args.network_name, cassette=cassette)
+
+    def run():
+        cassette.rewind()
+        return uni.swap(_args.input_token, _args.output_token, float_qty=_args.quantity, _quote_only=True)
+
+    print(f'Quote: {run()}')
+    profiler = cProfile.Profile() if _args.profile else None
+    start = time.perf_counter()
+    if profiler:
+        profiler.enable()
+    for _ in range(_args.number):
+        run()
+    if profiler:
+        profiler.disable()
+    elapsed = time.perf_counter() - start
+    print(f'{_args.number} quote flows in {elapsed:.2f}s, {_args.number / elapsed * 60:.0f} per minute, '
+          f'{len(cassette)} recorded requests, {cassette.stats}')
+    if profiler:
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(25)
+
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser()
+    args.add_argument('cassette', help='Cassette recorded with `swapper.py --record`.')
+    args.add_argument('-N', '--network', dest='network_name', default='ethereum', help='Network it was recorded on.')
+    args.add_argument('-uv', '--uniswap_version', type=int, default=2, choices=[2, 3], help='Uniswap version.')
+    args.add_argument('-i', '--input', dest='input_token', required=True, help='Input token.')
+    args.add_argument('-o', '--output', dest='output_token', required=True, help='Output token.')
+    args.add_argument('-q', '--quantity', type=float, default=0.0, help='Float quantity.')
+    args.add_argument('-n', '--number', type=int, default=1000, help='Quote flows to replay.')
+    args.add_argument('--profile', action='store_true', help='Print the hottest functions.')
+    main(args.parse_args())
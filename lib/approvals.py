@@ -0,0 +1,184 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from eth_utils import to_checksum_address, to_hex
+
+from lib import style
+from lib.erc20 import Erc20Reader, allowance_data, approve_data, decode_uint
+from lib.multicall import Multicall
+from lib.pyswap_exceptions import BundleError
+from lib.utils import dex_contracts
+
+MAX_UINT256 = 2 ** 256 - 1
+ZRX_EXCHANGE_PROXY = '0xDef1C0ded9bec7F1a1670819833240f027b25EfF'
+
+
+def fee_params(w3) -> dict:
+    """
+    :return: EIP-1559 fee fields (2x base fee plus tip) if the chain has a base fee, else gasPrice
+    """
+    latest = w3.eth.get_block('latest')
+    if latest.get('baseFeePerGas') is not None:
+        tip = w3.eth.max_priority_fee
+        return {'maxFeePerGas': 2 * latest['baseFeePerGas'] + tip, 'maxPriorityFeePerGas': tip}
+    return {'gasPrice': w3.eth.gas_price}
+
+
+def default_spenders(network: str, zrx: bool = True) -> list:
+    """
+    :return: every router configured for this network in data/dex_contracts.json, plus the 0x proxy
+    """
+    spenders = [to_checksum_address(d['router']) for d in dex_contracts(network) if d.get('router')]
+    if zrx:
+        spenders.append(ZRX_EXCHANGE_PROXY)
+    return list(dict.fromkeys(spenders))
+
+
+class ApprovalManager:
+    """
+    Check and set ERC-20 allowances for many token / spender pairs at once.
+
+    Allowances are read in one Multicall3 batch (plain eth_calls where it is not deployed). Only the
+    approvals that are missing are built: the nonce is read once and incremented locally, fees are
+    read once, gas limits are estimated concurrently, then everything is signed locally and sent
+    back to back, or as one private bundle when a bundler is set.
+    """
+    def __init__(self, w3, account, multicall: str = None, max_workers: int = 8, bundler=None):
+        """
+        :param account: eth_account LocalAccount that owns the tokens
+        :param multicall: Multicall3 address, None to fall back to one eth_call per pair
+        :param bundler: lib.bundles.BundleSubmitter, keeps approvals out of the public mempool
+        """
+        self.w3 = w3
+        self.account = account
+        self.multicall = Multicall(w3, address=multicall) if multicall else None
+        self.erc20 = Erc20Reader(w3)
+        self.max_workers = max_workers
+        self.bundler = bundler
+        self._print = style.PrettyText()
+
+    def allowances(self, tokens: list, spenders: list) -> dict:
+        """
+        :return: {(token, spender): allowance} for every combination
+        """
+        pairs = [(to_checksum_address(t), to_checksum_address(s)) for t in tokens for s in spenders]
+        owner = self.account.address
+        if self.multicall is not None:
+            results = self.multicall.call([(t, allowance_data(owner, s)) for t, s in pairs])
+            return {pair: decode_uint(raw) if ok else 0 for pair, (ok, raw) in zip(pairs, results)}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            values = pool.map(lambda p: self.erc20.allowance(p[0], owner, p[1]), pairs)
+        return dict(zip(pairs, values))
+
+    def missing(self, tokens: list, spenders: list, amount: int = MAX_UINT256) -> list:
+        """
+        :param amount: allowances below this (or below half of it for unlimited approvals, which some
+        tokens decrease as they are spent) need a new approval
+        :return: [(token, spender), ...]
+        """
+        threshold = amount // 2 if amount == MAX_UINT256 else amount
+        return [pair for pair, allowance in self.allowances(tokens, spenders).items() if allowance < threshold]
+
+    def build(self, pairs: list, amount: int = MAX_UINT256) -> list:
+        """
+        Build and sign one approve transaction per pair with consecutive nonces. A pair whose
+        approve would revert (ie USDT when changing one non-zero allowance to another) is reported
+        and left out, the nonces stay consecutive over the rest.
+        :return: [(token, spender, signed transaction), ...]
+        """
+        if not pairs:
+            return []
+        owner = self.account.address
+        nonce = self.w3.eth.get_transaction_count(owner, 'pending')
+        fees = fee_params(self.w3)
+        chain_id = self.w3.eth.chain_id
+        txs = [{'from': owner, 'to': token, 'data': approve_data(spender, amount), 'value': 0,
+                'chainId': chain_id, **fees} for token, spender in pairs]
+
+        def estimate(tx):
+            try:
+                return int(self.w3.eth.estimate_gas({k: tx[k] for k in ('from', 'to', 'data')}) * 1.2)
+            except ValueError as err:
+                return err
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            gas_limits = list(pool.map(estimate, txs))
+        signed = []
+        for (token, spender), tx, gas in zip(pairs, txs, gas_limits):
+            if isinstance(gas, Exception):
+                self._print.error(f'Approval of {token} for {spender} would revert, skipped: {gas}')
+                continue
+            tx.update(gas=gas, nonce=nonce + len(signed))
+            signed.append((token, spender, self.account.sign_transaction(tx)))
+        return signed
+
+    def send(self, signed: list) -> list:
+        """
+        Broadcast in nonce order. If one is rejected the rest would be stuck behind the gap, so stop there.
+        :return: [(token, spender, txid), ...] for the ones that were accepted
+        """
+        if self.bundler is not None:
+            return self.send_bundle(signed)
+        sent = []
+        for token, spender, tx in signed:
+            try:
+                txid = to_hex(self.w3.eth.send_raw_transaction(tx.rawTransaction))
+            except ValueError as err:
+                self._print.error(f'Approval of {token} for {spender} rejected: {err}')
+                break
+            self._print.good(f'Approve {token} for {spender}: {txid}')
+            sent.append((token, spender, txid))
+        return sent
+
+    def send_bundle(self, signed: list) -> list:
+        """
+        Submit every approval as one bundle through the relay, all of them land or none.
+        :return: [(token, spender, txid), ...] once included, else []
+        """
+        if not signed:
+            return []
+        try:
+            result = self.bundler.submit([tx.rawTransaction for _, _, tx in signed])
+        except BundleError as err:
+            self._print.error(f'Approval bundle failed: {err}')
+            return []
+        if result['included'] is None:
+            return []
+        sent = [(token, spender, to_hex(tx.hash)) for token, spender, tx in signed]
+        for token, spender, txid in sent:
+            self._print.good(f'Approve {token} for {spender}: {txid}')
+        return sent
+
+    def wait(self, sent: list, timeout: float = 120.0, poll: float = 1.0) -> dict:
+        """
+        :return: {txid: status} for the receipts seen before the timeout
+        """
+        pending = {txid for _, _, txid in sent}
+        statuses = {}
+        deadline = time.time() + timeout
+        while pending and time.time() < deadline:
+            for txid in list(pending):
+                try:
+                    receipt = self.w3.eth.get_transaction_receipt(txid)
+                except Exception:
+                    continue
+                statuses[txid] = receipt['status']
+                pending.discard(txid)
+            if pending:
+                time.sleep(poll)
+        return statuses
+
+    def approve_all(self, tokens: list, spenders: list, amount: int = MAX_UINT256, wait: bool = False) -> list:
+        """
+        Check, build, sign and send every missing approval.
+        :return: [(token, spender, txid), ...]
+        """
+        missing = self.missing(tokens, spenders, amount)
+        self._print.normal(f'{len(missing)} of {len(tokens) * len(spenders)} approvals needed.')
+        sent = self.send(self.build(missing, amount))
+        if wait and sent:
+            statuses = self.wait(sent)
+            failed = [txid for txid, status in statuses.items() if status != 1]
+            if failed:
+                self._print.error(f'Failed approvals: {failed}')
+        return sent
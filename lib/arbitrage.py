@@ -0,0 +1,288 @@
+import math
+import threading
+import time
+from itertools import permutations
+
+from eth_utils import to_checksum_address
+
+from lib import style
+from lib.erc20 import DECIMALS, decode_uint
+from lib.reserves import ReserveCache, ZERO_ADDRESS
+from lib.utils import dex_contracts
+from lib.v2_math import get_amount_out
+from lib.ws_provider import PersistentWebsocketProvider
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Per dex pool fee in basis points, anything not listed is assumed to charge the usual 30.
+FEE_BPS = {'uniswap': 30, 'sushiswap': 30}
+
+
+def fold_cycle(hops: list) -> (float, float, float):
+    """
+    Collapse a path of v2 pools into one virtual constant product pool. The first hop's fee stays
+    outside, the others are folded into the virtual reserves, so the output for input x is
+    g * x * e_out / (e_in + g * x), the same as a single pool.
+    :param hops: [(reserve_in, reserve_out, fee factor), ...]
+    :return: (e_in, e_out, g)
+    """
+    e_in, e_out, g = hops[0]
+    for reserve_in, reserve_out, fee in hops[1:]:
+        d = reserve_in + fee * e_out
+        e_in, e_out = e_in * reserve_in / d, fee * e_out * reserve_out / d
+    return e_in, e_out, g
+
+
+def optimal_input(e_in: float, e_out: float, g: float) -> float:
+    """
+    Input that maximises g*x*e_out/(e_in + g*x) - x, from setting the derivative to zero.
+    :return: 0.0 if the cycle is not profitable at any size
+    """
+    if e_in <= 0 or g * e_out <= e_in:
+        return 0.0
+    return (math.sqrt(g * e_in * e_out) - e_in) / g
+
+
+class ArbitrageScanner:
+    """
+    Look for profitable cycles between the v2 pools of every dex configured for a network.
+
+    discover() finds the pools of every pair of the given tokens on every v2 factory and builds the
+    candidate cycles once: two pools of the same pair on different dexes, and triangles that start
+    and end in WETH. Each block, scan() reloads all reserves in Multicall3 batches (lib/reserves.py),
+    sizes every cycle with the closed form optimum of its folded virtual pool, all cycles at once
+    with numpy when it is installed, subtracts gas and returns the profitable ones, best first.
+    Candidates are re-checked with the integer router math before they are reported.
+    """
+    def __init__(self, w3, network: str, tokens: list, weth: str, symbols: dict = None,
+                 gas_per_swap: int = 100000, gas_overhead: int = 60000, triangular: bool = True,
+                 reserves: ReserveCache = None):
+        """
+        :param tokens: token addresses to pair up
+        :param weth: wrapped native asset, profits and gas are measured in it
+        :param symbols: optional {address: symbol} for output
+        """
+        self.w3 = w3
+        self.network = network
+        self._print = style.PrettyText()
+        self.tokens = list(dict.fromkeys(t.lower() for t in tokens if t.lower() != ZERO_ADDRESS))
+        self.weth = weth.lower()
+        if self.weth not in self.tokens:
+            self.tokens.append(self.weth)
+        self.symbols = {k.lower(): v for k, v in (symbols or {}).items()}
+        self.gas_per_swap = gas_per_swap
+        self.gas_overhead = gas_overhead
+        self.triangular = triangular
+        self.reserves = reserves or ReserveCache(w3)
+        self.factories = [(d['dex'], d['factory']) for d in dex_contracts(network) if d['version'] == 2]
+        self.decimals = {}
+        self.pools = []
+        self.cycles = {}
+        self._by_pair = {}
+        self.stats = {}
+
+    # ------ set up -----------------------------------------------------------------------
+
+    def discover(self) -> int:
+        """
+        Find pools and build the candidate cycles. Pair addresses and token0 never change, so this
+        is only needed once.
+        :return: number of candidate cycles
+        """
+        pairs = [(a, b) for i, a in enumerate(self.tokens) for b in self.tokens[i + 1:]]
+        requests = [(factory, a, b) for _, factory in self.factories for a, b in pairs]
+        found = self.reserves.pairs_for(requests)
+        index = {}
+        for (factory, a, b), pool in zip(requests, found):
+            if pool is None:
+                continue
+            dex = next(d for d, f in self.factories if f == factory)
+            token0, token1 = sorted((a, b))
+            index[pool] = len(self.pools)
+            self.pools.append({'dex': dex, 'address': pool, 'token0': token0, 'token1': token1,
+                               'fee': (10000 - FEE_BPS.get(dex, 30)) / 10000})
+            self._by_pair.setdefault((token0, token1), []).append(index[pool])
+        calls = [(to_checksum_address(t), DECIMALS) for t in self.tokens]
+        for token, (ok, raw) in zip(self.tokens, self.reserves.multicall.call(calls)):
+            self.decimals[token] = decode_uint(raw) if ok else 18
+        self._build_cycles()
+        return sum(len(c[2]) for c in self.cycles.values())
+
+    def _pools_between(self, a: str, b: str) -> list:
+        return self._by_pair.get(tuple(sorted((a, b))), [])
+
+    def _add_cycle(self, path: list, pools: tuple) -> None:
+        idx, flips, meta = self.cycles.setdefault(len(pools), ([], [], []))
+        idx.append(list(pools))
+        # flipped when the hop sells token1 of its pool
+        flips.append([self.pools[p]['token1'] == path[h] for h, p in enumerate(pools)])
+        meta.append(path)
+
+    def _build_cycles(self) -> None:
+        self.cycles = {}
+        for (a, b), pools in self._by_pair.items():
+            start, other = (a, b) if a == self.weth or b != self.weth else (b, a)
+            for first, second in permutations(pools, 2):
+                self._add_cycle([start, other, start], (first, second))
+        if self.triangular:
+            for b, c in permutations([t for t in self.tokens if t != self.weth], 2):
+                for p1 in self._pools_between(self.weth, b):
+                    for p2 in self._pools_between(b, c):
+                        for p3 in self._pools_between(c, self.weth):
+                            self._add_cycle([self.weth, b, c, self.weth], (p1, p2, p3))
+        if np is not None:
+            self.cycles = {n: (np.array(idx, dtype=np.int64), np.array(flips, dtype=bool), meta)
+                           for n, (idx, flips, meta) in self.cycles.items()}
+
+    # ------ per block --------------------------------------------------------------------
+
+    def snapshot(self, block: int) -> None:
+        """
+        Load reserves of every pool at this block, in Multicall3 batches.
+        """
+        self.reserves.new_block(block)
+        self.reserves.refresh([p['address'] for p in self.pools], block_identifier=block)
+        loaded = [self.reserves.reserves(p['address']) or (0, 0) for p in self.pools]
+        self._r0 = [r[0] for r in loaded]
+        self._r1 = [r[1] for r in loaded]
+
+    def _weth_price(self, token: str) -> (float, None):
+        """
+        :return: raw WETH per raw unit of token, from the deepest token/WETH pool
+        """
+        if token == self.weth:
+            return 1.0
+        best = None
+        for p in self._pools_between(token, self.weth):
+            r0, r1 = self._r0[p], self._r1[p]
+            r_token, r_weth = (r0, r1) if self.pools[p]['token0'] == token else (r1, r0)
+            if r_token and (best is None or r_weth > best[1]):
+                best = (r_weth / r_token, r_weth)
+        return best[0] if best else None
+
+    def _sizes_numpy(self, idx, flips) -> tuple:
+        r0 = np.array(self._r0, dtype=np.float64)
+        r1 = np.array(self._r1, dtype=np.float64)
+        fee = np.array([p['fee'] for p in self.pools], dtype=np.float64)
+        r_in = np.where(flips, r1[idx], r0[idx])
+        r_out = np.where(flips, r0[idx], r1[idx])
+        g = fee[idx]
+        e_in, e_out = r_in[:, 0], r_out[:, 0]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for h in range(1, idx.shape[1]):
+                d = r_in[:, h] + g[:, h] * e_out
+                e_in, e_out = e_in * r_in[:, h] / d, g[:, h] * e_out * r_out[:, h] / d
+            g0 = g[:, 0]
+            x = np.where((e_in > 0) & (g0 * e_out > e_in), (np.sqrt(g0 * e_in * e_out) - e_in) / g0, 0.0)
+            profit = g0 * x * e_out / (e_in + g0 * x) - x
+        return np.nan_to_num(x), np.nan_to_num(profit)
+
+    def _sizes_python(self, idx, flips) -> tuple:
+        sizes, profits = [], []
+        for pools, flipped in zip(idx, flips):
+            hops = []
+            for p, f in zip(pools, flipped):
+                r0, r1 = self._r0[p], self._r1[p]
+                hops.append((r1, r0, self.pools[p]['fee']) if f else (r0, r1, self.pools[p]['fee']))
+            if any(h[0] <= 0 or h[1] <= 0 for h in hops):
+                sizes.append(0.0)
+                profits.append(0.0)
+                continue
+            e_in, e_out, g = fold_cycle(hops)
+            x = optimal_input(e_in, e_out, g)
+            sizes.append(x)
+            profits.append(g * x * e_out / (e_in + g * x) - x if x > 0 else 0.0)
+        return sizes, profits
+
+    def _exact(self, pools: list, flips: list, amount_in: int) -> int:
+        """
+        Output of the cycle for amount_in with the router's integer math.
+        """
+        amount = amount_in
+        for p, f in zip(pools, flips):
+            r0, r1 = self._r0[p], self._r1[p]
+            reserve_in, reserve_out = (r1, r0) if f else (r0, r1)
+            amount = get_amount_out(amount, reserve_in, reserve_out, round(10000 - self.pools[p]['fee'] * 10000))
+        return amount
+
+    def evaluate(self, gas_price: int, min_profit_wei: int = 0) -> list:
+        """
+        Size every candidate cycle against the current snapshot.
+        :param gas_price: wei per gas
+        :return: opportunities with a net profit above min_profit_wei, best first
+        """
+        found = []
+        for hops, (idx, flips, meta) in self.cycles.items():
+            if not len(meta):
+                continue
+            sizes, profits = (self._sizes_numpy if np is not None else self._sizes_python)(idx, flips)
+            gas_wei = gas_price * (self.gas_overhead + self.gas_per_swap * hops)
+            for i in (np.flatnonzero(profits > 0) if np is not None else
+                      [i for i, p in enumerate(profits) if p > 0]):
+                path = meta[i]
+                price = self._weth_price(path[0])
+                if price is None or profits[i] * price <= gas_wei + min_profit_wei:
+                    continue
+                amount_in = int(sizes[i])
+                pools, flipped = list(idx[i]), list(flips[i])
+                profit = self._exact(pools, flipped, amount_in) - amount_in
+                net = int(profit * price) - gas_wei
+                if net <= min_profit_wei:
+                    continue
+                found.append({
+                    'path': [self.symbols.get(t, t) for t in path],
+                    'dexes': [self.pools[p]['dex'] for p in pools],
+                    'pools': [self.pools[p]['address'] for p in pools],
+                    'amount_in': amount_in / 10 ** self.decimals.get(path[0], 18),
+                    'amount_in_raw': amount_in,
+                    'profit_raw': profit,
+                    'gas_cost_wei': gas_wei,
+                    'net_profit_weth': net / 10 ** 18,
+                })
+        found.sort(key=lambda o: o['net_profit_weth'], reverse=True)
+        return found
+
+    def scan(self, block: int = None, gas_price: int = None, min_profit_wei: int = 0) -> list:
+        """
+        Snapshot and evaluate one block.
+        :return: ranked opportunities, see evaluate()
+        """
+        start = time.perf_counter()
+        block = self.w3.eth.block_number if block is None else block
+        self.snapshot(block)
+        loaded = time.perf_counter()
+        found = self.evaluate(self.w3.eth.gas_price if gas_price is None else gas_price, min_profit_wei)
+        done = time.perf_counter()
+        self.stats = {'block': block, 'pools': len(self.pools),
+                      'cycles': sum(len(c[2]) for c in self.cycles.values()),
+                      'snapshot_ms': round((loaded - start) * 1000, 1),
+                      'evaluate_ms': round((done - loaded) * 1000, 1), 'found': len(found)}
+        return found
+
+    def run(self, top: int = 10, min_profit_wei: int = 0, block_time: float = None) -> None:
+        """
+        Scan every new block until interrupted, new heads come from a websocket subscription when
+        available and from polling otherwise.
+        :param block_time: seconds, used for the poll interval and the time budget warning
+        """
+        new_head = threading.Event()
+        if isinstance(self.w3.provider, PersistentWebsocketProvider):
+            self.w3.provider.subscribe_new_heads(lambda head: new_head.set())
+        poll = (block_time or 12.0) / 4
+        last = None
+        while True:
+            block = self.w3.eth.block_number
+            if block != last:
+                last = block
+                found = self.scan(block, min_profit_wei=min_profit_wei)
+                self._print.debug(f'Arbitrage scan: {self.stats}')
+                elapsed = (self.stats['snapshot_ms'] + self.stats['evaluate_ms']) / 1000
+                if block_time and elapsed > block_time / 2:
+                    self._print.warning(f'Scan took {elapsed:.2f}s, more than half the block time.')
+                if found:
+                    self._print.data(found[:top], f'Block {block}, {len(found)} opportunities:')
+            new_head.wait(timeout=poll)
+            new_head.clear()
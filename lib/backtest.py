@@ -0,0 +1,204 @@
+"""
+Offline backtests of autosell style exits (take profit, stop loss, trailing stop) over the
+recorded reserve history of one v2 pair.
+
+record_sync_history() pulls the pair's Sync events from a node once and writes them to a csv file,
+`block,reserve0,reserve1`, last Sync of each block only. Everything after that runs without a node.
+
+Every exit rule fires the first time a running statistic of the price crosses a level: take profit
+when the running max reaches it, stop loss when the running min does, trailing stop when the
+running max drawdown does. Those running statistics are monotonic, so the exit block of any
+parameter is one binary search, and a whole parameter grid is one searchsorted call per rule.
+"""
+import bisect
+import itertools
+import os
+
+from lib.v2_math import get_amount_out
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+SYNC_TOPIC = '0x1c411e9a96e071241c2f21f7726b17ae89e3cab4c78be50e062b03a9fffbbad1'
+
+
+def record_sync_history(w3, pair: str, path: str, from_block: int, to_block: int, chunk: int = 2000,
+                        on_progress=None) -> int:
+    """
+    Append the pair's reserves after each block that touched it to a csv file.
+    :param chunk: blocks per eth_getLogs request
+    :return: number of rows written
+    """
+    new_file = not os.path.exists(path)
+    rows = 0
+    with open(path, 'a') as ff:
+        if new_file:
+            ff.write(f'# pair {pair.lower()}\n')
+        for start in range(from_block, to_block + 1, chunk):
+            end = min(start + chunk - 1, to_block)
+            logs = w3.eth.get_logs({'address': pair, 'topics': [SYNC_TOPIC], 'fromBlock': start, 'toBlock': end})
+            last = {}
+            for log in logs:
+                data = log['data']
+                data = data[2:] if isinstance(data, str) else bytes(data).hex()
+                last[log['blockNumber']] = (int(data[:64], 16), int(data[64:128], 16))
+            for block in sorted(last):
+                ff.write(f'{block},{last[block][0]},{last[block][1]}\n')
+            rows += len(last)
+            if on_progress:
+                on_progress(end, rows)
+    return rows
+
+
+def load_history(path: str, sell_token0: bool = True) -> tuple:
+    """
+    :param sell_token0: True if the backtested position is in token0
+    :return: (blocks, reserve_in, reserve_out), blocks as a numpy array when numpy is there, the
+    reserves always as lists of exact ints (they do not fit int64 and float64 rounds them)
+    """
+    blocks, r0, r1 = [], [], []
+    with open(path) as ff:
+        for line in ff:
+            if line.startswith('#') or not line.strip():
+                continue
+            b, a, c = line.split(',')
+            blocks.append(int(b))
+            r0.append(int(a))
+            r1.append(int(c))
+    if np is not None:
+        blocks = np.asarray(blocks, dtype=np.int64)
+    return (blocks, r0, r1) if sell_token0 else (blocks, r1, r0)
+
+
+def parse_range(spec: str) -> list:
+    """
+    `1.1,1.5,2` or `start:stop:step` (stop included) to a list of floats.
+    """
+    if ':' in spec:
+        start, stop, step = (float(x) for x in spec.split(':'))
+        count = int(round((stop - start) / step)) + 1
+        return [round(start + i * step, 10) for i in range(count)]
+    return [float(x) for x in spec.split(',')]
+
+
+class AutosellBacktest:
+    """
+    Sell `amount` of the input token once take profit, stop loss or trailing stop fires, for every
+    combination of a parameter grid.
+
+    Levels are relative to the price at the first block: take profit 1.5 sells at +50%, stop loss
+    0.8 at -20%, trailing 0.1 once the price is 10% below its high so far; 0 disables a rule. The
+    fill happens `delay_blocks` blocks (not rows, quiet blocks have no row) after the trigger,
+    through the v2 formula at the reserves in effect at that block,
+    less `slippage_bps` and `gas_cost` (raw output token). Positions that never exit are valued at
+    the last block. Float math is used across the grid, only the best results are re-computed
+    with the integer router math.
+    """
+    def __init__(self, blocks, reserve_in, reserve_out, amount: int, fee_bps: int = 30, delay_blocks: int = 1,
+                 slippage_bps: float = 0.0, gas_cost: int = 0):
+        self.blocks = blocks
+        self.reserve_in = reserve_in
+        self.reserve_out = reserve_out
+        self.amount = amount
+        self.fee_bps = fee_bps
+        self.delay_blocks = delay_blocks
+        self.slippage_bps = slippage_bps
+        self.gas_cost = gas_cost
+        self.n = len(blocks)
+        if self.n == 0:
+            raise ValueError('Empty reserve history')
+        self._prepare()
+
+    def _prepare(self) -> None:
+        if np is not None:
+            # float copies for the grid, the exact ints stay in reserve_in / reserve_out for _fill
+            self._float_in = np.array(self.reserve_in, dtype=np.float64)
+            self._float_out = np.array(self.reserve_out, dtype=np.float64)
+            price = self._float_out / self._float_in
+            self.price = price
+            self.run_max = np.maximum.accumulate(price)
+            self.neg_run_min = -np.minimum.accumulate(price)
+            self.max_drawdown = np.maximum.accumulate(1 - price / self.run_max)
+            return
+        price = [o / i for i, o in zip(self.reserve_in, self.reserve_out)]
+        self.price = price
+        self.run_max, self.neg_run_min, self.max_drawdown = [], [], []
+        hi, lo, dd = price[0], price[0], 0.0
+        for p in price:
+            hi, lo = max(hi, p), min(lo, p)
+            dd = max(dd, 1 - p / hi)
+            self.run_max.append(hi)
+            self.neg_run_min.append(-lo)
+            self.max_drawdown.append(dd)
+
+    def _proceeds(self, index):
+        # float version of get_amount_out over many blocks at once, numpy only
+        gamma = (10000 - self.fee_bps) / 10000
+        r_in, r_out = self._float_in[index], self._float_out[index]
+        return self.amount * gamma * r_out / (r_in + self.amount * gamma)
+
+    def exits(self, take_profit, stop_loss, trailing):
+        """
+        :return: index of the first block each rule fires, self.n where it never does
+        """
+        entry = self.price[0]
+        if np is not None:
+            tp, sl, tr = (np.asarray(x, dtype=np.float64) for x in (take_profit, stop_loss, trailing))
+            i_tp = np.where(tp > 0, np.searchsorted(self.run_max, tp * entry, 'left'), self.n)
+            i_sl = np.where(sl > 0, np.searchsorted(self.neg_run_min, -sl * entry, 'left'), self.n)
+            i_tr = np.where(tr > 0, np.searchsorted(self.max_drawdown, tr, 'left'), self.n)
+            return np.minimum(np.minimum(i_tp, i_sl), i_tr)
+        out = []
+        for tp, sl, tr in zip(take_profit, stop_loss, trailing):
+            i_tp = bisect.bisect_left(self.run_max, tp * entry) if tp > 0 else self.n
+            i_sl = bisect.bisect_left(self.neg_run_min, -sl * entry) if sl > 0 else self.n
+            i_tr = bisect.bisect_left(self.max_drawdown, tr) if tr > 0 else self.n
+            out.append(min(i_tp, i_sl, i_tr))
+        return out
+
+    def run(self, take_profit: list, stop_loss: list, trailing: list, top: int = 20) -> list:
+        """
+        Backtest every combination of the three lists.
+        :return: the `top` combinations by return, best first
+        """
+        grid = list(itertools.product(take_profit, stop_loss, trailing))
+        tp, sl, tr = (list(c) for c in zip(*grid))
+        exit_at = self.exits(tp, sl, tr)
+        hold = self._fill(0, False)
+        if np is not None:
+            exited = exit_at < self.n
+            # the last row at or before the fill block holds the reserves in effect then
+            target = self.blocks[np.minimum(exit_at, self.n - 1)] + self.delay_blocks
+            fill_at = np.where(exited, np.searchsorted(self.blocks, target, 'right') - 1, self.n - 1)
+            proceeds = self._proceeds(fill_at) * np.where(exited, 1 - self.slippage_bps / 10000, 1.0)
+            proceeds = proceeds - np.where(exited, self.gas_cost, 0)
+            ret = proceeds / hold - 1
+            order = np.argsort(-ret)[:top]
+        else:
+            exited = [e < self.n for e in exit_at]
+            fill_at = [bisect.bisect_right(self.blocks, self.blocks[e] + self.delay_blocks) - 1 if x else self.n - 1
+                       for e, x in zip(exit_at, exited)]
+            ret = [self._fill(f, x) / hold - 1 for f, x in zip(fill_at, exited)]
+            order = sorted(range(len(grid)), key=lambda i: -ret[i])[:top]
+        results = []
+        for i in order:
+            exact = self._fill(int(fill_at[i]), bool(exited[i]))
+            results.append({
+                'take_profit': tp[i], 'stop_loss': sl[i], 'trailing': tr[i],
+                'exit_block': int(self.blocks[int(exit_at[i])]) if exited[i] else None,
+                'fill_block': int(self.blocks[int(fill_at[i])]),
+                'proceeds_raw': exact,
+                'return': round(exact / hold - 1, 6),
+            })
+        return results
+
+    def _fill(self, index: int, exited: bool) -> int:
+        """
+        Output for the position at this block with the integer router math.
+        """
+        out = get_amount_out(self.amount, self.reserve_in[index], self.reserve_out[index], self.fee_bps)
+        if exited:
+            out = int(out * (1 - self.slippage_bps / 10000)) - self.gas_cost
+        return out
@@ -0,0 +1,194 @@
+"""
+A wallet's balances over time, for accounting.
+
+Balances are sampled every `step` blocks, every token of a sample in one Multicall3 batch at that
+block (the native balance through Multicall3.getEthBalance), samples in parallel. Where a token's
+balance differs between two samples the interval is halved until the exact block is found. The
+intervals of every token are searched in lockstep, so each round reads each block once for all
+the tokens that need it: a change costs about log2(step) batched reads, whatever the number of
+tokens, and a quiet token costs nothing past the samples.
+
+A balance that changes and changes back between two samples, or between two halves of a search,
+is not seen: pick a step shorter than the shortest round trip that matters.
+
+Every read at a block at least REORG_DEPTH below the head is kept in SQLite (balance_history.db
+in the data directory) and never made again. Historical reads need an archive node.
+"""
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+from eth_abi.exceptions import DecodingError
+from eth_utils import function_signature_to_4byte_selector, to_checksum_address
+from web3.exceptions import ContractLogicError
+
+from lib import style
+from lib.chain_profile import MULTICALL3
+from lib.data_store import data_path
+from lib.erc20 import balance_of_data, decode_uint
+from lib.multicall import Multicall
+from lib.receipts import NATIVE_ADDRESSES
+
+GET_ETH_BALANCE = '0x' + function_signature_to_4byte_selector('getEthBalance(address)').hex()
+
+# Reads at blocks closer to the head than this may still be reorged away, they are not stored.
+REORG_DEPTH = 64
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS balances (
+    chain_id INTEGER NOT NULL,
+    wallet TEXT NOT NULL,
+    token TEXT NOT NULL,
+    block INTEGER NOT NULL,
+    balance TEXT NOT NULL,
+    PRIMARY KEY (chain_id, wallet, token, block)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS block_times (
+    chain_id INTEGER NOT NULL,
+    block INTEGER NOT NULL,
+    timestamp INTEGER NOT NULL,
+    PRIMARY KEY (chain_id, block)
+) WITHOUT ROWID;
+'''
+
+
+class BalanceHistory:
+    """
+    Balance reads at past blocks with a disk cache, and the change point search, see the module doc.
+    Balances are stored as text, token amounts do not fit sqlite's 64 bit integers.
+    """
+    def __init__(self, w3, chain_id: int, multicall: str = None, path: str = 'balance_history.db',
+                 chunk_size: int = 500, max_workers: int = 8):
+        """
+        :param max_workers: blocks read at once
+        """
+        self.w3 = w3
+        self.chain_id = chain_id
+        self.multicall = Multicall(w3, address=multicall or MULTICALL3, chunk_size=chunk_size, max_workers=1)
+        self.max_workers = max_workers
+        self.db = sqlite3.connect(data_path(path), timeout=30)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript(SCHEMA)
+        self.head = None
+        self.stats = {'cached': 0, 'read': 0, 'rpc': 0}
+        self._print = style.PrettyText()
+
+    # ------ reads ------------------------------------------------------------------------
+
+    def _calls(self, wallet: str, tokens: list) -> list:
+        return [(self.multicall.address, GET_ETH_BALANCE + wallet[2:].lower().rjust(64, '0'))
+                if token.lower() in NATIVE_ADDRESSES else (token, balance_of_data(wallet)) for token in tokens]
+
+    def _read_block(self, job: tuple) -> list:
+        wallet, tokens, block = job
+        try:
+            results = self.multicall.call(self._calls(wallet, tokens), block)
+            self.stats['rpc'] += -(-len(tokens) // self.multicall.chunk_size)
+        except DecodingError:
+            # Multicall3 was not deployed yet at this block, one read per token
+            self.stats['rpc'] += len(tokens)
+            return [self.w3.eth.get_balance(wallet, block) if token.lower() in NATIVE_ADDRESSES
+                    else self._erc20_balance(token, wallet, block) for token in tokens]
+        # a token that did not exist yet has no code, the call succeeds with no data
+        return [decode_uint(raw) if ok and len(raw) >= 32 else 0 for ok, raw in results]
+
+    def _erc20_balance(self, token: str, wallet: str, block: int) -> int:
+        try:
+            raw = self.w3.eth.call({'to': token, 'data': balance_of_data(wallet)}, block)
+        except ContractLogicError:
+            return 0
+        return decode_uint(raw) if len(raw) >= 32 else 0
+
+    def _cached(self, wallet: str, tokens: list, blocks: list) -> dict:
+        found = {}
+        for block in blocks:
+            rows = self.db.execute('SELECT token, balance FROM balances '
+                                   'WHERE chain_id = ? AND wallet = ? AND block = ?',
+                                   (self.chain_id, wallet, block)).fetchall()
+            for token, balance in rows:
+                if token in tokens:
+                    found[(token, block)] = int(balance)
+        return found
+
+    def read(self, wallet: str, wanted: dict) -> dict:
+        """
+        :param wanted: {block: [tokens]}
+        :return: {(token, block): raw balance}
+        """
+        wallet = to_checksum_address(wallet)
+        if self.head is None:
+            self.head = self.w3.eth.block_number
+        tokens = {t for ts in wanted.values() for t in ts}
+        balances = self._cached(wallet, tokens, list(wanted))
+        self.stats['cached'] += len(balances)
+        jobs = []
+        for block, block_tokens in wanted.items():
+            missing = [t for t in block_tokens if (t, block) not in balances]
+            if missing:
+                jobs.append((wallet, missing, block))
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            for (_, missing, block), values in zip(jobs, pool.map(self._read_block, jobs)):
+                balances.update({(t, block): v for t, v in zip(missing, values)})
+        rows = [(self.chain_id, wallet, t, block, str(balances[(t, block)]))
+                for _, missing, block in jobs if block <= self.head - REORG_DEPTH for t in missing]
+        if rows:
+            self.db.executemany('INSERT OR REPLACE INTO balances VALUES (?, ?, ?, ?, ?)', rows)
+            self.db.commit()
+        self.stats['read'] += sum(len(missing) for _, missing, _ in jobs)
+        return balances
+
+    def block_times(self, blocks: list) -> dict:
+        """
+        :return: {block: unix timestamp}
+        """
+        times = {}
+        for block in set(blocks):
+            row = self.db.execute('SELECT timestamp FROM block_times WHERE chain_id = ? AND block = ?',
+                                  (self.chain_id, block)).fetchone()
+            if row:
+                times[block] = row[0]
+        missing = [b for b in set(blocks) if b not in times]
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            for block, header in zip(missing, pool.map(self.w3.eth.get_block, missing)):
+                times[block] = header['timestamp']
+        self.stats['rpc'] += len(missing)
+        if missing:
+            self.db.executemany('INSERT OR REPLACE INTO block_times VALUES (?, ?, ?)',
+                                [(self.chain_id, b, times[b]) for b in missing])
+            self.db.commit()
+        return times
+
+    # ------ change points ----------------------------------------------------------------
+
+    def timeline(self, wallet: str, tokens: list, start: int, end: int, step: int) -> dict:
+        """
+        :param tokens: token addresses, the zero address for the native balance
+        :param start: first block, included
+        :param end: last block, included
+        :param step: blocks between samples
+        :return: {'start': {token: balance at start}, 'changes': [{'block', 'token', 'before', 'after'}, ...]}
+        sorted by block
+        """
+        tokens = [to_checksum_address(t) for t in tokens]
+        samples = sorted(set(list(range(start, end, step)) + [end]))
+        values = self.read(wallet, {block: tokens for block in samples})
+        # intervals (token, lo, hi) whose ends differ, each holds at least one change
+        open_intervals = [(t, lo, hi) for lo, hi in zip(samples, samples[1:]) for t in tokens
+                          if values[(t, lo)] != values[(t, hi)]]
+        changes = []
+        while open_intervals:
+            wanted = {}
+            for token, lo, hi in open_intervals:
+                if hi - lo > 1:
+                    wanted.setdefault((lo + hi) // 2, []).append(token)
+            values.update(self.read(wallet, wanted))
+            split = []
+            for token, lo, hi in open_intervals:
+                if hi - lo == 1:
+                    changes.append({'block': hi, 'token': token, 'before': values[(token, lo)],
+                                    'after': values[(token, hi)]})
+                    continue
+                mid = (lo + hi) // 2
+                split += [(token, a, b) for a, b in ((lo, mid), (mid, hi)) if values[(token, a)] != values[(token, b)]]
+            open_intervals = split
+        changes.sort(key=lambda c: (c['block'], c['token']))
+        return {'start': {t: values[(t, samples[0])] for t in tokens}, 'changes': changes}
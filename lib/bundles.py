@@ -0,0 +1,153 @@
+"""
+Private submission of signed transactions as one bundle (eth_sendBundle, the Flashbots relay api)
+instead of one public send_raw_transaction each. A bundle lands whole, in order, in one block, or
+not at all: an approve and the swap that needs it cannot be split across blocks and nothing can be
+put between them.
+
+The relay is asked to include the bundle in each of the next `blocks` blocks at once. Every new
+block without it slides the window forward by one target, until it lands, `max_blocks` have
+passed, or the sender's nonce moves on without it (another transaction used the nonce, the bundle
+can never land). That costs one block number, one receipt and one nonce read per block.
+"""
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from eth_account import Account
+from eth_account.messages import encode_defunct
+from eth_utils import keccak, to_hex
+from web3.exceptions import TransactionNotFound
+
+from lib import style
+from lib.pyswap_exceptions import BundleError
+
+
+def _raw_hex(raw) -> str:
+    return raw if isinstance(raw, str) else '0x' + bytes(raw).hex()
+
+
+class BundleRelay:
+    """
+    JSON-RPC client of a bundle relay. Requests are signed with `auth_key` in the
+    X-Flashbots-Signature header, relays use it for reputation only: it should not be a key that
+    holds funds, a throwaway one is generated when none is given.
+    """
+    def __init__(self, url: str, auth_key: str = None, timeout: float = 10.0):
+        self.url = url
+        self.auth = Account.from_key(auth_key) if auth_key else Account.create()
+        self.timeout = timeout
+        self._session = requests.Session()
+        self._ids = 0
+
+    def _post(self, method: str, params: list):
+        self._ids += 1
+        body = json.dumps({'jsonrpc': '2.0', 'id': self._ids, 'method': method, 'params': params})
+        signature = self.auth.sign_message(encode_defunct(text=to_hex(keccak(text=body)))).signature.hex()
+        headers = {'Content-Type': 'application/json',
+                   'X-Flashbots-Signature': f'{self.auth.address}:{signature}'}
+        try:
+            response = self._session.post(self.url, data=body, headers=headers, timeout=self.timeout)
+            reply = response.json()
+        except (requests.exceptions.RequestException, ValueError) as err:
+            raise BundleError(f'Relay {self.url} unreachable: {err}')
+        if reply.get('error'):
+            raise BundleError(f'Relay rejected {method}: {reply["error"]}')
+        return reply.get('result')
+
+    def send_bundle(self, raw_txs: list, block: int) -> str:
+        """
+        :return: the bundle hash
+        """
+        result = self._post('eth_sendBundle', [{'txs': [_raw_hex(r) for r in raw_txs], 'blockNumber': hex(block)}])
+        return (result or {}).get('bundleHash')
+
+    def call_bundle(self, raw_txs: list, block: int, state_block='latest') -> dict:
+        """
+        Simulate the bundle on top of `state_block` as if it were mined in `block`.
+        """
+        return self._post('eth_callBundle', [{'txs': [_raw_hex(r) for r in raw_txs], 'blockNumber': hex(block),
+                                              'stateBlockNumber': state_block}])
+
+
+class BundleSubmitter:
+    """
+    Send bundles to a relay and follow them until they land, see the module doc.
+    """
+    def __init__(self, w3, relay: BundleRelay, blocks: int = 3, max_blocks: int = 25, poll: float = 1.0):
+        """
+        :param blocks: future blocks targeted at any time
+        :param max_blocks: give up after this many blocks
+        :param poll: seconds between block number reads, a fraction of the block time
+        """
+        self.w3 = w3
+        self.relay = relay
+        self.blocks = blocks
+        self.max_blocks = max_blocks
+        self.poll = poll
+        self._pool = ThreadPoolExecutor(max_workers=max(4, blocks))
+        self._print = style.PrettyText()
+
+    def _send(self, raw_txs: list, targets: list) -> list:
+        return list(self._pool.map(lambda b: self.relay.send_bundle(raw_txs, b), targets))
+
+    def _landed(self, tx_hashes: list) -> (int, None):
+        # a bundle is all or nothing, its last transaction is enough to check
+        try:
+            receipt = self.w3.eth.get_transaction_receipt(tx_hashes[-1])
+        except TransactionNotFound:
+            return None
+        return receipt['blockNumber'] if receipt else None
+
+    def submit(self, raw_txs: list) -> dict:
+        """
+        :param raw_txs: signed transactions in the order they must execute
+        :return: {'bundle_hash', 'tx_hashes', 'included' (block number or None), 'targets', 'reason'}
+        """
+        if not raw_txs:
+            raise BundleError('Empty bundle')
+        raw_txs = [_raw_hex(r) for r in raw_txs]
+        tx_hashes = [to_hex(keccak(hexstr=r)) for r in raw_txs]
+        sender = Account.recover_transaction(raw_txs[0])
+        base_nonce = self.w3.eth.get_transaction_count(sender)
+        head = self.w3.eth.block_number
+        first = head + 1
+        targets = list(range(first, first + self.blocks))
+        bundle_hash = self._send(raw_txs, targets)[0]
+        self._print.normal(f'Bundle of {len(raw_txs)} sent for blocks {targets[0]}-{targets[-1]}: {bundle_hash}')
+        result = {'bundle_hash': bundle_hash, 'tx_hashes': tx_hashes, 'included': None, 'targets': targets,
+                  'reason': None}
+        while True:
+            block = self.w3.eth.block_number
+            if block == head:
+                time.sleep(self.poll)
+                continue
+            head = block
+            included = self._landed(tx_hashes)
+            if included is not None:
+                result['included'] = included
+                self._print.good(f'Bundle included in block {included}')
+                return result
+            if self.w3.eth.get_transaction_count(sender) > base_nonce:
+                # the receipt may have appeared between the two reads
+                included = self._landed(tx_hashes)
+                if included is not None:
+                    result['included'] = included
+                    self._print.good(f'Bundle included in block {included}')
+                    return result
+                result['reason'] = 'nonce used by another transaction'
+                break
+            if head - first + 1 >= self.max_blocks:
+                result['reason'] = f'not included in {self.max_blocks} blocks'
+                break
+            # keep `blocks` future blocks targeted
+            new = [b for b in range(head + 1, head + 1 + self.blocks)
+                   if b not in targets and b < first + self.max_blocks]
+            if new:
+                try:
+                    self._send(raw_txs, new)
+                except BundleError as err:
+                    self._print.warning(f'Could not extend bundle to {new}: {err}')
+                targets += new
+        self._print.error(f'Bundle {bundle_hash} dropped: {result["reason"]}')
+        return result
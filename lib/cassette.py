@@ -0,0 +1,232 @@
+"""
+Record every JSON-RPC call and 0x api request of a run into a cassette file, then replay the run
+offline: no network, same answers, fast enough to profile the quote / swap flow in a loop.
+
+A cassette is append-only JSON lines (gzip compressed if the path ends in .gz). Each line is
+`[method, key, body index]`, or `[method, key, body index, body]` the first time a body is seen, so
+repeated answers (chain id, block number, the same eth_call) are only stored once. The key is a
+hash of the request after normalisation: hex strings lower cased, dict keys and query strings
+sorted, ids dropped. Loading builds a {key: [bodies]} index; a key seen several times replays its
+answers in recorded order and starts over after the last one.
+
+With strict=False a request that was never recorded gets the next recorded answer of the same
+method instead, so flows that put the time in calldata (swap deadlines) still replay.
+
+Values the run did not get over rpc but needs again on replay (the chain profile, usually read
+from the local cache) are stored under their name with put_value() and read with value().
+"""
+import gzip
+import hashlib
+import json
+import os
+import threading
+from urllib.parse import parse_qsl, urlsplit
+
+import requests
+from requests.adapters import BaseAdapter, HTTPAdapter
+from web3.providers.base import BaseProvider
+
+from lib.pyswap_exceptions import CassetteMiss
+
+MODES = ('record', 'replay')
+# method of the entries written by put_value(), never sent anywhere
+VALUE_METHOD = 'pyswap_value'
+
+
+def _normalise(value):
+    if isinstance(value, str):
+        return value.lower() if value.startswith('0x') else value
+    if isinstance(value, (bytes, bytearray)):
+        return '0x' + bytes(value).hex()
+    if isinstance(value, dict):
+        return {k: _normalise(v) for k, v in sorted(value.items())}
+    if isinstance(value, (list, tuple)):
+        return [_normalise(v) for v in value]
+    return value
+
+
+def request_key(method: str, params) -> str:
+    """
+    :return: hash of the normalised request, what the cassette is indexed by
+    """
+    text = json.dumps([method, _normalise(params)], separators=(',', ':'), default=str)
+    return hashlib.sha1(text.encode()).hexdigest()[:24]
+
+
+def http_request_key(request: requests.PreparedRequest) -> (str, str):
+    """
+    :return: (method, key) of an http request, method is the verb and the url without its query
+    """
+    url = urlsplit(request.url)
+    method = f'{request.method} {url.scheme}://{url.netloc}{url.path}'
+    body = request.body.decode() if isinstance(request.body, bytes) else request.body
+    return method, request_key(method, [sorted(parse_qsl(url.query)), body])
+
+
+class Cassette:
+    """
+    Indexed store of recorded responses, see the module doc.
+    """
+    def __init__(self, path: str, mode: str = 'replay', strict: bool = True):
+        if mode not in MODES:
+            raise ValueError(f'Cassette mode must be one of {MODES}')
+        if mode == 'replay' and not os.path.exists(path):
+            raise FileNotFoundError(f'No cassette at {path}, record one first')
+        self.path = path
+        self.mode = mode
+        self.strict = strict
+        self.bodies = []
+        self.index = {}
+        self.by_method = {}
+        self.stats = {'hits': 0, 'fallbacks': 0, 'recorded': 0}
+        self._body_ids = {}
+        self._cursor = {}
+        self._lock = threading.Lock()
+        self._file = None
+        if os.path.exists(path):
+            self._load()
+
+    def _open(self, mode: str):
+        if self.path.endswith('.gz'):
+            return gzip.open(self.path, mode + 't')
+        return open(self.path, mode)
+
+    def _load(self) -> None:
+        with self._open('r') as ff:
+            for line in ff:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                if len(entry) == 4:
+                    self._body_ids[entry[3]] = len(self.bodies)
+                    self.bodies.append(entry[3])
+                self.index.setdefault(entry[1], []).append(entry[2])
+                self.by_method.setdefault(entry[0], []).append(entry[2])
+
+    def rewind(self) -> None:
+        """
+        Start every key over from its first recorded answer.
+        """
+        with self._lock:
+            self._cursor.clear()
+
+    def _next(self, name, recorded: list) -> str:
+        position = self._cursor.get(name, 0)
+        self._cursor[name] = position + 1
+        return self.bodies[recorded[position % len(recorded)]]
+
+    def play(self, method: str, key: str) -> str:
+        """
+        :return: the recorded body for this request
+        """
+        with self._lock:
+            recorded = self.index.get(key)
+            if recorded:
+                self.stats['hits'] += 1
+                return self._next(key, recorded)
+            recorded = None if self.strict else self.by_method.get(method)
+            if not recorded:
+                raise CassetteMiss(method, key)
+            self.stats['fallbacks'] += 1
+            return self._next(('method', method), recorded)
+
+    def record(self, method: str, key: str, body: str) -> None:
+        with self._lock:
+            entry = [method, key]
+            body_id = self._body_ids.get(body)
+            if body_id is None:
+                body_id = self._body_ids[body] = len(self.bodies)
+                self.bodies.append(body)
+                entry += [body_id, body]
+            else:
+                entry.append(body_id)
+            self.index.setdefault(key, []).append(body_id)
+            self.by_method.setdefault(method, []).append(body_id)
+            if self._file is None:
+                self._file = self._open('a')
+            self._file.write(json.dumps(entry, separators=(',', ':')) + '\n')
+            self._file.flush()
+            self.stats['recorded'] += 1
+
+    def put_value(self, name: str, value) -> None:
+        """
+        Store a JSON serializable value of the run, the last one stored under a name wins.
+        """
+        self.record(VALUE_METHOD, request_key(VALUE_METHOD, [name]), json.dumps(value, separators=(',', ':')))
+
+    def value(self, name: str, default=None):
+        with self._lock:
+            recorded = self.index.get(request_key(VALUE_METHOD, [name]))
+            return json.loads(self.bodies[recorded[-1]]) if recorded else default
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def __len__(self):
+        return sum(len(v) for v in self.index.values())
+
+
+class CassetteProvider(BaseProvider):
+    """
+    Web3 provider that records what the wrapped provider answers, or replays a cassette without one.
+    """
+    def __init__(self, cassette: Cassette, provider: BaseProvider = None):
+        super().__init__()
+        if cassette.mode == 'record' and provider is None:
+            raise ValueError('Recording needs a real provider to record from')
+        self.cassette = cassette
+        self.provider = provider
+
+    def __str__(self):
+        return f'Cassette {self.cassette.mode} {self.cassette.path}'
+
+    def make_request(self, method, params) -> dict:
+        key = request_key(method, params)
+        if self.cassette.mode == 'replay':
+            response = json.loads(self.cassette.play(method, key))
+            response['id'] = 0
+            return response
+        response = self.provider.make_request(method, params)
+        self.cassette.record(method, key, json.dumps({k: v for k, v in response.items() if k != 'id'},
+                                                     separators=(',', ':')))
+        return response
+
+    def isConnected(self) -> bool:
+        return self.cassette.mode == 'replay' or self.provider.isConnected()
+
+    is_connected = isConnected
+
+
+class CassetteAdapter(BaseAdapter):
+    """
+    requests transport adapter doing the same for http apis (the 0x api). Mount it on a session:
+    `session.mount('https://', CassetteAdapter(cassette))`.
+    """
+    def __init__(self, cassette: Cassette, adapter: BaseAdapter = None):
+        super().__init__()
+        self.cassette = cassette
+        self.adapter = adapter or HTTPAdapter()
+
+    def send(self, request, **kwargs) -> requests.Response:
+        method, key = http_request_key(request)
+        if self.cassette.mode == 'replay':
+            recorded = json.loads(self.cassette.play(method, key))
+            response = requests.Response()
+            response.status_code = recorded['status']
+            response.headers.update(recorded['headers'])
+            response._content = recorded['body'].encode()
+            response.encoding = 'utf-8'
+            response.url = request.url
+            response.request = request
+            return response
+        response = self.adapter.send(request, **kwargs)
+        headers = {k: v for k, v in response.headers.items() if k.lower() == 'content-type'}
+        self.cassette.record(method, key, json.dumps({'status': response.status_code, 'headers': headers,
+                                                      'body': response.text}, separators=(',', ':')))
+        return response
+
+    def close(self) -> None:
+        self.adapter.close()
@@ -0,0 +1,131 @@
+import hashlib
+import threading
+import time
+
+from lib import style
+from lib.data_store import snapshot
+from lib.pyswap_exceptions import CassetteMiss
+
+MULTICALL3 = '0xcA11bde05977b3631167028862bE2a173976CA11'
+
+# Chains whose blocks carry the long proof-of-authority extraData and need geth_poa_middleware.
+POA_CHAIN_IDS = frozenset([56, 97, 137, 80001, 100, 43114, 250])
+# The same by network name, for when there is no profile to go by.
+POA_NETWORKS = frozenset(['polygon', 'bsc'])
+
+
+def endpoint_key(endpoints: list) -> str:
+    """
+    The one cache key of a set of endpoints, whichever tool connects to it. Endpoint urls usually
+    embed an api key, only a hash of them is written to disk.
+    :param endpoints: the endpoint urls in use, in configured order
+    """
+    return hashlib.sha256(','.join(endpoints).encode()).hexdigest()[:16]
+
+
+class ChainProfileCache:
+    """
+    Per endpoint cache of the facts we need before talking to a chain: chain id, whether it needs
+    the PoA middleware, native asset symbol, average block time and the Multicall3 address
+    (None if not deployed). Stored in chain_profiles.json in the data directory, shared by every
+    process using it.
+
+    The first contact with an endpoint fetches the profile. After that the cached profile is
+    returned straight away, so start-up does no blocking rpc, and the profile is re-checked once per
+    process on a background thread.
+
+    With a cassette the profile goes into it when recording and comes from it on replay, where the
+    endpoint is never contacted: nothing is fetched, stored or revalidated.
+    """
+    def __init__(self, path: str = 'chain_profiles.json'):
+        self.path = path
+        self._print = style.PrettyText()
+        self._revalidated = set()
+
+    @property
+    def profiles(self) -> dict:
+        # resolved on first use, the data directory may be set in .env, loaded after this module
+        return snapshot(self.path, indent=1).data
+
+    def get(self, endpoints: list, w3, network: str, cassette=None) -> dict:
+        """
+        :param endpoints: the endpoint urls in use, see endpoint_key()
+        :param cassette: lib.cassette.Cassette the run records or replays, if any
+        """
+        if cassette is not None and cassette.mode == 'replay':
+            return self._replayed(cassette, w3, network)
+        profile = self._get(endpoint_key(endpoints), w3, network)
+        if cassette is not None:
+            cassette.put_value('chain_profile', profile)
+        return profile
+
+    def _replayed(self, cassette, w3, network: str) -> dict:
+        profile = cassette.value('chain_profile')
+        if profile is not None:
+            return profile
+        try:
+            # recorded before profiles went into cassettes, the fetch may have been recorded
+            return self.fetch(w3, network)
+        except CassetteMiss:
+            self._print.warning('No chain profile in the cassette, replaying without one.')
+            return {'network': network, 'poa': network in POA_NETWORKS}
+
+    def _get(self, key: str, w3, network: str) -> dict:
+        profile = self.profiles.get(key)
+        if profile is None:
+            profile = self.fetch(w3, network)
+            self._store(key, profile)
+            return profile
+        if key not in self._revalidated:
+            self._revalidated.add(key)
+            threading.Thread(target=self._revalidate, args=(key, w3, network), name='chain-profile',
+                             daemon=True).start()
+        return profile
+
+    @staticmethod
+    def _raw(w3, method: str, params: list):
+        # straight to the provider, PoA blocks fail web3's formatters before the middleware is in place
+        response = w3.provider.make_request(method, params)
+        if 'error' in response:
+            raise ValueError(response['error'])
+        return response['result']
+
+    def fetch(self, w3, network: str) -> dict:
+        chain_id = int(self._raw(w3, 'eth_chainId', []), 16)
+        latest = self._raw(w3, 'eth_getBlockByNumber', ['latest', False])
+        number = int(latest['number'], 16)
+        older = self._raw(w3, 'eth_getBlockByNumber', [hex(max(0, number - 100)), False])
+        span = number - int(older['number'], 16)
+        block_time = (int(latest['timestamp'], 16) - int(older['timestamp'], 16)) / span if span else None
+        extra_data = latest.get('extraData') or '0x'
+        code = self._raw(w3, 'eth_getCode', [MULTICALL3, 'latest'])
+        natives = snapshot('native_currency.json').data.get('native_assets', {})
+        return {
+            'network': network,
+            'chain_id': chain_id,
+            'poa': chain_id in POA_CHAIN_IDS or len(extra_data) > 2 + 2 * 32,
+            'native_asset': natives.get(network),
+            'block_time': round(block_time, 3) if block_time else None,
+            'multicall3': MULTICALL3 if code not in ('0x', '0x0', None) else None,
+            'checked': int(time.time()),
+        }
+
+    def _revalidate(self, key: str, w3, network: str) -> None:
+        try:
+            fresh = self.fetch(w3, network)
+        except Exception as err:
+            self._print.warning(f'Could not revalidate chain profile for {network}: {err}')
+            return
+        cached = self.profiles.get(key, {})
+        if fresh['chain_id'] != cached.get('chain_id'):
+            self._print.error(f'Endpoint for {network} now reports chain id {fresh["chain_id"]}, '
+                              f'cached profile said {cached.get("chain_id")}. Restart to pick it up.')
+        self._store(key, fresh)
+
+    def _store(self, key: str, profile: dict) -> None:
+        def change(profiles):
+            profiles[key] = profile
+        snapshot(self.path, indent=1).update(change)
+
+
+profiles = ChainProfileCache()
@@ -0,0 +1,155 @@
+"""
+The data directory, shared by every process started from this checkout.
+
+Paths are resolved against one root: `pyswap_data_dir` from the environment or .env, otherwise
+the data/ directory next to lib/, so the tools work from any working directory.
+
+JSON files are parsed once per process into a snapshot. A snapshot re-stats its file at most every
+`max_age` seconds and is parsed again only when the file was replaced, so reads are a dict lookup.
+Updates take an advisory lock (flock on `<file>.lock`), re-read the file so changes made by other
+processes in the meantime are kept, apply the change and publish it by renaming a temp file over
+the old one: readers never see a half written file and concurrent writers never lose each other's
+changes.
+"""
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # not on windows, writes are still atomic but concurrent updates are not serialized
+    fcntl = None
+
+DEFAULT_ROOT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data')
+
+
+def data_root() -> str:
+    return os.path.expanduser(os.environ.get('pyswap_data_dir') or DEFAULT_ROOT)
+
+
+def data_path(name: str) -> str:
+    """
+    :param name: file name inside the data directory, ie tokens_ethereum.json, absolute paths are kept
+    """
+    return os.path.join(data_root(), name)
+
+
+@contextmanager
+def file_lock(path: str, shared: bool = False):
+    """
+    Advisory lock of `path`, held on a separate lock file because the file itself is replaced
+    on every write.
+    """
+    if fcntl is None:
+        yield
+        return
+    with open(path + '.lock', 'a') as ff:
+        fcntl.flock(ff, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(ff, fcntl.LOCK_UN)
+
+
+def atomic_write_json(path: str, obj, indent: int = None) -> None:
+    """
+    Write to a temp file in the same directory and rename it over `path`.
+    """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix=os.path.basename(path) + '.',
+                               suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as ff:
+            json.dump(obj, fp=ff, indent=indent, default=str)
+            ff.flush()
+            os.fsync(ff.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def _signature(path: str):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_ino, st.st_mtime_ns, st.st_size
+
+
+class JsonSnapshot:
+    """
+    One JSON file, parsed once and reloaded when another process replaces it, see the module doc.
+    Get instances from snapshot(), not directly, so a process holds one per file.
+    """
+    def __init__(self, path: str, default=None, max_age: float = 1.0, indent: int = None):
+        """
+        :param default: factory of the value used while the file does not exist
+        :param max_age: seconds between stat checks
+        """
+        self.path = path
+        self.default = default or dict
+        self.max_age = max_age
+        self.indent = indent
+        self.stats = {'loads': 0, 'writes': 0}
+        self._data = None
+        self._signature = None
+        self._checked = 0.0
+        self._lock = threading.Lock()
+
+    def _load(self):
+        signature = _signature(self.path)
+        if signature is None:
+            return self.default(), None
+        with open(self.path) as ff:
+            data = json.load(ff)
+        self.stats['loads'] += 1
+        return data, signature
+
+    @property
+    def data(self):
+        """
+        The current contents. Treat it as read only, change the file with update().
+        """
+        now = time.monotonic()
+        if self._data is not None and now - self._checked < self.max_age:
+            return self._data
+        with self._lock:
+            self._checked = now
+            if self._data is None or _signature(self.path) != self._signature:
+                self._data, self._signature = self._load()
+            return self._data
+
+    def update(self, change):
+        """
+        Read-modify-write under the file lock.
+        :param change: called with a fresh copy of the contents to modify in place
+        :return: the new contents
+        """
+        with self._lock, file_lock(self.path):
+            data, _ = self._load()
+            change(data)
+            atomic_write_json(self.path, data, indent=self.indent)
+            self.stats['writes'] += 1
+            self._data, self._signature, self._checked = data, _signature(self.path), time.monotonic()
+            return data
+
+
+_snapshots = {}
+_snapshots_lock = threading.Lock()
+
+
+def snapshot(path: str, **kwargs) -> JsonSnapshot:
+    """
+    :param path: absolute, or a name inside the data directory
+    :return: this process's snapshot of the file
+    """
+    path = os.path.abspath(data_path(path))
+    with _snapshots_lock:
+        if path not in _snapshots:
+            _snapshots[path] = JsonSnapshot(path, **kwargs)
+        return _snapshots[path]
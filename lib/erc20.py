@@ -0,0 +1,133 @@
+"""
+Precompiled calldata for the hot ERC-20 calls, and a cache for web3 contract objects.
+
+`w3.eth.contract(address, abi=...)` re-processes the whole ABI and `contract.functions.x(...).call()`
+goes through ABI lookup, argument normalisation and eth_abi encoding on every call. For the handful
+of ERC-20 reads we do constantly the calldata is a fixed selector plus 32 byte words, so it is
+cheaper to build it directly. See extras/bench_erc20.py for numbers.
+"""
+from eth_utils import function_signature_to_4byte_selector, to_checksum_address
+
+from lib.pyswap_exceptions import NotAContract
+
+
+def _selector(signature: str) -> str:
+    return '0x' + function_signature_to_4byte_selector(signature).hex()
+
+
+BALANCE_OF = _selector('balanceOf(address)')
+DECIMALS = _selector('decimals()')
+SYMBOL = _selector('symbol()')
+ALLOWANCE = _selector('allowance(address,address)')
+APPROVE = _selector('approve(address,uint256)')
+TRANSFER = _selector('transfer(address,uint256)')
+
+_ZERO_PAD = '0' * 24
+
+
+def encode_address(address: str) -> str:
+    """
+    :return: 32 byte hex word (no 0x) for an address
+    """
+    return _ZERO_PAD + address[-40:].lower()
+
+
+def encode_uint(value: int) -> str:
+    """
+    :return: 32 byte hex word (no 0x) for an unsigned int
+    """
+    return format(value, '064x')
+
+
+def balance_of_data(owner: str) -> str:
+    return BALANCE_OF + encode_address(owner)
+
+
+def allowance_data(owner: str, spender: str) -> str:
+    return ALLOWANCE + encode_address(owner) + encode_address(spender)
+
+
+def approve_data(spender: str, amount: int) -> str:
+    return APPROVE + encode_address(spender) + encode_uint(amount)
+
+
+def transfer_data(recipient: str, amount: int) -> str:
+    return TRANSFER + encode_address(recipient) + encode_uint(amount)
+
+
+def decode_uint(raw: bytes) -> int:
+    """
+    Decode a single uint return value. Empty return data (no code at address) decodes to 0, check
+    the length first where that has to be told apart, see Erc20Reader.
+    """
+    return int.from_bytes(raw[:32], 'big')
+
+
+def decode_string(raw: bytes) -> str:
+    """
+    Decode a string return value. Handles the old bytes32 style used by tokens like MKR.
+    """
+    if len(raw) == 32:
+        return raw.rstrip(b'\x00').decode('utf-8', errors='replace')
+    if len(raw) < 64:
+        return ''
+    offset = int.from_bytes(raw[:32], 'big')
+    length = int.from_bytes(raw[offset:offset + 32], 'big')
+    return raw[offset + 32:offset + 32 + length].decode('utf-8', errors='replace')
+
+
+class Erc20Reader:
+    """
+    ERC-20 reads through a raw eth_call with precompiled calldata.
+    """
+    def __init__(self, w3):
+        self.w3 = w3
+
+    def _call(self, token: str, data: str, block_identifier='latest') -> bytes:
+        return self.w3.eth.call({'to': token, 'data': data}, block_identifier)
+
+    def balance_of(self, token: str, owner: str, block_identifier='latest') -> int:
+        return decode_uint(self._call(token, balance_of_data(owner), block_identifier))
+
+    def _contract_call(self, token: str, data: str) -> bytes:
+        # a call to an address without code succeeds with no data, every token answers with a word or more
+        raw = self._call(token, data)
+        if len(raw) < 32:
+            raise NotAContract(token)
+        return raw
+
+    def decimals(self, token: str) -> int:
+        """
+        :raises NotAContract: nothing deployed at `token`
+        """
+        return decode_uint(self._contract_call(token, DECIMALS))
+
+    def symbol(self, token: str) -> str:
+        """
+        :raises NotAContract: nothing deployed at `token`
+        """
+        return decode_string(self._contract_call(token, SYMBOL))
+
+    def allowance(self, token: str, owner: str, spender: str) -> int:
+        return decode_uint(self._call(token, allowance_data(owner, spender)))
+
+
+class ContractCache:
+    """
+    web3 contract objects keyed by (address, id(abi)). ABIs are module level constants in
+    lib/abi_lib.py so their id is stable for the life of the process.
+    """
+    def __init__(self, w3):
+        self.w3 = w3
+        self._contracts = {}
+
+    def get(self, address: str, abi: list):
+        key = (address.lower(), id(abi))
+        contract = self._contracts.get(key)
+        if contract is None:
+            contract = self.w3.eth.contract(to_checksum_address(address), abi=abi)
+            self._contracts[key] = contract
+        return contract
+
+    def __len__(self):
+        return len(self._contracts)
@@ -0,0 +1,369 @@
+import bisect
+import sqlite3
+import threading
+import time
+
+from eth_utils import to_checksum_address, to_hex
+from web3.exceptions import TransactionNotFound
+
+from lib import style
+from lib.data_store import data_path
+from lib.reserves import ReserveCache
+from lib.v2_math import get_amounts_out
+from lib.ws_provider import PersistentWebsocketProvider
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS orders (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    network TEXT NOT NULL,
+    pair_key TEXT NOT NULL,
+    input TEXT NOT NULL,
+    output TEXT NOT NULL,
+    in_decimals INTEGER NOT NULL,
+    out_decimals INTEGER NOT NULL,
+    amount_raw TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    trigger_price REAL NOT NULL,
+    state TEXT NOT NULL DEFAULT 'open',
+    created INTEGER NOT NULL,
+    block INTEGER,
+    txid TEXT,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS orders_open_by_pair ON orders (network, state, pair_key, kind, trigger_price);
+'''
+
+# limit: sell once the price is at or above the trigger. stop: sell once it is at or below.
+KINDS = ('limit', 'stop')
+# A sent swap the node has never heard of after this many blocks was dropped.
+DROPPED_AFTER = 50
+
+
+def pair_key(input_token: str, output_token: str) -> str:
+    """
+    Orders are grouped by direction, the price of input in output is not the price of output in input.
+    """
+    return f'{input_token.lower()}:{output_token.lower()}'
+
+
+class OrderBook:
+    """
+    Limit and stop orders in SQLite (limit_orders.db in the data directory), indexed by network,
+    state and pair. amount_raw is stored as text, token amounts do not fit sqlite's 64 bit integers.
+    In WAL mode, so the engine keeps reading while other processes add or cancel orders.
+    """
+    def __init__(self, path: str = 'limit_orders.db'):
+        self.path = data_path(path)
+        self.db = sqlite3.connect(self.path, timeout=30)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript(SCHEMA)
+        # pairs changed through this connection since the engine last looked
+        self.changed = set()
+        self._data_version = self._external_version()
+
+    def _external_version(self) -> int:
+        # sqlite bumps this when another connection commits, ie orders added from the cli
+        return self.db.execute('PRAGMA data_version').fetchone()[0]
+
+    def changed_pairs(self) -> (set, None):
+        """
+        :return: pair keys changed since the last call, None if another process changed the db
+        """
+        version = self._external_version()
+        if version != self._data_version:
+            self._data_version = version
+            self.changed.clear()
+            return None
+        changed, self.changed = self.changed, set()
+        return changed
+
+    def _touch(self, order_id: int) -> None:
+        row = self.db.execute('SELECT pair_key FROM orders WHERE id = ?', (order_id,)).fetchone()
+        if row:
+            self.changed.add(row[0])
+
+    def add(self, network: str, input_token: str, output_token: str, in_decimals: int, out_decimals: int,
+            amount_raw: int, kind: str, trigger_price: float) -> int:
+        """
+        :param trigger_price: output per input in human units
+        :return: order id
+        """
+        if kind not in KINDS:
+            raise ValueError(f'Order kind must be one of {KINDS}')
+        with self.db:
+            cur = self.db.execute(
+                'INSERT INTO orders (network, pair_key, input, output, in_decimals, out_decimals, amount_raw, kind, '
+                'trigger_price, created) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (network, pair_key(input_token, output_token), to_checksum_address(input_token),
+                 to_checksum_address(output_token), in_decimals, out_decimals, str(int(amount_raw)), kind,
+                 float(trigger_price), int(time.time())))
+        self.changed.add(pair_key(input_token, output_token))
+        return cur.lastrowid
+
+    def set_state(self, order_id: int, state: str, **fields) -> None:
+        columns = ', '.join(f'{k} = ?' for k in ['state'] + list(fields))
+        with self.db:
+            self.db.execute(f'UPDATE orders SET {columns} WHERE id = ?', [state] + list(fields.values()) + [order_id])
+        self._touch(order_id)
+
+    def cancel(self, order_id: int) -> bool:
+        with self.db:
+            cur = self.db.execute("UPDATE orders SET state = 'cancelled' WHERE id = ? AND state = 'open'", (order_id,))
+        self._touch(order_id)
+        return cur.rowcount == 1
+
+    def orders(self, network: str = None, state: str = None) -> list:
+        query, params = 'SELECT * FROM orders WHERE 1 = 1', []
+        if network:
+            query, params = query + ' AND network = ?', params + [network]
+        if state:
+            query, params = query + ' AND state = ?', params + [state]
+        return [dict(r) for r in self.db.execute(query + ' ORDER BY id', params)]
+
+    def open_pairs(self, network: str) -> list:
+        return [r[0] for r in self.db.execute(
+            "SELECT DISTINCT pair_key FROM orders WHERE network = ? AND state = 'open'", (network,))]
+
+    def open_for_pair(self, network: str, key: str, kind: str) -> list:
+        return [dict(r) for r in self.db.execute(
+            "SELECT * FROM orders WHERE network = ? AND state = 'open' AND pair_key = ? AND kind = ? "
+            "ORDER BY trigger_price", (network, key, kind))]
+
+
+class LimitOrderEngine:
+    """
+    Check open orders every block and send the swap once an order's price is crossed.
+
+    Only pairs with open orders are priced. For a Swapper (v2) all their reserves are refreshed in
+    one Multicall3 batch through lib/reserves.py, a ZeroX client asks the 0x api per pair. Each pair
+    keeps its limit and stop orders sorted by trigger price in memory, so a price change only has to
+    bisect to the crossed orders, and pairs whose price did not move are skipped. Limit orders are
+    re-checked at their own size with the integer v2 math before they fire, stops fire at market.
+
+    An order goes open -> triggered -> sent once its swap is broadcast, and is settled to filled or
+    failed from the receipt on a later block, or to failed when the swap was dropped or its nonce
+    used by another transaction.
+    """
+    def __init__(self, client, book: OrderBook = None):
+        """
+        :param client: a connected Swapper or ZeroX
+        """
+        self.client = client
+        self.w3 = client.w3
+        self.network = client.network
+        self.book = book or OrderBook()
+        self._print = style.PrettyText()
+        self.zrx = not hasattr(client, 'uniswap')
+        if self.zrx:
+            # nobody is there to answer a prompt when an order fires
+            self.client.no_prompt = True
+        self.reserves = None if self.zrx else ReserveCache(self.w3)
+        self._books = None
+        self._last_price = {}
+        self._routes = {}
+        self.stats = {}
+
+    def _load_pair(self, key: str) -> None:
+        books = {}
+        for kind in KINDS:
+            orders = self.book.open_for_pair(self.network, key, kind)
+            books[kind] = ([o['trigger_price'] for o in orders], orders)
+        if books['limit'][1] or books['stop'][1]:
+            self._books[key] = books
+        else:
+            self._books.pop(key, None)
+        # re-check the pair even if its price does not move, it has different orders now
+        self._last_price.pop(key, None)
+
+    def _load_books(self) -> None:
+        """
+        Keep the per pair sorted trigger lists in sync with the db, reloading only changed pairs.
+        """
+        changed = self.book.changed_pairs()
+        if self._books is None or changed is None:
+            self._books = {}
+            self._last_price = {}
+            changed = self.book.open_pairs(self.network)
+        for key in changed:
+            self._load_pair(key)
+
+    # ------ pricing ----------------------------------------------------------------------
+
+    def _route(self, input_token: str, output_token: str) -> (tuple, None):
+        key = pair_key(input_token, output_token)
+        if key not in self._routes:
+            factory = self.client.uniswap.factory_contract.address
+            pair = self.reserves.pair_for(factory, input_token, output_token)
+            if pair:
+                self._routes[key] = ([input_token, output_token], [pair])
+            else:
+                weth = self.client.uniswap.get_weth_address()
+                pairs = self.reserves.pairs_for([(factory, input_token, weth), (factory, weth, output_token)])
+                self._routes[key] = ([input_token, weth, output_token], pairs) if all(pairs) else None
+        return self._routes[key]
+
+    def _hops(self, key: str) -> (list, None):
+        input_token, output_token = key.split(':')
+        route = self._route(input_token, output_token)
+        if route is None:
+            return None
+        path, pairs = route
+        hops = [self.reserves.oriented(pair, path[i]) for i, pair in enumerate(pairs)]
+        return hops if all(hops) else None
+
+    def prices(self, block: int) -> dict:
+        """
+        :return: {pair key: output per input in human units} for every pair with open orders
+        """
+        prices = {}
+        keys = list(self._books)
+        if self.zrx:
+            for key in keys:
+                sample = self._books[key]
+                order = next(o for kind in KINDS for o in sample[kind][1])
+                obj = self.client.quote(order['output'], order['input'], int(order['amount_raw']), quote_only=True)
+                if obj:
+                    prices[key] = float(obj.get('price'))
+            return prices
+        for key in keys:
+            self._route(*key.split(':'))
+        self.reserves.new_block(block)
+        self.reserves.refresh([p for r in self._routes.values() if r for p in r[1]])
+        for key in keys:
+            hops = self._hops(key)
+            if hops is None:
+                continue
+            order = next(o for kind in KINDS for o in self._books[key][kind][1])
+            mid = 10 ** (order['in_decimals'] - order['out_decimals']) * 0.997 ** len(hops)
+            for reserve_in, reserve_out in hops:
+                mid *= reserve_out / reserve_in
+            prices[key] = mid
+        return prices
+
+    def _fills_at_size(self, key: str, order: dict) -> bool:
+        if self.zrx or order['kind'] == 'stop':
+            return True
+        hops = self._hops(key)
+        amount = int(order['amount_raw'])
+        out = get_amounts_out(amount, hops)[-1] if hops else 0
+        price = (out / 10 ** order['out_decimals']) / (amount / 10 ** order['in_decimals'])
+        return price >= order['trigger_price']
+
+    # ------ evaluation -------------------------------------------------------------------
+
+    def crossed(self, key: str, price: float) -> list:
+        """
+        :return: open orders of this pair whose trigger is crossed at this price
+        """
+        books = self._books[key]
+        triggers, orders = books['limit']
+        hit = orders[:bisect.bisect_right(triggers, price)]
+        triggers, orders = books['stop']
+        hit += orders[bisect.bisect_left(triggers, price):]
+        return hit
+
+    def execute(self, order: dict, block: int) -> None:
+        # marked first so a crash between here and the broadcast can not send it twice
+        self.book.set_state(order['id'], 'triggered', block=block)
+        amount = int(order['amount_raw'])
+        try:
+            if self.zrx:
+                txid = self.client.swap(order['output'], order['input'], amount)
+            else:
+                txid = self.client.swap(order['input'], order['output'], raw_qty=amount, no_prompt=True)
+        except Exception as err:
+            txid, error = False, str(err)
+        else:
+            error = None if txid and txid != 2 else 'swap failed'
+        if error:
+            self._print.error(f'Order {order["id"]}: {error}')
+            self.book.set_state(order['id'], 'failed', error=error)
+            return
+        txid = txid if isinstance(txid, str) else to_hex(txid)
+        self.book.set_state(order['id'], 'sent', txid=txid)
+        self._print.good(f'Order {order["id"]} ({order["kind"]} @ {order["trigger_price"]}) sent: {txid}')
+
+    def _receipt(self, txid: str):
+        try:
+            return self.w3.eth.get_transaction_receipt(txid)
+        except TransactionNotFound:
+            return None
+
+    def _outcome(self, order: dict, block: int) -> tuple:
+        """
+        :return: (new state, error) of a sent order, (None, None) while its swap is pending
+        """
+        receipt = self._receipt(order['txid'])
+        if receipt is not None:
+            return ('filled', None) if receipt['status'] == 1 else ('failed', 'reverted')
+        try:
+            tx = self.w3.eth.get_transaction(order['txid'])
+        except TransactionNotFound:
+            if block - (order['block'] or block) < DROPPED_AFTER:
+                return None, None
+            return 'failed', 'dropped'
+        if self.w3.eth.get_transaction_count(tx['from']) <= tx['nonce']:
+            return None, None
+        # the nonce is used, by this transaction if the receipt appeared between the reads
+        receipt = self._receipt(order['txid'])
+        if receipt is not None:
+            return ('filled', None) if receipt['status'] == 1 else ('failed', 'reverted')
+        return 'failed', 'replaced'
+
+    def settle(self, block: int) -> None:
+        """
+        Settle the sent orders of this network whose swap has an outcome.
+        """
+        for order in self.book.orders(self.network, 'sent'):
+            state, error = self._outcome(order, block)
+            if state == 'filled':
+                self.book.set_state(order['id'], 'filled')
+                self._print.good(f'Order {order["id"]} filled: {order["txid"]}')
+            elif state == 'failed':
+                self.book.set_state(order['id'], 'failed', error=error)
+                self._print.error(f'Order {order["id"]} failed, swap {error}: {order["txid"]}')
+
+    def evaluate(self, block: int) -> list:
+        """
+        Price pairs with open orders and fire every crossed order.
+        :return: the orders that fired
+        """
+        start = time.perf_counter()
+        self.settle(block)
+        self._load_books()
+        prices = self.prices(block) if self._books else {}
+        priced = time.perf_counter()
+        fired = []
+        for key, price in prices.items():
+            if self._last_price.get(key) == price:
+                continue
+            self._last_price[key] = price
+            for order in self.crossed(key, price):
+                if self._fills_at_size(key, order):
+                    fired.append(order)
+        for order in fired:
+            self.execute(order, block)
+        self.stats = {'block': block, 'pairs': len(self._books),
+                      'orders': sum(len(b[k][1]) for b in self._books.values() for k in KINDS),
+                      'price_ms': round((priced - start) * 1000, 1),
+                      'match_ms': round((time.perf_counter() - priced) * 1000, 1), 'fired': len(fired)}
+        return fired
+
+    def run(self, poll: float = None) -> None:
+        """
+        Evaluate on every new block until interrupted.
+        """
+        new_head = threading.Event()
+        if isinstance(self.w3.provider, PersistentWebsocketProvider):
+            self.w3.provider.subscribe_new_heads(lambda head: new_head.set())
+        poll = poll or (self.client.chain.get('block_time') or 12.0) / 4
+        last = None
+        while True:
+            block = self.w3.eth.block_number
+            if block != last:
+                last = block
+                self.evaluate(block)
+                self._print.debug(f'Limit orders: {self.stats}')
+            new_head.wait(timeout=poll)
+            new_head.clear()
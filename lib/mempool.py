@@ -0,0 +1,258 @@
+import queue
+import threading
+import time
+from collections import OrderedDict
+
+from eth_abi import decode_abi
+from eth_utils import function_signature_to_4byte_selector, to_checksum_address
+
+from lib import style
+from lib.reserves import ReserveCache
+from lib.utils import dex_contracts
+from lib.v2_math import get_amounts_out, get_amount_in, price_impact
+from lib.ws_provider import PersistentWebsocketProvider
+
+_V3_SINGLE = '(address,address,uint24,address,uint256,uint256,uint256,uint160)'
+
+# name, argument types, exact side, index of the fixed amount, index of the path (None for v3)
+_SWAP_FUNCTIONS = [
+    ('swapExactTokensForTokens', ['uint256', 'uint256', 'address[]', 'address', 'uint256'], 'in', 0, 2),
+    ('swapTokensForExactTokens', ['uint256', 'uint256', 'address[]', 'address', 'uint256'], 'out', 0, 2),
+    ('swapExactETHForTokens', ['uint256', 'address[]', 'address', 'uint256'], 'in', None, 1),
+    ('swapTokensForExactETH', ['uint256', 'uint256', 'address[]', 'address', 'uint256'], 'out', 0, 2),
+    ('swapExactTokensForETH', ['uint256', 'uint256', 'address[]', 'address', 'uint256'], 'in', 0, 2),
+    ('swapETHForExactTokens', ['uint256', 'address[]', 'address', 'uint256'], 'out', 0, 1),
+    ('swapExactTokensForTokensSupportingFeeOnTransferTokens',
+     ['uint256', 'uint256', 'address[]', 'address', 'uint256'], 'in', 0, 2),
+    ('swapExactETHForTokensSupportingFeeOnTransferTokens', ['uint256', 'address[]', 'address', 'uint256'],
+     'in', None, 1),
+    ('swapExactTokensForETHSupportingFeeOnTransferTokens',
+     ['uint256', 'uint256', 'address[]', 'address', 'uint256'], 'in', 0, 2),
+    ('exactInputSingle', [_V3_SINGLE], 'in', 5, None),
+    ('exactOutputSingle', [_V3_SINGLE], 'out', 5, None),
+]
+
+
+def _signature(name: str, types: list) -> str:
+    return f'{name}({",".join(types)})'
+
+
+# '0x12345678' -> (name, types, exact side, amount index, path index), computed once at import
+SELECTORS = {'0x' + function_signature_to_4byte_selector(_signature(n, t)).hex(): (n, t, e, a, p)
+             for n, t, e, a, p in _SWAP_FUNCTIONS}
+
+
+class MempoolWatcher:
+    """
+    Watch pending transactions for router swaps that touch a set of watched tokens.
+
+    Transactions come either from a newPendingTransactions subscription on a websocket provider
+    or by polling txpool_content (a local node or dev chain). Each one goes through cheap string
+    checks first: `to` against the configured routers, the 4 byte selector against SELECTORS, and
+    a substring search of the calldata for a watched token. Only survivors are ABI decoded.
+    The price impact of v2 swaps comes from reserves cached per block (lib/reserves.py).
+
+    Every hash is checked against an LRU of the last `seen_limit` hashes first, so a transaction is
+    looked at once however often it is announced. When the node only sends hashes, the bodies are
+    fetched on a separate thread in JSON-RPC batches of up to `batch_size`, the subscription
+    callbacks (new heads included) never wait for them. Hashes arriving while `max_backlog` are
+    waiting are dropped and counted.
+    """
+    def __init__(self, w3, network: str, tokens: list, on_swap=None, seen_limit: int = 200000,
+                 batch_size: int = 100, max_backlog: int = 20000):
+        """
+        :param tokens: addresses to watch
+        :param on_swap: called with a dict per decoded swap, prints it by default
+        :param batch_size: transaction bodies fetched per request when the node only sends hashes
+        """
+        self.w3 = w3
+        self.network = network
+        self._print = style.PrettyText()
+        self.on_swap = on_swap or (lambda swap: self._print.data(swap, 'Pending swap:'))
+        self.reserves = ReserveCache(w3)
+        self.routers = {}
+        for deployment in dex_contracts(network):
+            if deployment.get('router'):
+                info = (deployment['dex'], deployment['version'], deployment['factory'])
+                # both spellings so the hot path never has to lower() the `to` field
+                self.routers[deployment['router'].lower()] = info
+                self.routers[to_checksum_address(deployment['router'])] = info
+        self.watched = {t.lower() for t in tokens}
+        self._watched_hex = tuple(t[2:] for t in self.watched)
+        self._seen = OrderedDict()
+        self._seen_limit = seen_limit
+        self.batch_size = batch_size
+        self._hashes = queue.Queue(maxsize=max_backlog)
+        self._fetcher = None
+        self.stats = {'received': 0, 'router': 0, 'matched': 0, 'decoded': 0, 'fetched': 0, 'dropped': 0}
+
+    # ------ filtering / decoding ---------------------------------------------------------
+
+    def _mark_seen(self, tx_hash: str) -> bool:
+        """
+        :return: True the first time a hash is seen since it was last evicted
+        """
+        if tx_hash in self._seen:
+            self._seen.move_to_end(tx_hash)
+            return False
+        self._seen[tx_hash] = None
+        if len(self._seen) > self._seen_limit:
+            self._seen.popitem(last=False)
+        return True
+
+    def handle(self, tx: dict) -> (dict, None):
+        """
+        Run one pending transaction (as returned by the node, hex fields) through the filters. The
+        sources skip hashes they have already seen before calling this.
+        :return: the decoded swap if it was emitted
+        """
+        self.stats['received'] += 1
+        router = self.routers.get(tx.get('to'))
+        if router is None:
+            return None
+        self.stats['router'] += 1
+        data = tx.get('input') or tx.get('data') or ''
+        spec = SELECTORS.get(data[:10])
+        if spec is None:
+            return None
+        lowered = data.lower()
+        if not any(t in lowered for t in self._watched_hex):
+            return None
+        self.stats['matched'] += 1
+        swap = self.decode(tx, data, spec, router)
+        if swap is not None:
+            self.stats['decoded'] += 1
+            self.on_swap(swap)
+        return swap
+
+    def decode(self, tx: dict, data: str, spec: tuple, router: tuple) -> (dict, None):
+        name, types, exact, amount_idx, path_idx = spec
+        dex, version, factory = router
+        try:
+            args = decode_abi(types, bytes.fromhex(data[10:]))
+        except Exception:
+            return None
+        value = tx.get('value') or 0
+        value = int(value, 16) if isinstance(value, str) else value
+        if path_idx is None:
+            params = args[0]
+            path = [params[0].lower(), params[1].lower()]
+            fixed = params[amount_idx]
+            limit = params[6]
+        else:
+            path = [a.lower() for a in args[path_idx]]
+            fixed = value if amount_idx is None else args[amount_idx]
+            limit = args[1] if path_idx == 2 else (value if exact == 'out' else args[0])
+        if self.watched.isdisjoint(path):
+            # the watched address was somewhere else in the calldata, ie the recipient
+            return None
+        swap = {
+            'hash': tx.get('hash'),
+            'from': tx.get('from'),
+            'dex': dex,
+            'version': version,
+            'function': name,
+            'path': path,
+            'amount_in': fixed if exact == 'in' else None,
+            'amount_out': fixed if exact == 'out' else None,
+            'limit': limit,
+            'price_impact': None,
+        }
+        if version == 2:
+            self._v2_impact(swap, factory, exact, fixed)
+        return swap
+
+    def _v2_impact(self, swap: dict, factory: str, exact: str, fixed: int) -> None:
+        path = swap['path']
+        pairs = self.reserves.pairs_for([(factory, path[i], path[i + 1]) for i in range(len(path) - 1)])
+        if not all(pairs):
+            return
+        self.reserves.refresh(pairs)
+        hops = [self.reserves.oriented(pair, path[i]) for i, pair in enumerate(pairs)]
+        if not all(hops):
+            return
+        if exact == 'in':
+            swap['amount_out'] = get_amounts_out(fixed, hops)[-1]
+        else:
+            amount = fixed
+            for reserve_in, reserve_out in reversed(hops):
+                amount = get_amount_in(amount, reserve_in, reserve_out)
+            swap['amount_in'] = amount
+        swap['price_impact'] = round(price_impact(swap['amount_in'], hops), 6)
+
+    # ------ sources ----------------------------------------------------------------------
+
+    def _raw(self, method: str, params: list):
+        response = self.w3.provider.make_request(method, params)
+        if 'error' in response:
+            raise ValueError(response['error'])
+        return response['result']
+
+    def _on_pending(self, result):
+        if isinstance(result, str):
+            # node only sends hashes, the body is fetched on the fetcher thread
+            if self._mark_seen(result):
+                try:
+                    self._hashes.put_nowait(result)
+                except queue.Full:
+                    self.stats['dropped'] += 1
+            return
+        if self._mark_seen(result.get('hash')):
+            self.handle(result)
+
+    def _fetch_bodies(self) -> None:
+        while True:
+            hashes = [self._hashes.get()]
+            while len(hashes) < self.batch_size:
+                try:
+                    hashes.append(self._hashes.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                responses = self.w3.provider.make_batch_request([('eth_getTransactionByHash', [h]) for h in hashes])
+            except Exception as err:
+                self._print.warning(f'Could not fetch {len(hashes)} pending transactions: {err!r}')
+                self.stats['dropped'] += len(hashes)
+                continue
+            self.stats['fetched'] += len(hashes)
+            for response in responses:
+                # gone from the pool already, or an error for this one
+                if response.get('result'):
+                    self.handle(response['result'])
+
+    def _on_head(self, head: dict):
+        self.reserves.new_block(int(head['number'], 16))
+
+    def run_subscription(self) -> None:
+        """
+        Stream from a websocket provider until interrupted.
+        """
+        provider = self.w3.provider
+        if not isinstance(provider, PersistentWebsocketProvider):
+            raise ValueError('Subscriptions need a ws:// endpoint, use run_polling() instead')
+        self._fetcher = threading.Thread(target=self._fetch_bodies, name='mempool-fetch', daemon=True)
+        self._fetcher.start()
+        provider.subscribe_new_heads(self._on_head)
+        provider.subscribe_pending_transactions(self._on_pending, full=True)
+        self._print.good(f'Watching pending transactions for {len(self.watched)} tokens ...')
+        while True:
+            time.sleep(60)
+            self._print.debug(f'Mempool stats: {self.stats}')
+
+    def run_polling(self, interval: float = 1.0, iterations: int = None) -> None:
+        """
+        Poll txpool_content. Needs a node that exposes the txpool namespace.
+        :param iterations: stop after this many polls, forever if None
+        """
+        self._print.good(f'Polling txpool every {interval}s for {len(self.watched)} tokens ...')
+        n = 0
+        while iterations is None or n < iterations:
+            n += 1
+            start = time.time()
+            self.reserves.new_block(int(self._raw('eth_blockNumber', []), 16))
+            pool = self._raw('txpool_content', [])
+            for by_nonce in (pool.get('pending') or {}).values():
+                for tx in by_nonce.values():
+                    if self._mark_seen(tx.get('hash')):
+                        self.handle(tx)
+            time.sleep(max(0.0, interval - (time.time() - start)))
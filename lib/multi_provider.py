@@ -0,0 +1,236 @@
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, as_completed, FIRST_COMPLETED
+
+import requests
+import web3
+from web3.providers.base import BaseProvider
+
+# Methods that change chain state. These are fanned out to every healthy endpoint instead of hedged.
+WRITE_METHODS = frozenset(['eth_sendRawTransaction', 'eth_sendTransaction'])
+
+# JSON-RPC error codes that mean "this endpoint is throttling us", not "your request is bad".
+RATE_LIMIT_CODES = frozenset([-32005, -32029, -32090, 429])
+
+
+def endpoints_from_env(network: str) -> list:
+    """
+    Collect every configured http endpoint for this network from the environment.
+    `{network}_http_endpoints` is a comma separated list, `{network}_http_endpoint` is the
+    legacy single endpoint and is appended if not already present.
+    :param network: the name of the chain (ie ethereum)
+    :return: list of endpoint urls, primary first
+    """
+    endpoints = []
+    multi = os.environ.get(f'{network}_http_endpoints')
+    if multi:
+        endpoints = [e.strip() for e in multi.split(',') if e.strip()]
+    single = os.environ.get(f'{network}_http_endpoint')
+    if single and single not in endpoints:
+        endpoints.append(single)
+    return endpoints
+
+
+def pooled_session(pool_size: int) -> requests.Session:
+    """
+    A requests session whose connection pool holds up to pool_size keep-alive connections per host.
+    requests defaults to 10, threads beyond that open and drop a fresh connection per request.
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def make_http_provider(endpoints: list, request_kwargs: dict = None, pool_size: int = None) -> BaseProvider:
+    """
+    Return a plain HTTPProvider for one endpoint, or a MultiEndpointProvider for several.
+    :param endpoints: list of endpoint urls
+    :param request_kwargs: passed through to requests
+    :param pool_size: size of each endpoint's connection pool, requests' default if None
+    :return: web3 provider
+    """
+    if len(endpoints) <= 1:
+        return web3.HTTPProvider(endpoints[0] if endpoints else None, request_kwargs=request_kwargs,
+                                 session=pooled_session(pool_size) if pool_size else None)
+    return MultiEndpointProvider(endpoints, request_kwargs=request_kwargs, pool_size=pool_size)
+
+
+class EndpointHealth:
+    """
+    Rolling health statistics for one rpc endpoint: EWMA latency, EWMA error rate and a window
+    of recent successful latencies used to pick the hedge delay.
+    """
+    def __init__(self, uri: str, alpha: float = 0.2, window: int = 128):
+        self.uri = uri
+        self.alpha = alpha
+        self.ewma_latency = None
+        self.ewma_error = 0.0
+        self.samples = deque(maxlen=window)
+        self.requests = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    def record(self, latency: float, ok: bool) -> None:
+        with self._lock:
+            self.requests += 1
+            self.ewma_error = (1 - self.alpha) * self.ewma_error + self.alpha * (0.0 if ok else 1.0)
+            if not ok:
+                self.errors += 1
+                return
+            self.samples.append(latency)
+            if self.ewma_latency is None:
+                self.ewma_latency = latency
+            else:
+                self.ewma_latency = (1 - self.alpha) * self.ewma_latency + self.alpha * latency
+
+    def percentile(self, pct: float) -> (float, None):
+        """
+        :param pct: 0.0 - 1.0
+        :return: latency at this percentile of recent successful requests, or None if no samples yet
+        """
+        with self._lock:
+            if not self.samples:
+                return None
+            ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(pct * len(ordered)))]
+
+    @property
+    def healthy(self) -> bool:
+        return self.ewma_error < 0.5
+
+    def score(self) -> float:
+        """
+        Lower is better. Unknown endpoints score 0 so they get probed early.
+        """
+        latency = self.ewma_latency if self.ewma_latency is not None else 0.0
+        return latency * (1 + 4 * self.ewma_error) + self.ewma_error
+
+    def __repr__(self):
+        return f'<EndpointHealth {self.uri} ewma={self.ewma_latency} err={self.ewma_error:.2f}>'
+
+
+class MultiEndpointProvider(BaseProvider):
+    """
+    Web3 provider spread over several rpc endpoints.
+
+    Reads are hedged: the request goes to the best scoring endpoint and, if it has not answered
+    within `hedge_percentile` of that endpoint's recent latencies, the same request is fired at the
+    next best endpoint and whichever answers first wins. Failed or throttled endpoints are failed
+    over immediately. Writes are sent to every healthy endpoint at once for faster propagation.
+    """
+    def __init__(self, endpoint_uris: list,
+                 hedge_percentile: float = 0.9,
+                 min_hedge_delay: float = 0.05,
+                 default_hedge_delay: float = 0.5,
+                 request_kwargs: dict = None,
+                 max_workers: int = 16,
+                 pool_size: int = None):
+        super().__init__()
+        if not endpoint_uris:
+            raise ValueError('MultiEndpointProvider needs at least one endpoint')
+        self.endpoint_uris = list(endpoint_uris)
+        self.hedge_percentile = hedge_percentile
+        self.min_hedge_delay = min_hedge_delay
+        self.default_hedge_delay = default_hedge_delay
+        self.providers = [web3.HTTPProvider(uri, request_kwargs=request_kwargs or {'timeout': 30},
+                                            session=pooled_session(pool_size) if pool_size else None)
+                          for uri in self.endpoint_uris]
+        self.health = [EndpointHealth(uri) for uri in self.endpoint_uris]
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='rpc-hedge')
+
+    def __str__(self):
+        return f'Multi endpoint RPC connection {self.endpoint_uris}'
+
+    def ranked(self) -> list:
+        """
+        :return: endpoint indexes, healthy endpoints first, each group ordered by score
+        """
+        return sorted(range(len(self.providers)),
+                      key=lambda i: (not self.health[i].healthy, self.health[i].score()))
+
+    def _call(self, index: int, method, params) -> dict:
+        start = time.perf_counter()
+        try:
+            response = self.providers[index].make_request(method, params)
+        except Exception:
+            self.health[index].record(time.perf_counter() - start, False)
+            raise
+        error = response.get('error') if isinstance(response, dict) else None
+        throttled = isinstance(error, dict) and error.get('code') in RATE_LIMIT_CODES
+        self.health[index].record(time.perf_counter() - start, not throttled)
+        if throttled:
+            raise ConnectionError(f'{self.endpoint_uris[index]} throttled: {error.get("message")}')
+        return response
+
+    def _hedge_delay(self, index: int) -> float:
+        delay = self.health[index].percentile(self.hedge_percentile)
+        if delay is None:
+            return self.default_hedge_delay
+        return max(self.min_hedge_delay, delay)
+
+    def make_request(self, method, params) -> dict:
+        if method in WRITE_METHODS:
+            return self._broadcast(method, params)
+        return self._hedged(method, params)
+
+    def _hedged(self, method, params) -> dict:
+        order = self.ranked()
+        pending = {}
+        last_err = None
+        next_idx = 0
+
+        def launch():
+            nonlocal next_idx
+            index = order[next_idx]
+            next_idx += 1
+            pending[self._pool.submit(self._call, index, method, params)] = index
+            return index
+
+        primary = launch()
+        timeout = self._hedge_delay(primary)
+        while pending:
+            done, _ = wait(list(pending), timeout=timeout, return_when=FIRST_COMPLETED)
+            timeout = None
+            if not done:
+                # primary is slower than its usual tail, hedge on the next endpoint
+                if next_idx < len(order):
+                    launch()
+                continue
+            for fut in done:
+                pending.pop(fut)
+                try:
+                    return fut.result()
+                except Exception as err:
+                    last_err = err
+            if not pending and next_idx < len(order):
+                # everything in flight failed, fail over to an endpoint we have not tried yet
+                launch()
+        raise last_err
+
+    def _broadcast(self, method, params) -> dict:
+        targets = [i for i in self.ranked() if self.health[i].healthy] or self.ranked()
+        futures = [self._pool.submit(self._call, i, method, params) for i in targets]
+        first_error_response = None
+        last_err = None
+        for fut in as_completed(futures):
+            try:
+                response = fut.result()
+            except Exception as err:
+                last_err = err
+                continue
+            if 'error' not in response:
+                return response
+            if first_error_response is None:
+                first_error_response = response
+        if first_error_response is not None:
+            return first_error_response
+        raise last_err
+
+    def isConnected(self) -> bool:
+        return any(p.isConnected() for p in self.providers)
+
+    is_connected = isConnected
@@ -0,0 +1,51 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from eth_abi import encode_abi, decode_abi
+from eth_utils import function_signature_to_4byte_selector
+
+from lib.chain_profile import MULTICALL3
+
+AGGREGATE3 = '0x' + function_signature_to_4byte_selector('aggregate3((address,bool,bytes)[])').hex()
+
+
+def _to_bytes(data) -> bytes:
+    if isinstance(data, (bytes, bytearray)):
+        return bytes(data)
+    return bytes.fromhex(data[2:] if data.startswith('0x') else data)
+
+
+class Multicall:
+    """
+    Batch many eth_calls into Multicall3.aggregate3 calls. Failed sub calls come back as
+    (False, revert data) instead of failing the batch.
+    """
+    def __init__(self, w3, address: str = MULTICALL3, chunk_size: int = 500, max_workers: int = 4):
+        """
+        :param chunk_size: sub calls per eth_call, keeps requests under provider size / gas limits
+        :param max_workers: chunks of one batch that may be in flight at once
+        """
+        self.w3 = w3
+        self.address = address
+        self.chunk_size = chunk_size
+        self.max_workers = max_workers
+
+    def _aggregate(self, calls: list, block_identifier) -> list:
+        data = encode_abi(['(address,bool,bytes)[]'], [[(target, True, _to_bytes(cd)) for target, cd in calls]])
+        raw = self.w3.eth.call({'to': self.address, 'data': AGGREGATE3 + data.hex()}, block_identifier)
+        return list(decode_abi(['(bool,bytes)[]'], bytes(raw))[0])
+
+    def call(self, calls: list, block_identifier='latest') -> list:
+        """
+        :param calls: list of (target address, calldata hex or bytes)
+        :param block_identifier: block to read at, works at historical blocks on archive nodes
+        :return: list of (success, return data bytes) in the same order as calls
+        """
+        chunks = [calls[i:i + self.chunk_size] for i in range(0, len(calls), self.chunk_size)]
+        if len(chunks) <= 1 or self.max_workers <= 1:
+            results = []
+            for chunk in chunks:
+                results.extend(self._aggregate(chunk, block_identifier))
+            return results
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(chunks))) as pool:
+            parts = pool.map(lambda c: self._aggregate(c, block_identifier), chunks)
+        return [r for part in parts for r in part]
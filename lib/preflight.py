@@ -0,0 +1,161 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from eth_abi import decode_abi
+from eth_utils import keccak
+from web3.exceptions import ContractLogicError
+
+from lib import style
+from lib.pyswap_exceptions import PreflightError, SlippageExceeded
+
+TRANSFER_TOPIC = '0x' + keccak(text='Transfer(address,address,uint256)').hex()
+
+# Transaction fields eth_call does not accept.
+_NON_CALL_FIELDS = ('nonce', 'chainId', 'type', 'accessList')
+
+# Fee fields are left out of simulations so the node does not demand balance for gas * price.
+_FEE_FIELDS = ('gasPrice', 'maxFeePerGas', 'maxPriorityFeePerGas')
+
+
+def call_params(tx: dict, drop: tuple = ()) -> dict:
+    """
+    :param drop: extra fields to leave out
+    :return: the transaction fields that eth_call / eth_estimateGas understand
+    """
+    return {k: v for k, v in tx.items() if k not in _NON_CALL_FIELDS and k not in drop}
+
+
+def decode_output(raw: bytes, output_types: list) -> (int, None):
+    """
+    Pull the bought amount out of a swap function's return data.
+    uint256[] amounts (uniswap v2 router) -> last element, uint256 (v3 router, 0x) -> the value,
+    bytes[] (v3 router multicall) -> first result decoded as uint256.
+    :return: int or None if the function returns nothing we can use
+    """
+    if not output_types or not raw:
+        return None
+    value = decode_abi(output_types, raw)[0]
+    if isinstance(value, int):
+        return value
+    if isinstance(value, (list, tuple)) and value:
+        if isinstance(value[-1], int):
+            return value[-1]
+        if isinstance(value[0], bytes) and len(value[0]) >= 32:
+            return int.from_bytes(value[0][:32], 'big')
+    return None
+
+
+def _walk_logs(frame: dict):
+    if frame.get('error'):
+        return
+    for log in frame.get('logs') or []:
+        yield log
+    for child in frame.get('calls') or []:
+        yield from _walk_logs(child)
+
+
+def transfers_in_frame(frame: dict) -> list:
+    """
+    :return: list of (token, from, to, value) for every Transfer log in a callTracer frame,
+    logs of reverted sub calls are skipped
+    """
+    transfers = []
+    for log in _walk_logs(frame):
+        topics = log.get('topics') or []
+        if len(topics) == 3 and topics[0].lower() == TRANSFER_TOPIC:
+            transfers.append((log['address'].lower(), '0x' + topics[1][-40:], '0x' + topics[2][-40:],
+                              int(log.get('data') or '0x0', 16)))
+    return transfers
+
+
+class Preflight:
+    """
+    Simulate a fully built transaction with eth_call against the pending block before it is
+    signed and broadcast. The simulation runs concurrently with eth_estimateGas, so the check costs
+    one round trip that was going to be paid for the gas estimate anyway.
+
+    The realised output is taken from the swap function's return data. For functions that return
+    nothing (the SupportingFeeOnTransfer variants) the Transfer logs of a debug_traceCall are
+    decoded instead, on nodes that support it.
+    """
+    def __init__(self, w3, max_slippage: float = 0.005, gas_multiplier: float = 1.2, use_trace: bool = True):
+        self.w3 = w3
+        self.max_slippage = max_slippage
+        self.gas_multiplier = gas_multiplier
+        self.use_trace = use_trace
+        self._print = style.PrettyText()
+        self._pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix='preflight')
+
+    def simulate(self, tx: dict) -> bytes:
+        return self.w3.eth.call(call_params(tx, _FEE_FIELDS), 'pending')
+
+    def estimate_gas(self, tx: dict) -> int:
+        return int(self.w3.eth.estimate_gas(call_params(tx, _FEE_FIELDS + ('gas',))) * self.gas_multiplier)
+
+    def trace(self, tx: dict) -> (dict, None):
+        """
+        :return: the callTracer frame (with logs) of tx executed at pending, or None if the node
+        does not support debug_traceCall
+        """
+        params = {k: (hex(v) if isinstance(v, int) else v) for k, v in call_params(tx, _FEE_FIELDS).items()}
+        response = self.w3.provider.make_request('debug_traceCall', [
+            params, 'pending', {'tracer': 'callTracer', 'tracerConfig': {'withLog': True}}])
+        if 'error' in response:
+            self._print.debug(f'debug_traceCall unavailable: {response["error"]}')
+            return None
+        return response.get('result') or {}
+
+    def traced_transfers(self, tx: dict) -> (list, None):
+        """
+        :return: list of (token, from, to, value) emitted while executing tx, or None if the node
+        does not support debug_traceCall
+        """
+        frame = self.trace(tx)
+        if frame is None:
+            return None
+        return transfers_in_frame(frame)
+
+    def realised_from_trace(self, tx: dict, output_token: str, recipient: str) -> (int, None):
+        if int(output_token, 16) == 0:
+            # native output does not show up as a Transfer log
+            return None
+        transfers = self.traced_transfers(tx)
+        if transfers is None:
+            return None
+        token, to = output_token.lower(), recipient.lower()
+        return sum(value for t, _, dst, value in transfers if t == token and dst == to)
+
+    def check(self, tx: dict, expected_out: int, output_types: list = None,
+              output_token: str = None, recipient: str = None) -> (int, int):
+        """
+        Simulate tx and estimate its gas in parallel, then enforce the slippage guard.
+        :param tx: the transaction exactly as it is going to be signed
+        :param expected_out: the raw amount the user was quoted
+        :param output_types: return types of the called function, used to decode the bought amount
+        :param output_token: bought token, for the trace fallback
+        :param recipient: receiver of the bought token, for the trace fallback
+        :return: (gas limit to use, realised raw output or None if it could not be determined)
+        """
+        sim = self._pool.submit(self.simulate, tx)
+        gas = self._pool.submit(self.estimate_gas, tx)
+        try:
+            raw = sim.result()
+        except (ContractLogicError, ValueError) as err:
+            gas.cancel()
+            raise PreflightError(f'Simulation reverted: {err}')
+        try:
+            gas_limit = gas.result()
+        except (ContractLogicError, ValueError) as err:
+            raise PreflightError(f'Gas estimation failed: {err}')
+
+        realised = decode_output(bytes(raw), output_types)
+        if realised is None and self.use_trace and output_token and recipient:
+            realised = self.realised_from_trace(tx, output_token, recipient)
+        if realised is None:
+            self._print.warning('Preflight: could not determine simulated output, only checked for reverts.')
+            return gas_limit, None
+
+        floor = int(expected_out * (1 - self.max_slippage))
+        if realised < floor:
+            raise SlippageExceeded(expected_out, realised, self.max_slippage)
+        self._print.good(f'Preflight ok: simulated output {realised}, quoted {expected_out}, gas {gas_limit}')
+        return gas_limit, realised
@@ -1,2 +1,56 @@
+from web3.exceptions import BadFunctionCallOutput
+
+
 class ConfigurationError(Exception):
     pass
+
+
+class PreflightError(Exception):
+    """
+    The pre-broadcast simulation of a transaction failed, the transaction was not sent.
+    """
+    pass
+
+
+class SlippageExceeded(PreflightError):
+    def __init__(self, expected: int, realised: int, max_slippage: float):
+        self.expected = expected
+        self.realised = realised
+        self.max_slippage = max_slippage
+        super().__init__(f'Simulated output {realised} is more than {max_slippage * 100:.2f}% below '
+                         f'the quoted {expected}')
+
+
+class TickWindowExceeded(Exception):
+    """
+    A local v3 swap simulation walked past the tick bitmap words loaded for the pool.
+    """
+    def __init__(self, word_pos: int):
+        self.word_pos = word_pos
+        super().__init__(f'Tick bitmap word {word_pos} is not loaded')
+
+
+class CassetteMiss(Exception):
+    """
+    A replayed run made a request that is not in the cassette.
+    """
+    def __init__(self, method: str, key: str):
+        self.method = method
+        self.key = key
+        super().__init__(f'{method} ({key}) was not recorded in the cassette')
+
+
+class BundleError(Exception):
+    """
+    A bundle relay refused a bundle or could not be reached.
+    """
+    pass
+
+
+class NotAContract(BadFunctionCallOutput):
+    """
+    A token read returned no data: there is no contract at the address.
+    """
+    def __init__(self, address: str):
+        self.address = address
+        super().__init__(f'No contract at {address}')
@@ -0,0 +1,143 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+
+# Reads whose answer only depends on the block they are made at.
+CACHED_METHODS = frozenset(['eth_call', 'eth_getBalance', 'eth_getCode', 'eth_getStorageAt'])
+
+# Never change for a connection, cached for good.
+STATIC_METHODS = frozenset(['eth_chainId', 'net_version'])
+
+class BlockReadCache:
+    """
+    Read-through cache of eth_call and balance / code / storage reads, installed as web3 middleware.
+
+    Entries are keyed by (block number, method, params): reads at `latest` are filed under the
+    current head and reads at an explicit block under that block, so the two share entries.
+    Everything is dropped when a new head arrives, either pushed by new_block() (a websocket
+    newHeads subscription) or noticed when eth_blockNumber is re-polled, at most every `head_ttl`
+    seconds, before serving a `latest` read.
+    LRU eviction keeps it under `max_entries` and roughly `max_bytes` of response data. Writes,
+    `pending` reads and error responses are never cached.
+    """
+    def __init__(self, max_entries: int = 10000, max_bytes: int = 32 * 1024 * 1024, head_ttl: float = 1.0):
+        """
+        :param head_ttl: how stale the head may get without a subscription, a fraction of the block time
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.head_ttl = head_ttl
+        self.block = None
+        self.stats = {'hits': 0, 'misses': 0, 'bypassed': 0, 'evictions': 0, 'blocks': 0}
+        self._entries = OrderedDict()
+        self._static = {}
+        self._bytes = 0
+        self._head_checked = 0.0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.stats['hits'] + self.stats['misses']
+        return self.stats['hits'] / lookups if lookups else 0.0
+
+    def report(self) -> dict:
+        return dict(self.stats, hit_rate=round(self.hit_rate, 4), entries=len(self._entries), bytes=self._bytes)
+
+    def new_block(self, number: int) -> bool:
+        """
+        Move to a new head, dropping every cached read if it changed.
+        :return: True if it did
+        """
+        with self._lock:
+            self._head_checked = time.monotonic()
+            if number == self.block:
+                return False
+            self.block = number
+            self._entries.clear()
+            self._bytes = 0
+            self.stats['blocks'] += 1
+            return True
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def _get(self, key):
+        with self._lock:
+            response = self._entries.get(key)
+            if response is None:
+                self.stats['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return response[0]
+
+    def _put(self, key, response: dict, latest: bool) -> None:
+        size = len(str(response.get('result')))
+        with self._lock:
+            if latest and key[0] != self.block:
+                # the head moved while this read was in flight, it may be from either block
+                return
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._entries[key] = (response, size)
+            self._bytes += size
+            while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._bytes -= evicted
+                self.stats['evictions'] += 1
+
+    def _refresh_head(self, make_request) -> None:
+        if time.monotonic() - self._head_checked < self.head_ttl:
+            return
+        response = make_request('eth_blockNumber', [])
+        if 'result' in response:
+            self.new_block(int(response['result'], 16))
+
+    def middleware(self, make_request, w3):
+        """
+        web3 middleware, install with `w3.middleware_onion.add(cache.middleware, 'read_cache')`.
+        """
+        def inner(method, params):
+            if method in STATIC_METHODS:
+                if method not in self._static:
+                    response = make_request(method, params)
+                    if 'error' in response:
+                        return response
+                    self._static[method] = response
+                return self._static[method]
+            if method == 'eth_blockNumber':
+                response = make_request(method, params)
+                if 'result' in response:
+                    self.new_block(int(response['result'], 16))
+                return response
+            if method not in CACHED_METHODS:
+                return make_request(method, params)
+            # the block is the last param, `pending`, `safe` and `finalized` are passed through uncached
+            tag = params[-1] if params and isinstance(params[-1], str) else None
+            latest = tag == 'latest'
+            if latest:
+                self._refresh_head(make_request)
+                block = self.block
+            elif isinstance(tag, str) and tag.startswith('0x'):
+                block = int(tag, 16)
+            else:
+                block = None
+            if block is None:
+                self.stats['bypassed'] += 1
+                return make_request(method, params)
+            key = (block, method, json.dumps(params[:-1], sort_keys=True, default=str))
+            response = self._get(key)
+            if response is not None:
+                return response
+            response = make_request(method, params)
+            if 'error' not in response:
+                self._put(key, response, latest)
+            return response
+        return inner
@@ -0,0 +1,148 @@
+"""
+Decode swap receipts into what actually happened: tokens in and out of our account, the pools the
+swap went through and their reserves afterwards, and the gas paid. Everything comes from the
+receipt's logs, no extra rpc calls. Topic hashes are computed once at import.
+"""
+import json
+import os
+import time
+
+from eth_utils import event_signature_to_log_topic, to_checksum_address
+
+from lib.data_store import data_path, file_lock
+
+
+def _topic(signature: str) -> str:
+    return '0x' + event_signature_to_log_topic(signature).hex()
+
+
+TRANSFER = _topic('Transfer(address,address,uint256)')
+V2_SWAP = _topic('Swap(address,uint256,uint256,uint256,uint256,address)')
+V2_SYNC = _topic('Sync(uint112,uint112)')
+V3_SWAP = _topic('Swap(address,address,int256,int256,uint160,uint128,int24)')
+WETH_DEPOSIT = _topic('Deposit(address,uint256)')
+WETH_WITHDRAWAL = _topic('Withdrawal(address,uint256)')
+
+# addresses the tools use to mean the chain's native asset rather than a token
+NATIVE_ADDRESSES = frozenset(['0x0000000000000000000000000000000000000000',
+                              '0xeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeee'])
+
+
+def _hex(value) -> str:
+    if isinstance(value, str):
+        return value.lower() if value.startswith('0x') else '0x' + value.lower()
+    return '0x' + bytes(value).hex()
+
+
+def _words(log) -> list:
+    data = _hex(log['data'])[2:]
+    return [int(data[i:i + 64], 16) for i in range(0, len(data), 64)]
+
+
+def _signed(word: int) -> int:
+    return word - (1 << 256) if word >= 1 << 255 else word
+
+
+def _address(topic: str) -> str:
+    return '0x' + topic[-40:]
+
+
+def decode_logs(logs: list) -> dict:
+    """
+    :return: {'transfers': [(token, from, to, amount)], 'v2_swaps': [(pair, a0in, a1in, a0out, a1out)],
+    'v3_swaps': [(pool, amount0, amount1)], 'syncs': {pair: (reserve0, reserve1)},
+    'deposits': [(weth, amount)], 'withdrawals': [(weth, amount)]}, all addresses lower case
+    """
+    out = {'transfers': [], 'v2_swaps': [], 'v3_swaps': [], 'syncs': {}, 'deposits': [], 'withdrawals': []}
+    for log in logs:
+        topics = [_hex(t) for t in log['topics']]
+        if not topics:
+            continue
+        emitter = log['address'].lower()
+        topic0 = topics[0]
+        if topic0 == TRANSFER and len(topics) == 3:
+            out['transfers'].append((emitter, _address(topics[1]), _address(topics[2]), _words(log)[0]))
+        elif topic0 == V2_SWAP:
+            out['v2_swaps'].append((emitter,) + tuple(_words(log)[:4]))
+        elif topic0 == V2_SYNC:
+            # later syncs of the same pair overwrite earlier ones, we want the final reserves
+            out['syncs'][emitter] = tuple(_words(log)[:2])
+        elif topic0 == V3_SWAP:
+            words = _words(log)
+            out['v3_swaps'].append((emitter, _signed(words[0]), _signed(words[1])))
+        elif topic0 == WETH_DEPOSIT:
+            out['deposits'].append((emitter, _words(log)[0]))
+        elif topic0 == WETH_WITHDRAWAL:
+            out['withdrawals'].append((emitter, _words(log)[0]))
+    return out
+
+
+def realised(decoded: dict, account: str, input_token: str, output_token: str) -> (int, int):
+    """
+    Raw amounts that left and reached the account. A native input shows up as the router wrapping
+    it (Deposit), a native output as the router unwrapping it (Withdrawal).
+    """
+    account, input_token, output_token = account.lower(), input_token.lower(), output_token.lower()
+    if input_token in NATIVE_ADDRESSES:
+        amount_in = sum(a for _, a in decoded['deposits'])
+    else:
+        amount_in = sum(a for t, src, _, a in decoded['transfers'] if t == input_token and src == account)
+    if output_token in NATIVE_ADDRESSES:
+        amount_out = sum(a for _, a in decoded['withdrawals'])
+    else:
+        amount_out = sum(a for t, _, dst, a in decoded['transfers'] if t == output_token and dst == account)
+    return amount_in, amount_out
+
+
+def fill_report(receipt: dict, account: str, trade: dict) -> dict:
+    """
+    :param trade: what was sent: input, output, in_decimals, out_decimals, quote_raw (expected output)
+    :return: realised amounts, effective price, slippage against the quote and gas cost
+    """
+    decoded = decode_logs(receipt.get('logs') or [])
+    amount_in, amount_out = realised(decoded, account, trade['input'], trade['output'])
+    human_in = amount_in / 10 ** trade['in_decimals']
+    human_out = amount_out / 10 ** trade['out_decimals']
+    quote_raw = trade.get('quote_raw') or 0
+    gas_price = receipt.get('effectiveGasPrice') or receipt.get('gasPrice') or 0
+    gas_price = int(gas_price, 16) if isinstance(gas_price, str) else gas_price
+    tx_hash = receipt.get('transactionHash')
+    return {
+        'txid': _hex(tx_hash) if tx_hash is not None else None,
+        'block': receipt.get('blockNumber'),
+        'status': receipt.get('status'),
+        'network': trade.get('network'),
+        'input': to_checksum_address(trade['input']),
+        'output': to_checksum_address(trade['output']),
+        'amount_in_raw': amount_in,
+        'amount_out_raw': amount_out,
+        'amount_in': human_in,
+        'amount_out': human_out,
+        'price': human_out / human_in if human_in else None,
+        'quote_raw': quote_raw,
+        'slippage': round(1 - amount_out / quote_raw, 6) if quote_raw else None,
+        'gas_used': receipt.get('gasUsed'),
+        'gas_cost': (receipt.get('gasUsed') or 0) * gas_price / 10 ** 18,
+        'pools': [s[0] for s in decoded['v2_swaps']] + [s[0] for s in decoded['v3_swaps']],
+        'reserves_after': decoded['syncs'],
+        'time': int(time.time()),
+    }
+
+
+class TradeJournal:
+    """
+    Fill reports appended to trades.jsonl in the data directory, one JSON object per line. Appends
+    hold the file lock, lines from concurrent bots never interleave.
+    """
+    def __init__(self, path: str = 'trades.jsonl'):
+        self.path = data_path(path)
+
+    def append(self, report: dict) -> None:
+        with file_lock(self.path), open(self.path, 'a') as ff:
+            ff.write(json.dumps(report, default=str) + '\n')
+
+    def read(self) -> list:
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path) as ff:
+            return [json.loads(line) for line in ff if line.strip()]
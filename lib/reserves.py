@@ -0,0 +1,91 @@
+from eth_utils import function_signature_to_4byte_selector, to_checksum_address
+
+from lib.erc20 import encode_address
+from lib.multicall import Multicall
+
+GET_RESERVES = '0x' + function_signature_to_4byte_selector('getReserves()').hex()
+TOKEN0 = '0x' + function_signature_to_4byte_selector('token0()').hex()
+GET_PAIR = '0x' + function_signature_to_4byte_selector('getPair(address,address)').hex()
+
+ZERO_ADDRESS = '0x0000000000000000000000000000000000000000'
+
+
+class ReserveCache:
+    """
+    Uniswap v2 style pair addresses, token0 and reserves, loaded in Multicall3 batches.
+
+    Pair addresses and token0 never change and are kept for the life of the process. Reserves are
+    scoped to one block: call new_block() when a new head arrives and the next refresh() reloads
+    them, until then every lookup is served from memory. All addresses are lower case internally.
+    """
+    def __init__(self, w3, multicall: Multicall = None):
+        self.w3 = w3
+        self.multicall = multicall or Multicall(w3)
+        self.block = None
+        self._pairs = {}
+        self._token0 = {}
+        self._reserves = {}
+
+    def new_block(self, number: int) -> bool:
+        """
+        :return: True if this was a new block and cached reserves were dropped
+        """
+        if number == self.block:
+            return False
+        self.block = number
+        self._reserves.clear()
+        return True
+
+    def pairs_for(self, requests: list) -> list:
+        """
+        :param requests: list of (factory, token a, token b)
+        :return: pair address (lower case) or None per request, unknown pairs fetched in one batch
+        """
+        keys = [(f.lower(),) + tuple(sorted((a.lower(), b.lower()))) for f, a, b in requests]
+        missing = [k for k in dict.fromkeys(keys) if k not in self._pairs]
+        if missing:
+            calls = [(to_checksum_address(f), GET_PAIR + encode_address(a) + encode_address(b)) for f, a, b in missing]
+            for key, (ok, raw) in zip(missing, self.multicall.call(calls)):
+                pair = '0x' + raw[12:32].hex() if ok and len(raw) >= 32 else ZERO_ADDRESS
+                self._pairs[key] = None if pair == ZERO_ADDRESS else pair
+        return [self._pairs[k] for k in keys]
+
+    def pair_for(self, factory: str, token_a: str, token_b: str) -> (str, None):
+        return self.pairs_for([(factory, token_a, token_b)])[0]
+
+    def refresh(self, pairs: list, block_identifier='latest') -> dict:
+        """
+        Load reserves (and token0 where unknown) for every pair not already cached this block.
+        :return: {pair: (reserve0, reserve1)} for the requested pairs that exist
+        """
+        pairs = [p.lower() for p in pairs if p]
+        stale = [p for p in dict.fromkeys(pairs) if p not in self._reserves]
+        if stale:
+            calls = [(to_checksum_address(p), GET_RESERVES) for p in stale]
+            no_token0 = [p for p in stale if p not in self._token0]
+            calls += [(to_checksum_address(p), TOKEN0) for p in no_token0]
+            results = self.multicall.call(calls, block_identifier)
+            for p, (ok, raw) in zip(no_token0, results[len(stale):]):
+                if ok and len(raw) >= 32:
+                    self._token0[p] = '0x' + raw[12:32].hex()
+            for p, (ok, raw) in zip(stale, results[:len(stale)]):
+                if ok and len(raw) >= 64:
+                    self._reserves[p] = (int.from_bytes(raw[:32], 'big'), int.from_bytes(raw[32:64], 'big'))
+        return {p: self._reserves[p] for p in pairs if p in self._reserves}
+
+    def reserves(self, pair: str) -> (tuple, None):
+        return self._reserves.get(pair.lower())
+
+    def token0(self, pair: str) -> (str, None):
+        return self._token0.get(pair.lower())
+
+    def oriented(self, pair: str, token_in: str) -> (tuple, None):
+        """
+        :return: (reserve_in, reserve_out) for a swap that sells token_in into pair, None if not loaded
+        """
+        pair = pair.lower()
+        reserves = self._reserves.get(pair)
+        token0 = self._token0.get(pair)
+        if reserves is None or token0 is None:
+            return None
+        return reserves if token_in.lower() == token0 else (reserves[1], reserves[0])
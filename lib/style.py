@@ -1,25 +1,149 @@
+import atexit
+import json
+import pprint
+import queue
+import sys
+import threading
+import time
+from collections.abc import Mapping
+
 import colored
 
+LEVELS = {'debug': 10, 'normal': 20, 'good': 20, 'data': 20, 'warning': 30, 'error': 40}
+
+_PREFIX = {
+    'normal': colored.fore.LIGHT_BLUE + colored.style.BOLD + '[' + colored.fore.RED + '+'
+              + colored.fore.LIGHT_BLUE + '] ' + colored.style.RESET,
+    'error': colored.fore.RED_1 + colored.style.BOLD + '[' + colored.fore.WHITE + '!'
+             + colored.fore.RED_1 + '] ' + colored.style.RESET,
+    'good': colored.fore.LIGHT_GREEN + colored.style.BOLD + '[' + colored.fore.MAGENTA + '~'
+            + colored.fore.LIGHT_GREEN + '] ' + colored.style.RESET,
+    'warning': colored.fore.VIOLET + colored.style.BOLD + '[' + colored.fore.VIOLET
+               + '*' + colored.fore.VIOLET + '] ' + colored.style.RESET,
+    'debug': colored.fore.VIOLET + colored.style.BOLD + '[' + colored.fore.BLACK
+             + 'd' + colored.fore.VIOLET + '] ' + colored.style.RESET,
+}
+_PREFIX['data'] = _PREFIX['normal']
+
+
+def _json_default(obj):
+    if isinstance(obj, bytes):
+        return '0x' + obj.hex()
+    if isinstance(obj, Mapping):
+        return dict(obj)
+    if isinstance(obj, (set, tuple)):
+        return list(obj)
+    return str(obj)
+
+
+class OutputSink:
+    """
+    Buffered asynchronous writer behind PrettyText. Callers only put a tuple on a queue, a
+    background thread does the formatting (colour codes, json, pprint) and writes in batches, so
+    printing never blocks the hot path.
+
+    Modes:
+      human - coloured lines, like before
+      json  - one JSON object per line: {"ts", "level", "msg", "data"}, for piping into other tools
+    quiet drops everything below error.
+    """
+    def __init__(self, stream=None, mode: str = 'human', level: str = 'debug', quiet: bool = False,
+                 batch: int = 256):
+        self.stream = stream or sys.stdout
+        self.mode = mode
+        self.level = LEVELS[level]
+        self.quiet = quiet
+        self.batch = batch
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._writer, name='output-sink', daemon=True)
+        self._thread.start()
+        atexit.register(self.flush)
+
+    def configure(self, mode: str = None, level: str = None, quiet: bool = None) -> None:
+        if mode is not None:
+            if mode not in ('human', 'json'):
+                raise ValueError(f'Unknown output mode: {mode}')
+            self.mode = mode
+        if level is not None:
+            self.level = LEVELS[level]
+        if quiet is not None:
+            self.quiet = quiet
+
+    def emit(self, level: str, message, data=None) -> None:
+        rank = LEVELS[level]
+        if rank < self.level or (self.quiet and rank < LEVELS['error']):
+            return
+        self._queue.put((self.mode, time.time(), level, message, data))
+
+    def flush(self) -> None:
+        """
+        Block until everything queued so far has been written. Call before prompting for input.
+        """
+        self._queue.join()
+
+    @staticmethod
+    def _format(mode: str, ts: float, level: str, message, data) -> str:
+        if mode == 'json':
+            record = {'ts': round(ts, 3), 'level': level, 'msg': str(message) if message is not None else None}
+            if data is not None:
+                record['data'] = data
+            return json.dumps(record, default=_json_default) + '\n'
+        text = str(message) if message is not None else ''
+        if data is not None:
+            formatted = pprint.pformat(dict(data) if isinstance(data, Mapping) else data)
+            text = f'{text}\n{formatted}' if text else formatted
+        return _PREFIX[level] + text + '\n'
+
+    def _writer(self) -> None:
+        while True:
+            records = [self._queue.get()]
+            while len(records) < self.batch:
+                try:
+                    records.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.stream.write(''.join(self._format(*r) for r in records))
+                self.stream.flush()
+            except Exception:
+                pass
+            finally:
+                for _ in records:
+                    self._queue.task_done()
+
+
+sink = OutputSink()
+
+
+def configure(mode: str = None, level: str = None, quiet: bool = None) -> None:
+    """
+    Switch the process wide output mode, see OutputSink.
+    """
+    sink.configure(mode=mode, level=level, quiet=quiet)
+
 
 class PrettyText:
     def normal(self, data):
-        print(colored.fore.LIGHT_BLUE + colored.style.BOLD + '[' + colored.fore.RED + '+'
-              + colored.fore.LIGHT_BLUE + '] ' + colored.style.RESET + str(data))
+        sink.emit('normal', data)
 
     def error(self, data):
-        print(
-            colored.fore.RED_1 + colored.style.BOLD + '[' + colored.fore.WHITE + '!' \
-            + colored.fore.RED_1 + '] '+ colored.style.RESET + str(data))
+        sink.emit('error', data)
 
     def good(self, data):
-        print(
-            colored.fore.LIGHT_GREEN + colored.style.BOLD + '[' + colored.fore.MAGENTA + '~' \
-            + colored.fore.LIGHT_GREEN +  '] ' + colored.style.RESET + str(data))
+        sink.emit('good', data)
 
     def warning(self, data):
-        print(colored.fore.VIOLET + colored.style.BOLD + '[' + colored.fore.VIOLET + \
-              '*' + colored.fore.VIOLET + '] ' + colored.style.RESET + str(data))
+        sink.emit('warning', data)
 
     def debug(self, data):
-        print(colored.fore.VIOLET + colored.style.BOLD + '[' + colored.fore.BLACK + \
-              'd' + colored.fore.VIOLET + '] ' + colored.style.RESET + str(data))
+        sink.emit('debug', data)
+
+    def data(self, obj, label: str = None):
+        """
+        Structured output (receipts, quotes, transactions). pprinted in human mode,
+        a json object in json mode.
+        """
+        sink.emit('data', label, dict(obj) if isinstance(obj, Mapping) else obj)
+
+    def flush(self):
+        sink.flush()
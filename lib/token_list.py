@@ -0,0 +1,132 @@
+"""
+Import standard token lists (https://tokenlists.org format) into the local token db.
+
+Every listed token of the chain is checked on chain before it is added: decimals() and symbol() are
+read for the whole list in chunked Multicall3 batches with a bounded number of chunks in flight.
+A call to an address without code succeeds with empty return data, so a 32 byte decimals answer
+also proves there is a contract. Tokens whose decimals disagree with the list are rejected.
+
+Symbol collisions are settled the same way every run, whatever order the list is in: aliases
+already in the db are never touched, and new tokens sharing a symbol (case insensitive) are
+sorted by address, the first keeps the symbol and the others get `SYMBOL-abcdef`, the first six
+hex digits of their address (more if that is taken too).
+"""
+import json
+import os
+
+import requests
+from eth_utils import to_checksum_address
+
+from lib import style
+from lib.chain_profile import MULTICALL3
+from lib.erc20 import DECIMALS, SYMBOL, decode_string, decode_uint
+from lib.multicall import Multicall
+from lib.token_store import TokenStore
+from lib.utils import is_valid_evm_address
+
+
+def load_token_list(source: str, chain_id: int = None, timeout: float = 30.0) -> list:
+    """
+    :param source: path or http(s) url of a token list
+    :param chain_id: only keep the tokens of this chain
+    :return: the list's token entries
+    """
+    if source.startswith(('http://', 'https://')):
+        response = requests.get(source, timeout=timeout)
+        response.raise_for_status()
+        data = response.json()
+    else:
+        with open(os.path.expanduser(source)) as ff:
+            data = json.load(ff)
+    tokens = data.get('tokens', []) if isinstance(data, dict) else data
+    if chain_id is not None:
+        tokens = [t for t in tokens if t.get('chainId', chain_id) == chain_id]
+    return tokens
+
+
+class TokenListImporter:
+    """
+    Validate a token list on chain and bulk add it to a TokenStore, see the module doc.
+    """
+    def __init__(self, w3, store: TokenStore, multicall: str = None, chunk_size: int = 500, max_workers: int = 4):
+        """
+        :param chunk_size: calls per multicall, two per token
+        :param max_workers: multicall chunks in flight at once
+        """
+        self.w3 = w3
+        self.store = store
+        self.multicall = Multicall(w3, address=multicall or MULTICALL3, chunk_size=chunk_size,
+                                   max_workers=max_workers)
+        self._print = style.PrettyText()
+
+    def validate(self, tokens: list) -> (list, list):
+        """
+        :return: (valid, rejected), valid entries as {'address', 'symbol', 'decimals', 'name', 'chain_symbol'},
+        rejected ones as {'address', 'symbol', 'reason'}
+        """
+        valid, rejected, unique = [], [], {}
+        for token in tokens:
+            address = token.get('address') or ''
+            if not is_valid_evm_address(address) or not token.get('symbol'):
+                rejected.append({'address': address, 'symbol': token.get('symbol'), 'reason': 'malformed entry'})
+                continue
+            # the same token listed twice, keep the first entry
+            unique.setdefault(to_checksum_address(address), token)
+        addresses = list(unique)
+        calls = [(a, data) for a in addresses for data in (DECIMALS, SYMBOL)]
+        results = self.multicall.call(calls)
+        for i, address in enumerate(addresses):
+            token = unique[address]
+            (ok_decimals, raw_decimals), (ok_symbol, raw_symbol) = results[2 * i], results[2 * i + 1]
+            if not ok_decimals or len(raw_decimals) < 32:
+                rejected.append({'address': address, 'symbol': token['symbol'],
+                                 'reason': 'no contract' if ok_decimals else 'decimals() reverted'})
+                continue
+            decimals = decode_uint(raw_decimals)
+            if token.get('decimals') is not None and int(token['decimals']) != decimals:
+                rejected.append({'address': address, 'symbol': token['symbol'],
+                                 'reason': f'decimals {decimals} on chain, {token["decimals"]} listed'})
+                continue
+            valid.append({'address': address, 'symbol': token['symbol'].strip(), 'decimals': decimals,
+                          'name': token.get('name'),
+                          'chain_symbol': decode_string(raw_symbol) if ok_symbol else None})
+        return valid, rejected
+
+    def assign_aliases(self, valid: list) -> (dict, list):
+        """
+        :return: ({alias: address} to add, [(symbol, alias, address)] of the renamed ones)
+        """
+        taken = {alias.upper() for alias in self.store.known}
+        known_addresses = {a.lower() for a in self.store.known.values()}
+        by_symbol = {}
+        for token in valid:
+            if token['address'].lower() not in known_addresses:
+                by_symbol.setdefault(token['symbol'].upper(), []).append(token)
+        aliases, renamed = {}, []
+        for symbol in sorted(by_symbol):
+            for token in sorted(by_symbol[symbol], key=lambda t: t['address'].lower()):
+                alias = token['symbol']
+                if alias.upper() in taken:
+                    for digits in range(6, 41, 2):
+                        alias = f'{token["symbol"]}-{token["address"][2:2 + digits].lower()}'
+                        if alias.upper() not in taken:
+                            break
+                    renamed.append((token['symbol'], alias, token['address']))
+                taken.add(alias.upper())
+                aliases[alias] = token['address']
+        return aliases, renamed
+
+    def run(self, tokens: list, dry_run: bool = False) -> dict:
+        """
+        Validate, settle collisions and add everything in one write.
+        :return: counts, rejected and renamed entries
+        """
+        valid, rejected = self.validate(tokens)
+        aliases, renamed = self.assign_aliases(valid)
+        meta = {t['address']: {'symbol': t['chain_symbol'] or t['symbol'], 'decimals': t['decimals'],
+                               'name': t['name']} for t in valid}
+        if not dry_run:
+            self.store.bulk_add(aliases, meta)
+        return {'listed': len(tokens), 'valid': len(valid), 'added': len(aliases), 'renamed': renamed,
+                'rejected': rejected, 'symbol_mismatch': sum(1 for t in valid if t['chain_symbol'] and
+                                                              t['chain_symbol'].upper() != t['symbol'].upper())}
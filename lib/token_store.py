@@ -0,0 +1,51 @@
+from lib.data_store import snapshot
+
+
+class TokenStore:
+    """
+    The local token db, tokens_$network.json in the data directory (lib/data_store.py).
+
+    `known_contracts` maps symbol aliases to addresses (hand edited, see README).
+    `token_meta` holds facts learned about a token on chain, keyed by lower case address,
+    so they only have to be looked up once per token, ie {"transfer_fee": 0.05}.
+
+    The file is shared by every bot using the data directory: reads come from this process's
+    snapshot, picked up again when another process changes the file, and every change is a locked
+    read-modify-write, so concurrent adds are all kept.
+    """
+    def __init__(self, network: str):
+        self.network = network
+        self._snapshot = snapshot(f'tokens_{network}.json')
+        self.path = self._snapshot.path
+
+    @property
+    def data(self) -> dict:
+        return self._snapshot.data
+
+    @property
+    def known(self) -> dict:
+        return self.data.get('known_contracts', {})
+
+    def meta(self, address: str) -> dict:
+        """
+        :return: cached metadata for this token, empty dict if nothing is known yet
+        """
+        return self.data.get('token_meta', {}).get(address.lower(), {})
+
+    def add_known(self, symbol: str, address: str) -> None:
+        self.bulk_add({symbol: address})
+
+    def set_meta(self, address: str, **fields) -> None:
+        self.bulk_add({}, {address: fields})
+
+    def bulk_add(self, aliases: dict, meta: dict = None) -> None:
+        """
+        Add many aliases and token metadata with a single write.
+        :param aliases: {symbol: address}
+        :param meta: {address: {field: value}}
+        """
+        def change(data):
+            data.setdefault('known_contracts', {}).update(aliases)
+            for address, fields in (meta or {}).items():
+                data.setdefault('token_meta', {}).setdefault(address.lower(), {}).update(fields)
+        self._snapshot.update(change)
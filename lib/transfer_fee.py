@@ -0,0 +1,85 @@
+import time
+
+from lib import style
+from lib.erc20 import Erc20Reader, transfer_data
+from lib.preflight import Preflight, transfers_in_frame
+from lib.token_store import TokenStore
+
+ZERO_ADDRESS = '0x0000000000000000000000000000000000000000'
+
+# A token whose fee could not be determined (no debug_traceCall on the node, no pair) is probed
+# again only after this many seconds.
+RETRY_UNDETECTED = 24 * 3600
+
+
+class TransferFeeDetector:
+    """
+    Detect fee-on-transfer (taxed) tokens by simulating a small transfer out of the token's
+    uniswap v2 pair to our wallet, the same transfer a buy does, and reading back how much
+    actually arrived from the Transfer logs of a debug_traceCall. A plain eth_call only hands back
+    transfer()'s bool, so the trace is what makes the received amount visible.
+
+    If we hold some of the token the opposite direction (wallet -> pair, what a sell does) is
+    simulated too and the larger tax wins. The result is written to the token db once and reused
+    for every later swap. So is a failed attempt, as `transfer_fee_checked`, so nodes without
+    debug_traceCall do not pay for a probe on every swap.
+    """
+    def __init__(self, w3, store: TokenStore, preflight: Preflight, factory_contract, weth: str, account: str):
+        self.w3 = w3
+        self.store = store
+        self.preflight = preflight
+        self.factory = factory_contract
+        self.weth = weth
+        self.account = account
+        self.erc20 = Erc20Reader(w3)
+        self._print = style.PrettyText()
+
+    def fee(self, token: str) -> (float, None):
+        """
+        :return: the cached or freshly detected transfer tax of this token (0.05 == 5%),
+        None if it could not be determined
+        """
+        if token.lower() in (ZERO_ADDRESS, self.weth.lower()):
+            return 0.0
+        meta = self.store.meta(token)
+        if meta.get('transfer_fee') is not None:
+            return meta['transfer_fee']
+        if time.time() - meta.get('transfer_fee_checked', 0) < RETRY_UNDETECTED:
+            return None
+        fee = self.detect(token)
+        if fee is None:
+            self.store.set_meta(token, transfer_fee_checked=int(time.time()))
+            return None
+        self.store.set_meta(token, transfer_fee=fee)
+        if fee > 0:
+            self._print.warning(f'{token} charges a {fee * 100:.2f}% transfer fee.')
+        return fee
+
+    def _simulated_tax(self, token: str, sender: str, recipient: str, amount: int) -> (float, None):
+        frame = self.preflight.trace({'from': sender, 'to': token, 'data': transfer_data(recipient, amount)})
+        if frame is None:
+            return None
+        if frame.get('error'):
+            self._print.warning(f'Simulated transfer of {token} reverted: {frame.get("error")}')
+            return None
+        token_l, recipient_l = token.lower(), recipient.lower()
+        received = sum(v for t, _, dst, v in transfers_in_frame(frame) if t == token_l and dst == recipient_l)
+        return max(0.0, round(1 - received / amount, 6))
+
+    def detect(self, token: str) -> (float, None):
+        pair = self.factory.functions.getPair(token, self.weth).call()
+        if int(pair, 16) == 0:
+            self._print.warning(f'No {token}/WETH pair to probe transfer fee with.')
+            return None
+        pair_balance = self.erc20.balance_of(token, pair)
+        if pair_balance == 0:
+            return None
+        buy_tax = self._simulated_tax(token, pair, self.account, max(1, pair_balance // 1000))
+        if buy_tax is None:
+            return None
+        own_balance = self.erc20.balance_of(token, self.account)
+        if own_balance:
+            sell_tax = self._simulated_tax(token, self.account, pair, max(1, own_balance // 100))
+            if sell_tax is not None:
+                return max(buy_tax, sell_tax)
+        return buy_tax
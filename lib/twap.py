@@ -0,0 +1,380 @@
+import asyncio
+import copy
+import time
+import uuid
+
+from eth_utils import to_checksum_address, to_hex
+from web3.exceptions import ContractLogicError, TransactionNotFound
+
+from lib import style
+from lib.data_store import snapshot
+from lib.receipts import V2_SWAP, decode_logs, realised
+from lib.reserves import ReserveCache
+from lib.v2_math import get_amounts_out
+
+
+def _log_data(log) -> bytes:
+    # web3 v5 returns log data as a hex string, newer versions as bytes
+    data = log['data']
+    return bytes.fromhex(data[2:]) if isinstance(data, str) else bytes(data)
+
+
+class OrderJournal:
+    """
+    Parent orders and their child swaps in twap_orders.json in the data directory, rewritten (to a
+    temp file, then renamed over the old one) after every change so a crash never leaves half a
+    journal. Saves are merged into the file under its lock, orders other processes added are kept,
+    and a cancel written by another process (`twap --cancel`) always wins over our copy.
+    """
+    def __init__(self, path: str = 'twap_orders.json'):
+        self._snapshot = snapshot(path, indent=1)
+        self.path = self._snapshot.path
+        self.orders = copy.deepcopy(self._snapshot.data)
+
+    def active(self) -> list:
+        return [o for o in self.orders.values() if o['state'] == 'active']
+
+    def refresh(self, order: dict) -> dict:
+        """
+        Pick up a cancel made by another process since the order was loaded.
+        """
+        if self._snapshot.data.get(order['id'], {}).get('state') == 'cancelled':
+            order['state'] = 'cancelled'
+        return order
+
+    def save(self, order: dict = None) -> None:
+        """
+        :param order: only write this order, every order of this journal by default
+        """
+        mine = [order] if order is not None else list(self.orders.values())
+
+        def change(orders):
+            for item in mine:
+                if orders.get(item['id'], {}).get('state') == 'cancelled':
+                    item['state'] = 'cancelled'
+                orders[item['id']] = item
+        self._snapshot.update(change)
+
+    def cancel(self, order_id: str) -> bool:
+        """
+        Cancel straight in the file, a running scheduler stops the order before its next slice.
+        :return: False if there is no such active order
+        """
+        cancelled = []
+
+        def change(orders):
+            if orders.get(order_id, {}).get('state') == 'active':
+                orders[order_id]['state'] = 'cancelled'
+                cancelled.append(order_id)
+        self._snapshot.update(change)
+        if cancelled and order_id in self.orders:
+            self.orders[order_id]['state'] = 'cancelled'
+        return bool(cancelled)
+
+
+class TwapScheduler:
+    """
+    Split parent orders into child swaps on a time or block schedule.
+
+    Each slice is the remaining quantity over the remaining slices, so skipped slices are made up
+    later. Before a slice is sent it is re-quoted from reserves cached for the current block
+    (lib/reserves.py, v2 only, v3 asks the quoter). A slice is skipped while the quoted price is
+    below the order's limit price, and shrunk to `max_participation` of the input token volume the
+    pool traded since the previous slice. Orders run concurrently in one asyncio loop; the blocking
+    web3 calls go to threads and broadcasts are serialized because they share the account nonce.
+    An order whose child swaps fail `max_failures` times in a row is marked failed and stopped.
+
+    A child swap without a receipt yet stays pending: its amount is held back from later slices and
+    it is looked at again before each slice (and on resume) until a receipt settles it, or its nonce
+    is used by another transaction, then it failed.
+    """
+    def __init__(self, swapper, journal: OrderJournal = None, poll: float = None, max_failures: int = 3):
+        """
+        :param swapper: a connected Swapper
+        :param poll: seconds between block number polls, a quarter of the block time by default
+        :param max_failures: consecutive failed slices before the order is given up
+        """
+        self.swapper = swapper
+        self.max_failures = max_failures
+        self.w3 = swapper.w3
+        self.journal = journal or OrderJournal()
+        self._print = style.PrettyText()
+        self.reserves = ReserveCache(self.w3)
+        self.poll = poll or (swapper.chain.get('block_time') or 12.0) / 4
+        self.block = None
+        self._decimals = {}
+        self._send_lock = None
+        self._new_block = None
+
+    # ------ orders -----------------------------------------------------------------------
+
+    def submit(self, input_token: str, output_token: str, total_raw: int, slices: int, interval: int,
+               unit: str = 'seconds', limit_price: float = None, max_participation: float = None) -> str:
+        """
+        :param total_raw: raw quantity of input_token to sell
+        :param interval: seconds or blocks between slices
+        :param unit: 'seconds' or 'blocks'
+        :param limit_price: minimum output per input (human units), None for any price
+        :param max_participation: max slice as a fraction of the pool's input volume since the last slice
+        :return: order id
+        """
+        if unit not in ('seconds', 'blocks'):
+            raise ValueError(f'unit must be seconds or blocks, not {unit}')
+        if slices < 1 or total_raw <= 0:
+            raise ValueError('Need at least one slice and a positive quantity')
+        order_id = uuid.uuid4().hex[:8]
+        self.journal.orders[order_id] = {
+            'id': order_id,
+            'network': self.swapper.network,
+            'input': to_checksum_address(input_token),
+            'output': to_checksum_address(output_token),
+            'total_raw': int(total_raw),
+            'slices': int(slices),
+            'interval': interval,
+            'unit': unit,
+            'limit_price': limit_price,
+            'max_participation': max_participation,
+            'state': 'active',
+            'executed_raw': 0,
+            'received_raw': 0,
+            'next_at': None,
+            'last_block': None,
+            'children': [],
+            'failures': 0,
+            'created': int(time.time()),
+        }
+        self.journal.save(self.journal.orders[order_id])
+        return order_id
+
+    def cancel(self, order_id: str) -> bool:
+        return self.journal.cancel(order_id)
+
+    # ------ market state -----------------------------------------------------------------
+
+    def decimals(self, token: str) -> int:
+        if token not in self._decimals:
+            self._decimals[token] = self.swapper.erc20.decimals(token)
+        return self._decimals[token]
+
+    def _path(self, input_token: str, output_token: str) -> (list, list):
+        """
+        :return: (token path, pair per hop), direct if the pair exists, else through WETH
+        """
+        factory = self.swapper.uniswap.factory_contract.address
+        pair = self.reserves.pair_for(factory, input_token, output_token)
+        if pair:
+            return [input_token, output_token], [pair]
+        weth = self.swapper.uniswap.get_weth_address()
+        pairs = self.reserves.pairs_for([(factory, input_token, weth), (factory, weth, output_token)])
+        if not all(pairs):
+            raise ValueError(f'No v2 route from {input_token} to {output_token}')
+        return [input_token, weth, output_token], pairs
+
+    def quote(self, order: dict, amount_in: int) -> (int, str):
+        """
+        Expected output from the cached reserves of the current block.
+        :return: (raw amount out, first pair of the route or None for v3)
+        """
+        if self.swapper.version != 2:
+            try:
+                return self.swapper.uniswap.get_price_input(order['input'], order['output'], amount_in), None
+            except ContractLogicError:
+                return 0, None
+        path, pairs = self._path(order['input'], order['output'])
+        self.reserves.refresh(pairs)
+        hops = [self.reserves.oriented(pair, path[i]) for i, pair in enumerate(pairs)]
+        if not all(hops):
+            return 0, pairs[0]
+        return get_amounts_out(amount_in, hops)[-1], pairs[0]
+
+    def _volume(self, pair: str, token_in: str, from_block: int, to_block: int) -> int:
+        """
+        Raw amount of token_in sold into the pair between the two blocks, from its Swap events.
+        """
+        if from_block > to_block:
+            return 0
+        logs = self.w3.eth.get_logs({'address': to_checksum_address(pair), 'topics': [V2_SWAP],
+                                     'fromBlock': from_block, 'toBlock': to_block})
+        token0 = self.reserves.token0(pair)
+        side = 0 if token_in.lower() == token0 else 1
+        volume = 0
+        for log in logs:
+            data = _log_data(log)
+            volume += int.from_bytes(data[32 * side:32 * (side + 1)], 'big')
+        return volume
+
+    # ------ execution --------------------------------------------------------------------
+
+    async def _watch_blocks(self) -> None:
+        while True:
+            block = await asyncio.to_thread(lambda: self.w3.eth.block_number)
+            if block != self.block:
+                self.block = block
+                self.reserves.new_block(block)
+                async with self._new_block:
+                    self._new_block.notify_all()
+            await asyncio.sleep(self.poll)
+
+    async def _wait_turn(self, order: dict) -> None:
+        if order['next_at'] is None:
+            return
+        if order['unit'] == 'seconds':
+            await asyncio.sleep(max(0.0, order['next_at'] - time.time()))
+            return
+        async with self._new_block:
+            await self._new_block.wait_for(lambda: self.block is not None and self.block >= order['next_at'])
+
+    def _schedule_next(self, order: dict) -> None:
+        if order['unit'] == 'seconds':
+            order['next_at'] = time.time() + order['interval']
+        else:
+            order['next_at'] = self.block + order['interval']
+
+    @staticmethod
+    def _pending_raw(order: dict) -> int:
+        return sum(c['amount_in'] for c in order['children'] if c.get('status') is None)
+
+    def _slice_size(self, order: dict) -> int:
+        remaining = order['total_raw'] - order['executed_raw'] - self._pending_raw(order)
+        done = len([c for c in order['children'] if c.get('status') in (1, None)])
+        return remaining // max(1, order['slices'] - done) or remaining
+
+    def _receipt(self, txid: str):
+        try:
+            return self.w3.eth.get_transaction_receipt(txid)
+        except TransactionNotFound:
+            return None
+
+    def _nonce_of(self, txid: str):
+        try:
+            return self.w3.eth.get_transaction(txid)['nonce']
+        except TransactionNotFound:
+            return None
+
+    def _replaced(self, child: dict) -> bool:
+        """
+        True once the child's nonce was used by another transaction, it can never be mined.
+        """
+        if child.get('nonce') is None:
+            child['nonce'] = self._nonce_of(child['txid'])
+            if child['nonce'] is None:
+                return False
+        if self.w3.eth.get_transaction_count(self.swapper.account.address) <= child['nonce']:
+            return False
+        # the receipt may have appeared between the two reads
+        return self._receipt(child['txid']) is None
+
+    async def _settle(self, order: dict, child: dict, wait: bool = True) -> None:
+        """
+        :param wait: poll until the receipt shows up, else look once
+        """
+        if wait:
+            receipt = await asyncio.to_thread(self.swapper.poll_tx_for_receipt, child['txid'])
+        else:
+            receipt = await asyncio.to_thread(self._receipt, child['txid'])
+        if not receipt:
+            if not await asyncio.to_thread(self._replaced, child):
+                # still pending, not a failure, looked at again before the next slice
+                return
+            self._print.error(f'Order {order["id"]}: child {child["txid"]} was replaced.')
+            child['status'] = 0
+        else:
+            child['status'] = receipt.get('status')
+            if child['status'] == 1:
+                order['failures'] = 0
+                order['executed_raw'] += child['amount_in']
+                child['received'] = realised(decode_logs(receipt.get('logs') or []), self.swapper.account.address,
+                                             order['input'], order['output'])[1]
+                order['received_raw'] += child['received']
+        if child['status'] != 1:
+            order['failures'] = order.get('failures', 0) + 1
+        self.journal.save(order)
+
+    async def _settle_pending(self, order: dict) -> None:
+        for child in order['children']:
+            if child.get('status') is None:
+                await self._settle(order, child, wait=False)
+
+    async def _slice(self, order: dict) -> None:
+        if self.block is None:
+            self.block = await asyncio.to_thread(lambda: self.w3.eth.block_number)
+        amount = self._slice_size(order)
+        out, pair = await asyncio.to_thread(self.quote, order, amount)
+        if order['max_participation'] and pair:
+            if order['last_block'] is None:
+                # nothing to measure against yet, start the volume window here
+                order['last_block'] = self.block
+                return
+            volume = await asyncio.to_thread(self._volume, pair, order['input'], order['last_block'] + 1, self.block)
+            amount = min(amount, int(volume * order['max_participation']))
+            if amount <= 0:
+                self._print.normal(f'Order {order["id"]}: no pool volume since block {order["last_block"]}, waiting.')
+                return
+            out, pair = await asyncio.to_thread(self.quote, order, amount)
+        price = (out / 10 ** self.decimals(order['output'])) / (amount / 10 ** self.decimals(order['input']))
+        if order['limit_price'] and price < order['limit_price']:
+            self._print.normal(f'Order {order["id"]}: price {price:.8g} below limit {order["limit_price"]}, '
+                               f'skipping slice.')
+            return
+        if self.journal.refresh(order)['state'] != 'active':
+            return
+        async with self._send_lock:
+            txid = await asyncio.to_thread(self.swapper.swap, order['input'], order['output'], raw_qty=amount,
+                                           no_prompt=True)
+        if not txid or txid == 2:
+            self._print.error(f'Order {order["id"]}: child swap failed.')
+            order['failures'] = order.get('failures', 0) + 1
+            return
+        child = {'txid': to_hex(txid), 'amount_in': amount, 'quote': out, 'block': self.block,
+                 'at': int(time.time()), 'status': None}
+        child['nonce'] = await asyncio.to_thread(self._nonce_of, child['txid'])
+        order['children'].append(child)
+        order['last_block'] = self.block
+        self.journal.save(order)
+        self._print.good(f'Order {order["id"]}: sent slice of {amount}, txid {child["txid"]}')
+        await self._settle(order, child)
+
+    async def _run_order(self, order: dict) -> None:
+        # children sent before a restart, find out what happened to them first
+        await self._settle_pending(order)
+        while order['state'] == 'active' and order['executed_raw'] < order['total_raw']:
+            await self._wait_turn(order)
+            if self.journal.refresh(order)['state'] != 'active':
+                break
+            await self._settle_pending(order)
+            if order['executed_raw'] >= order['total_raw']:
+                break
+            if order['executed_raw'] + self._pending_raw(order) >= order['total_raw']:
+                # the rest is in flight, wait for it instead of selling more
+                await asyncio.sleep(self.poll)
+                continue
+            try:
+                await self._slice(order)
+            except Exception as err:
+                self._print.error(f'Order {order["id"]}: {err}')
+                order['failures'] = order.get('failures', 0) + 1
+            if order.get('failures', 0) >= self.max_failures:
+                self._print.error(f'Order {order["id"]}: {order["failures"]} failed slices in a row, giving up.')
+                order['state'] = 'failed'
+            self._schedule_next(order)
+            self.journal.save(order)
+        if order['state'] == 'active':
+            order['state'] = 'done'
+            self.journal.save(order)
+        self._print.data({k: order[k] for k in ('id', 'state', 'executed_raw', 'received_raw')}, 'Order:')
+
+    async def run(self) -> None:
+        """
+        Run every active order of this network in the journal until each is filled or cancelled.
+        """
+        self._send_lock = asyncio.Lock()
+        self._new_block = asyncio.Condition()
+        orders = [o for o in self.journal.active() if o.get('network') == self.swapper.network]
+        if not orders:
+            self._print.warning('No active orders.')
+            return
+        watcher = asyncio.create_task(self._watch_blocks())
+        try:
+            await asyncio.gather(*(self._run_order(o) for o in orders))
+        finally:
+            watcher.cancel()
@@ -0,0 +1,108 @@
+from hexbytes import HexBytes
+from uniswap import Uniswap
+from uniswap.util import _load_contract_erc20
+
+from lib.bundles import BundleSubmitter
+from lib.preflight import Preflight
+from lib.pyswap_exceptions import BundleError
+
+# Router functions that execute a swap. Anything else (approve, liquidity) is sent untouched.
+SWAP_FUNCTION_PREFIXES = ('swap', 'exact', 'multicall')
+
+# Gas used for the simulation itself, the real limit comes from eth_estimateGas.
+SIMULATION_GAS = 3_000_000
+
+# Gas limits of transactions that cannot be estimated because they depend on an approval queued
+# in the same bundle. Only the gas used is paid.
+BUNDLE_APPROVE_GAS = 100_000
+BUNDLE_SWAP_GAS = 600_000
+
+
+class PreflightUniswap(Uniswap):
+    """
+    uniswap-python's Uniswap with a pre-broadcast simulation stage. Before a swap transaction is
+    signed it is simulated with eth_call at `pending`, concurrently with its gas estimate, and
+    dropped if the simulated output is more than the allowed slippage below the quote the user saw.
+    Call expect() right before make_trade() to arm the check for the next swap.
+
+    With a `bundler` every transaction goes to a private relay instead of the public mempool, and
+    approvals are not sent on their own: they are signed and queued, then go out in one bundle in
+    front of the swap that needs them, see lib/bundles.py.
+    """
+    def __init__(self, *args, preflight: Preflight = None, bundler: BundleSubmitter = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.preflight = preflight
+        self.bundler = bundler
+        self.expectation = None
+        self._queued = []
+        self._queued_tokens = set()
+
+    def _is_approved(self, token) -> bool:
+        if token in self._queued_tokens:
+            return True
+        return super()._is_approved(token)
+
+    def approve(self, token, max_approval: int = None) -> None:
+        if self.bundler is None:
+            return super().approve(token, max_approval)
+        function = _load_contract_erc20(self.w3, token).functions.approve(
+            self.router_address, max_approval or self.max_approval_int)
+        tx_params = self._get_tx_params()
+        transaction = function.build_transaction(dict(tx_params, gas=BUNDLE_APPROVE_GAS))
+        signed_txn = self.w3.eth.account.sign_transaction(transaction, private_key=self.private_key)
+        self._queued.append(signed_txn.rawTransaction)
+        self._queued_tokens.add(token)
+        self.last_nonce = tx_params['nonce'] + 1
+
+    def _send(self, raw_transaction) -> HexBytes:
+        if self.bundler is None:
+            return self.w3.eth.send_raw_transaction(raw_transaction)
+        bundle = self._queued + [raw_transaction]
+        self._queued, self._queued_tokens = [], set()
+        result = self.bundler.submit(bundle)
+        if result['included'] is None:
+            raise BundleError(f'Bundle {result["bundle_hash"]} not included: {result["reason"]}')
+        return HexBytes(result['tx_hashes'][-1])
+
+    def expect(self, amount_out: int, output_token: str, recipient: str = None) -> None:
+        """
+        :param amount_out: quoted raw output amount
+        :param output_token: token being bought
+        :param recipient: who receives the output, defaults to our address
+        """
+        self.expectation = (int(amount_out), output_token, recipient or self.address)
+
+    def _build_and_send_tx(self, function, tx_params=None):
+        check = self.preflight is not None and self.expectation is not None \
+            and function.fn_name.startswith(SWAP_FUNCTION_PREFIXES)
+        if not check and self.bundler is None:
+            return super()._build_and_send_tx(function, tx_params)
+        expectation, self.expectation = self.expectation, None
+
+        if not tx_params:
+            tx_params = self._get_tx_params()
+        if self._queued:
+            # needs the approvals queued ahead of it, neither a simulation nor an estimate of it alone
+            # would succeed, the relay runs the bundle as a whole
+            transaction = function.build_transaction(dict(tx_params, gas=tx_params.get('gas', BUNDLE_SWAP_GAS)))
+        elif check:
+            amount_out, output_token, recipient = expectation
+            # give build_transaction a gas value so it does not run its own estimate, ours runs alongside
+            # the simulation below
+            transaction = function.build_transaction(dict(tx_params, gas=SIMULATION_GAS))
+            output_types = [o['type'] for o in function.abi.get('outputs', [])]
+            gas_limit, _ = self.preflight.check(transaction, amount_out, output_types=output_types,
+                                                output_token=output_token, recipient=recipient)
+            if 'gas' not in tx_params:
+                transaction['gas'] = gas_limit
+        else:
+            transaction = function.build_transaction(tx_params)
+
+        signed_txn = self.w3.eth.account.sign_transaction(transaction, private_key=self.private_key)
+        self.last_nonce = tx_params['nonce'] + 1
+        try:
+            return self._send(signed_txn.rawTransaction)
+        except BundleError:
+            # none of the bundle's nonces were used, start over from the chain's count
+            self.last_nonce = 0
+            raise
@@ -4,6 +4,8 @@ import json
 from eth_typing import ChecksumAddress
 from eth_utils import to_checksum_address
 
+from lib.data_store import snapshot
+
 
 def json_file_load(file) -> any:
     """
@@ -21,3 +23,23 @@ def is_valid_evm_address(address_or_str: (ChecksumAddress, str)):
     except (ValueError, binascii.Error):
         return False
     return True
+
+
+def dex_contracts(network: str = None, path: str = 'dex_contracts.json') -> list:
+    """
+    Flatten dex_contracts.json (data directory) into one dict per deployment:
+    {'dex': 'sushiswap', 'version': 2, 'factory': ..., 'router': ..., 'networks': [...]}
+    :param network: only return deployments on this chain
+    :return: list
+    """
+    deployments = []
+    for dex in snapshot(path).data.get('dex_map'):
+        for name, v in dex.items():
+            for versions in v.get('versions'):
+                for version, entries in versions.items():
+                    for entry in entries:
+                        if network and network not in entry.get('networks', []):
+                            continue
+                        deployments.append({'dex': name, 'version': int(version), 'factory': entry.get('factory'),
+                                            'router': entry.get('router'), 'networks': entry.get('networks', [])})
+    return deployments
@@ -0,0 +1,45 @@
+"""
+Uniswap v2 constant product math, integer exact like UniswapV2Library.
+fee_bps is the pool fee in basis points (30 for uniswap and sushiswap).
+"""
+
+
+def get_amount_out(amount_in: int, reserve_in: int, reserve_out: int, fee_bps: int = 30) -> int:
+    if amount_in <= 0 or reserve_in <= 0 or reserve_out <= 0:
+        return 0
+    amount_in_with_fee = amount_in * (10000 - fee_bps)
+    return amount_in_with_fee * reserve_out // (reserve_in * 10000 + amount_in_with_fee)
+
+
+def get_amount_in(amount_out: int, reserve_in: int, reserve_out: int, fee_bps: int = 30) -> int:
+    if amount_out <= 0 or reserve_in <= 0 or amount_out >= reserve_out:
+        return 0
+    return reserve_in * amount_out * 10000 // ((reserve_out - amount_out) * (10000 - fee_bps)) + 1
+
+
+def get_amounts_out(amount_in: int, reserves: list, fee_bps: int = 30) -> list:
+    """
+    :param reserves: [(reserve_in, reserve_out), ...] for each hop of the path
+    :return: amounts like router.getAmountsOut, first element is amount_in
+    """
+    amounts = [amount_in]
+    for reserve_in, reserve_out in reserves:
+        amounts.append(get_amount_out(amounts[-1], reserve_in, reserve_out, fee_bps))
+    return amounts
+
+
+def price_impact(amount_in: int, reserves: list, fee_bps: int = 30) -> float:
+    """
+    How much worse the execution price is than the mid price along the path, fee excluded.
+    :return: 0.0 - 1.0
+    """
+    if amount_in <= 0:
+        return 0.0
+    mid = 1.0
+    for reserve_in, reserve_out in reserves:
+        if reserve_in <= 0:
+            return 1.0
+        mid *= reserve_out / reserve_in
+    out = get_amounts_out(amount_in, reserves, fee_bps)[-1]
+    fee_factor = ((10000 - fee_bps) / 10000) ** len(reserves)
+    return max(0.0, 1 - out / (amount_in * mid * fee_factor))
@@ -0,0 +1,216 @@
+"""
+Uniswap v3 fixed point math (TickMath, SqrtPriceMath, SwapMath, FullMath, TickBitmap), ported to
+Python integers so local swap simulations round exactly like the contracts. Names and argument
+order follow the Solidity libraries.
+"""
+import math
+
+Q96 = 1 << 96
+MAX_UINT160 = (1 << 160) - 1
+MAX_UINT256 = (1 << 256) - 1
+MIN_TICK = -887272
+MAX_TICK = 887272
+MIN_SQRT_RATIO = 4295128739
+MAX_SQRT_RATIO = 1461446703485210103287273052203988822378723970342
+
+_TICK_FACTORS = [
+    (0x2, 0xfff97272373d413259a46990580e213a),
+    (0x4, 0xfff2e50f5f656932ef12357cf3c7fdcc),
+    (0x8, 0xffe5caca7e10e4e61c3624eaa0941cd0),
+    (0x10, 0xffcb9843d60f6159c9db58835c926644),
+    (0x20, 0xff973b41fa98c081472e6896dfb254c0),
+    (0x40, 0xff2ea16466c96a3843ec78b326b52861),
+    (0x80, 0xfe5dee046a99a2a811c461f1969c3053),
+    (0x100, 0xfcbe86c7900a88aedcffc83b479aa3a4),
+    (0x200, 0xf987a7253ac413176f2b074cf7815e54),
+    (0x400, 0xf3392b0822b70005940c7a398e4b70f3),
+    (0x800, 0xe7159475a2c29b7443b29c7fa6e889d9),
+    (0x1000, 0xd097f3bdfd2022b8845ad8f792aa5825),
+    (0x2000, 0xa9f746462d870fdf8a65dc1f90e061e5),
+    (0x4000, 0x70d869a156d2a1b890bb3df62baf32f7),
+    (0x8000, 0x31be135f97d08fd981231505542fcfa6),
+    (0x10000, 0x9aa508b5b7a84e1c677de54f3e99bc9),
+    (0x20000, 0x5d6af8dedb81196699c329225ee604),
+    (0x40000, 0x2216e584f5fa1ea926041bedfe98),
+    (0x80000, 0x48a170391f7dc42444e8fa2),
+]
+
+
+# ------ FullMath ---------------------------------------------------------------------------
+
+def mul_div(a: int, b: int, denominator: int) -> int:
+    return a * b // denominator
+
+
+def mul_div_rounding_up(a: int, b: int, denominator: int) -> int:
+    return -(-a * b // denominator)
+
+
+def div_rounding_up(a: int, b: int) -> int:
+    return -(-a // b)
+
+
+# ------ TickMath ---------------------------------------------------------------------------
+
+def get_sqrt_ratio_at_tick(tick: int) -> int:
+    abs_tick = abs(tick)
+    if abs_tick > MAX_TICK:
+        raise ValueError(f'tick {tick} out of range')
+    ratio = 0xfffcb933bd6fad37aa2d162d1a594001 if abs_tick & 0x1 else 0x100000000000000000000000000000000
+    for bit, factor in _TICK_FACTORS:
+        if abs_tick & bit:
+            ratio = (ratio * factor) >> 128
+    if tick > 0:
+        ratio = MAX_UINT256 // ratio
+    return (ratio >> 32) + (0 if ratio % (1 << 32) == 0 else 1)
+
+
+def get_tick_at_sqrt_ratio(sqrt_price_x96: int) -> int:
+    """
+    Greatest tick whose sqrt ratio is <= sqrt_price_x96, same result as the Solidity log2 version.
+    """
+    if not MIN_SQRT_RATIO <= sqrt_price_x96 < MAX_SQRT_RATIO:
+        raise ValueError('sqrt price out of range')
+    tick = math.floor(math.log((sqrt_price_x96 / Q96) ** 2, 1.0001))
+    tick = max(MIN_TICK, min(MAX_TICK, tick))
+    # the float estimate is off by at most a tick or two, walk it to the exact answer
+    while tick > MIN_TICK and get_sqrt_ratio_at_tick(tick) > sqrt_price_x96:
+        tick -= 1
+    while tick < MAX_TICK and get_sqrt_ratio_at_tick(tick + 1) <= sqrt_price_x96:
+        tick += 1
+    return tick
+
+
+# ------ SqrtPriceMath ----------------------------------------------------------------------
+
+def get_next_sqrt_price_from_amount0_rounding_up(sqrt_p: int, liquidity: int, amount: int, add: bool) -> int:
+    if amount == 0:
+        return sqrt_p
+    numerator1 = liquidity << 96
+    product = amount * sqrt_p
+    if add:
+        # the contract takes this branch unless amount * sqrt_p or the sum overflows 256 bits
+        if product <= MAX_UINT256 and numerator1 + product <= MAX_UINT256:
+            return mul_div_rounding_up(numerator1, sqrt_p, numerator1 + product)
+        return div_rounding_up(numerator1, numerator1 // sqrt_p + amount)
+    if product > MAX_UINT256 or numerator1 <= product:
+        raise ValueError('not enough liquidity for the output')
+    return mul_div_rounding_up(numerator1, sqrt_p, numerator1 - product)
+
+
+def get_next_sqrt_price_from_amount1_rounding_down(sqrt_p: int, liquidity: int, amount: int, add: bool) -> int:
+    if add:
+        quotient = (amount << 96) // liquidity
+        result = sqrt_p + quotient
+        if result > MAX_UINT160:
+            raise ValueError('sqrt price overflow')
+        return result
+    quotient = div_rounding_up(amount << 96, liquidity)
+    if sqrt_p <= quotient:
+        raise ValueError('not enough liquidity for the output')
+    return sqrt_p - quotient
+
+
+def get_next_sqrt_price_from_input(sqrt_p: int, liquidity: int, amount_in: int, zero_for_one: bool) -> int:
+    if zero_for_one:
+        return get_next_sqrt_price_from_amount0_rounding_up(sqrt_p, liquidity, amount_in, True)
+    return get_next_sqrt_price_from_amount1_rounding_down(sqrt_p, liquidity, amount_in, True)
+
+
+def get_next_sqrt_price_from_output(sqrt_p: int, liquidity: int, amount_out: int, zero_for_one: bool) -> int:
+    if zero_for_one:
+        return get_next_sqrt_price_from_amount1_rounding_down(sqrt_p, liquidity, amount_out, False)
+    return get_next_sqrt_price_from_amount0_rounding_up(sqrt_p, liquidity, amount_out, False)
+
+
+def get_amount0_delta(sqrt_a: int, sqrt_b: int, liquidity: int, round_up: bool) -> int:
+    if sqrt_a > sqrt_b:
+        sqrt_a, sqrt_b = sqrt_b, sqrt_a
+    numerator1 = liquidity << 96
+    numerator2 = sqrt_b - sqrt_a
+    if round_up:
+        return div_rounding_up(mul_div_rounding_up(numerator1, numerator2, sqrt_b), sqrt_a)
+    return mul_div(numerator1, numerator2, sqrt_b) // sqrt_a
+
+
+def get_amount1_delta(sqrt_a: int, sqrt_b: int, liquidity: int, round_up: bool) -> int:
+    if sqrt_a > sqrt_b:
+        sqrt_a, sqrt_b = sqrt_b, sqrt_a
+    if round_up:
+        return mul_div_rounding_up(liquidity, sqrt_b - sqrt_a, Q96)
+    return mul_div(liquidity, sqrt_b - sqrt_a, Q96)
+
+
+# ------ SwapMath ---------------------------------------------------------------------------
+
+def compute_swap_step(sqrt_current: int, sqrt_target: int, liquidity: int, amount_remaining: int,
+                      fee_pips: int) -> tuple:
+    """
+    :param amount_remaining: positive for exact input, negative for exact output
+    :return: (next sqrt price, amount in, amount out, fee amount)
+    """
+    zero_for_one = sqrt_current >= sqrt_target
+    exact_in = amount_remaining >= 0
+    amount_in = amount_out = 0
+    if exact_in:
+        remaining_less_fee = mul_div(amount_remaining, 10 ** 6 - fee_pips, 10 ** 6)
+        amount_in = get_amount0_delta(sqrt_target, sqrt_current, liquidity, True) if zero_for_one \
+            else get_amount1_delta(sqrt_current, sqrt_target, liquidity, True)
+        if remaining_less_fee >= amount_in:
+            sqrt_next = sqrt_target
+        else:
+            sqrt_next = get_next_sqrt_price_from_input(sqrt_current, liquidity, remaining_less_fee, zero_for_one)
+    else:
+        amount_out = get_amount1_delta(sqrt_target, sqrt_current, liquidity, False) if zero_for_one \
+            else get_amount0_delta(sqrt_current, sqrt_target, liquidity, False)
+        if -amount_remaining >= amount_out:
+            sqrt_next = sqrt_target
+        else:
+            sqrt_next = get_next_sqrt_price_from_output(sqrt_current, liquidity, -amount_remaining, zero_for_one)
+    reached = sqrt_target == sqrt_next
+    if zero_for_one:
+        if not (reached and exact_in):
+            amount_in = get_amount0_delta(sqrt_next, sqrt_current, liquidity, True)
+        if not (reached and not exact_in):
+            amount_out = get_amount1_delta(sqrt_next, sqrt_current, liquidity, False)
+    else:
+        if not (reached and exact_in):
+            amount_in = get_amount1_delta(sqrt_current, sqrt_next, liquidity, True)
+        if not (reached and not exact_in):
+            amount_out = get_amount0_delta(sqrt_current, sqrt_next, liquidity, False)
+    if not exact_in and amount_out > -amount_remaining:
+        amount_out = -amount_remaining
+    if exact_in and sqrt_next != sqrt_target:
+        fee_amount = amount_remaining - amount_in
+    else:
+        fee_amount = mul_div_rounding_up(amount_in, fee_pips, 10 ** 6 - fee_pips)
+    return sqrt_next, amount_in, amount_out, fee_amount
+
+
+# ------ TickBitmap -------------------------------------------------------------------------
+
+def position(compressed: int) -> (int, int):
+    """
+    :return: (word position, bit position) of a compressed tick
+    """
+    return compressed >> 8, compressed & 0xff
+
+
+def next_initialized_tick_within_one_word(words: dict, tick: int, tick_spacing: int, lte: bool) -> (int, bool):
+    """
+    :param words: {word position: bitmap word}, a missing word raises KeyError
+    :return: (next tick, whether it is initialized)
+    """
+    compressed = tick // tick_spacing
+    if lte:
+        word_pos, bit_pos = position(compressed)
+        masked = words[word_pos] & ((1 << bit_pos) - 1 + (1 << bit_pos))
+        if masked:
+            return (compressed - (bit_pos - (masked.bit_length() - 1))) * tick_spacing, True
+        return (compressed - bit_pos) * tick_spacing, False
+    word_pos, bit_pos = position(compressed + 1)
+    masked = words[word_pos] & (MAX_UINT256 ^ ((1 << bit_pos) - 1))
+    if masked:
+        lsb = (masked & -masked).bit_length() - 1
+        return (compressed + 1 + (lsb - bit_pos)) * tick_spacing, True
+    return (compressed + 1 + (255 - bit_pos)) * tick_spacing, False
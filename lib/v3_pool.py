@@ -0,0 +1,272 @@
+from eth_utils import function_signature_to_4byte_selector, to_checksum_address
+
+from lib.erc20 import encode_address, encode_uint
+from lib.multicall import Multicall
+from lib.pyswap_exceptions import TickWindowExceeded
+from lib.v3_math import (MAX_SQRT_RATIO, MAX_TICK, MAX_UINT256, MIN_SQRT_RATIO, MIN_TICK, compute_swap_step,
+                         get_sqrt_ratio_at_tick, get_tick_at_sqrt_ratio, next_initialized_tick_within_one_word,
+                         position)
+
+
+def _selector(signature: str) -> str:
+    return '0x' + function_signature_to_4byte_selector(signature).hex()
+
+
+SLOT0 = _selector('slot0()')
+LIQUIDITY = _selector('liquidity()')
+TICK_SPACING = _selector('tickSpacing()')
+TOKEN0 = _selector('token0()')
+TICK_BITMAP = _selector('tickBitmap(int16)')
+TICKS = _selector('ticks(int24)')
+GET_POOL = _selector('getPool(address,address,uint24)')
+
+FEE_TIERS = (100, 500, 3000, 10000)
+ZERO_ADDRESS = '0x0000000000000000000000000000000000000000'
+
+
+def _word(raw: bytes, index: int, signed: bool = False) -> int:
+    value = int.from_bytes(raw[32 * index:32 * (index + 1)], 'big')
+    return value - (1 << 256) if signed and value >= 1 << 255 else value
+
+
+def _encode_int(value: int) -> str:
+    return encode_uint(value & MAX_UINT256)
+
+
+class V3Pool:
+    """
+    Snapshot of one v3 pool (price, active liquidity, a window of the tick bitmap and the net
+    liquidity of its initialized ticks) and an exact replica of UniswapV3Pool.swap() over it.
+    """
+    def __init__(self, address: str, token0: str, token1: str, fee: int, tick_spacing: int):
+        self.address = address.lower()
+        self.token0 = token0.lower()
+        self.token1 = token1.lower()
+        self.fee = fee
+        self.tick_spacing = tick_spacing
+        self.block = None
+        self.sqrt_price = 0
+        self.tick = 0
+        self.liquidity = 0
+        self.words = {}
+        self.liquidity_net = {}
+
+    def __repr__(self):
+        return f'V3Pool({self.address}, fee={self.fee}, block={self.block})'
+
+    def swap(self, zero_for_one: bool, amount_specified: int, sqrt_price_limit: int = None) -> tuple:
+        """
+        :param amount_specified: positive exact input, negative exact output
+        :param sqrt_price_limit: like the contract, defaults to the widest limit like the Quoter
+        :return: (amount0, amount1, sqrt price after, tick after), pool side signs (positive = paid in)
+        """
+        if sqrt_price_limit is None:
+            sqrt_price_limit = MIN_SQRT_RATIO + 1 if zero_for_one else MAX_SQRT_RATIO - 1
+        if zero_for_one and not MIN_SQRT_RATIO < sqrt_price_limit < self.sqrt_price or \
+                not zero_for_one and not self.sqrt_price < sqrt_price_limit < MAX_SQRT_RATIO:
+            raise ValueError('SPL')
+        exact_input = amount_specified > 0
+        remaining, calculated = amount_specified, 0
+        sqrt_price, tick, liquidity = self.sqrt_price, self.tick, self.liquidity
+        while remaining != 0 and sqrt_price != sqrt_price_limit:
+            start = sqrt_price
+            try:
+                tick_next, initialized = next_initialized_tick_within_one_word(self.words, tick, self.tick_spacing,
+                                                                               zero_for_one)
+            except KeyError as err:
+                raise TickWindowExceeded(err.args[0])
+            tick_next = max(MIN_TICK, min(MAX_TICK, tick_next))
+            sqrt_next = get_sqrt_ratio_at_tick(tick_next)
+            target = sqrt_price_limit if (sqrt_next < sqrt_price_limit if zero_for_one
+                                          else sqrt_next > sqrt_price_limit) else sqrt_next
+            sqrt_price, amount_in, amount_out, fee_amount = compute_swap_step(sqrt_price, target, liquidity,
+                                                                              remaining, self.fee)
+            if exact_input:
+                remaining -= amount_in + fee_amount
+                calculated -= amount_out
+            else:
+                remaining += amount_out
+                calculated += amount_in + fee_amount
+            if sqrt_price == sqrt_next:
+                if initialized:
+                    net = self.liquidity_net.get(tick_next, 0)
+                    liquidity += -net if zero_for_one else net
+                tick = tick_next - 1 if zero_for_one else tick_next
+            elif sqrt_price != start:
+                tick = get_tick_at_sqrt_ratio(sqrt_price)
+        if zero_for_one == exact_input:
+            return amount_specified - remaining, calculated, sqrt_price, tick
+        return calculated, amount_specified - remaining, sqrt_price, tick
+
+    def quote_exact_input(self, token_in: str, amount_in: int) -> int:
+        zero_for_one = token_in.lower() == self.token0
+        amount0, amount1, _, _ = self.swap(zero_for_one, amount_in)
+        return -(amount1 if zero_for_one else amount0)
+
+    def quote_exact_output(self, token_in: str, amount_out: int) -> int:
+        zero_for_one = token_in.lower() == self.token0
+        amount0, amount1, _, _ = self.swap(zero_for_one, -amount_out)
+        received = -(amount1 if zero_for_one else amount0)
+        if received != amount_out:
+            # QuoterV2 reverts the same way when the pool can not fill the whole output
+            raise ValueError(f'pool can only fill {received} of {amount_out}')
+        return amount0 if zero_for_one else amount1
+
+
+class V3PoolCache:
+    """
+    V3 pools loaded in Multicall3 batches and simulated locally, see V3Pool.
+
+    Pool addresses, tokens and tick spacing are loaded once. The price, liquidity, tick bitmap
+    window and ticks are loaded in three batches (all requested pools together) the first time a
+    pool is used in a block; call new_block() on each head. The bitmap window is `words_each_side`
+    words either side of the current price (256 tick spacings per word) and grows on demand when
+    a large swap walks out of it.
+    """
+    def __init__(self, w3, factory: str, multicall: Multicall = None, words_each_side: int = 2,
+                 max_extensions: int = 16):
+        self.w3 = w3
+        self.factory = to_checksum_address(factory)
+        self.multicall = multicall or Multicall(w3)
+        self.words_each_side = words_each_side
+        self.max_extensions = max_extensions
+        self.block = None
+        self._pools = {}
+
+    def new_block(self, number: int) -> bool:
+        if number == self.block:
+            return False
+        self.block = number
+        return True
+
+    def pools_for(self, token_a: str, token_b: str, fees: tuple = FEE_TIERS) -> list:
+        """
+        :return: the existing pools of this pair among the fee tiers, static data loaded once
+        """
+        token0, token1 = sorted((token_a.lower(), token_b.lower()))
+        missing = [f for f in fees if (token0, token1, f) not in self._pools]
+        if missing:
+            calls = [(self.factory, GET_POOL + encode_address(token0) + encode_address(token1) + encode_uint(f))
+                     for f in missing]
+            found = []
+            for fee, (ok, raw) in zip(missing, self.multicall.call(calls)):
+                address = '0x' + raw[12:32].hex() if ok and len(raw) >= 32 else ZERO_ADDRESS
+                if address == ZERO_ADDRESS:
+                    self._pools[(token0, token1, fee)] = None
+                else:
+                    found.append((fee, address))
+            spacing = self.multicall.call([(to_checksum_address(a), TICK_SPACING) for _, a in found])
+            for (fee, address), (ok, raw) in zip(found, spacing):
+                self._pools[(token0, token1, fee)] = V3Pool(address, token0, token1, fee, _word(raw, 0, True)) \
+                    if ok else None
+        return [self._pools[(token0, token1, f)] for f in fees if self._pools.get((token0, token1, f))]
+
+    def _load_words(self, pools_words: list) -> None:
+        """
+        :param pools_words: [(pool, [word positions])], loads the words and the ticks they initialize
+        """
+        calls, index = [], []
+        for pool, positions in pools_words:
+            for pos in positions:
+                calls.append((to_checksum_address(pool.address), TICK_BITMAP + _encode_int(pos)))
+                index.append((pool, pos))
+        tick_calls, tick_index = [], []
+        for (pool, pos), (ok, raw) in zip(index, self.multicall.call(calls, self.block or 'latest')):
+            word = _word(raw, 0) if ok else 0
+            pool.words[pos] = word
+            while word:
+                bit = (word & -word).bit_length() - 1
+                word &= word - 1
+                tick = (pos * 256 + bit) * pool.tick_spacing
+                tick_calls.append((to_checksum_address(pool.address), TICKS + _encode_int(tick)))
+                tick_index.append((pool, tick))
+        if tick_calls:
+            for (pool, tick), (ok, raw) in zip(tick_index, self.multicall.call(tick_calls, self.block or 'latest')):
+                if ok:
+                    pool.liquidity_net[tick] = _word(raw, 1, signed=True)
+
+    def load(self, pools: list) -> None:
+        """
+        Refresh every pool not yet loaded at the current block.
+        """
+        stale = [p for p in pools if p.block is None or p.block != self.block]
+        if not stale:
+            return
+        block = self.block or 'latest'
+        calls = []
+        for pool in stale:
+            calls += [(to_checksum_address(pool.address), SLOT0), (to_checksum_address(pool.address), LIQUIDITY)]
+        results = self.multicall.call(calls, block)
+        for i, pool in enumerate(stale):
+            (ok_slot0, slot0), (ok_liq, liq) = results[2 * i], results[2 * i + 1]
+            if not (ok_slot0 and ok_liq):
+                raise ValueError(f'Could not load pool {pool.address}')
+            pool.sqrt_price, pool.tick, pool.liquidity = _word(slot0, 0), _word(slot0, 1, True), _word(liq, 0)
+            pool.words, pool.liquidity_net = {}, {}
+            pool.block = self.block
+        windows = []
+        for pool in stale:
+            center, _ = position(pool.tick // pool.tick_spacing)
+            windows.append((pool, range(center - self.words_each_side, center + self.words_each_side + 1)))
+        self._load_words(windows)
+
+    def simulate(self, pool: V3Pool, fn, *args):
+        """
+        Run a pool method, loading more bitmap words if the swap walks out of the window.
+        """
+        self.load([pool])
+        for _ in range(self.max_extensions):
+            try:
+                return fn(*args)
+            except TickWindowExceeded as err:
+                positions = [p for p in range(err.word_pos - self.words_each_side,
+                                              err.word_pos + self.words_each_side + 1) if p not in pool.words]
+                self._load_words([(pool, positions)])
+        raise ValueError(f'Swap crosses more than {self.max_extensions} extensions of the tick window')
+
+    def pool(self, token_a: str, token_b: str, fee: int) -> V3Pool:
+        pools = self.pools_for(token_a, token_b, (fee,))
+        if not pools:
+            raise ValueError(f'No v3 pool for {token_a}/{token_b} at fee {fee}')
+        return pools[0]
+
+    def quote_exact_input(self, token_in: str, token_out: str, amount_in: int, fee: int = 3000) -> int:
+        pool = self.pool(token_in, token_out, fee)
+        return self.simulate(pool, pool.quote_exact_input, token_in, amount_in)
+
+    def quote_exact_output(self, token_in: str, token_out: str, amount_out: int, fee: int = 3000) -> int:
+        pool = self.pool(token_in, token_out, fee)
+        return self.simulate(pool, pool.quote_exact_output, token_in, amount_out)
+
+    def best_exact_input(self, token_in: str, token_out: str, amount_in: int, fees: tuple = FEE_TIERS) -> (int, int):
+        """
+        :return: (amount out, fee tier) of the best pool, (0, None) if none can fill it
+        """
+        pools = self.pools_for(token_in, token_out, fees)
+        self.load(pools)
+        best = (0, None)
+        for pool in pools:
+            try:
+                out = self.simulate(pool, pool.quote_exact_input, token_in, amount_in)
+            except ValueError:
+                continue
+            if out > best[0]:
+                best = (out, pool.fee)
+        return best
+
+    def quote_path_exact_input(self, path: list, fees: list, amount_in: int) -> int:
+        """
+        Multi hop exact input, ie path [A, B, C] with fees [500, 3000].
+        """
+        amount = amount_in
+        for i, fee in enumerate(fees):
+            amount = self.quote_exact_input(path[i], path[i + 1], amount, fee)
+        return amount
+
+    def depth(self, token_in: str, token_out: str, sizes: list, fees: tuple = FEE_TIERS) -> list:
+        """
+        Best output per input size across fee tiers, for depth curves.
+        :return: [{'amount_in', 'amount_out', 'fee'}, ...]
+        """
+        return [dict(zip(('amount_out', 'fee'), self.best_exact_input(token_in, token_out, size, fees)),
+                     amount_in=size) for size in sizes]
@@ -0,0 +1,323 @@
+"""
+Run the same operation (approve, sweep, swap) across many hot wallets at once.
+
+Wallets are loaded from a directory: plain `{"wallet": {"address": ..., "private_key": ...}}` files
+like keys/example_wallet.json, and encrypted V3 keystores, which are decrypted in a process pool
+(scrypt is deliberately slow). Transactions are built per wallet with consecutive local nonces,
+one fee read and concurrent gas estimates, signed in a process pool, and broadcast wallet by
+wallet in parallel, each wallet's transactions in nonce order.
+"""
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from eth_account import Account
+from eth_utils import to_checksum_address, to_hex
+
+from lib import style
+from lib.approvals import MAX_UINT256, fee_params
+from lib.erc20 import allowance_data, approve_data, balance_of_data, decode_uint, transfer_data
+from lib.multicall import Multicall
+from lib.receipts import NATIVE_ADDRESSES
+
+# Below this many transactions signing in this process beats starting the pool.
+MIN_POOL_BATCH = 16
+NATIVE_TRANSFER_GAS = 21000
+
+
+def _decrypt(job: tuple) -> str:
+    keystore, password = job
+    return Account.decrypt(keystore, password).hex()
+
+
+def _sign(job: tuple) -> tuple:
+    tx, key = job
+    signed = Account.sign_transaction(tx, key)
+    return bytes(signed.rawTransaction), to_hex(signed.hash)
+
+
+def load_wallet_dir(path: str = 'keys', password: str = None, max_workers: int = None) -> list:
+    """
+    :param password: for encrypted keystores, files that need one are skipped without it
+    :return: [(address, private key), ...] sorted by file name, example files skipped
+    """
+    _print = style.PrettyText()
+    plain, keystores = [], []
+    for name in sorted(os.listdir(path)):
+        if not name.endswith('.json') or name.startswith('example'):
+            continue
+        with open(os.path.join(path, name)) as ff:
+            try:
+                data = json.load(ff)
+            except ValueError:
+                _print.warning(f'Skipping {name}, not json')
+                continue
+        if isinstance(data.get('wallet'), dict) and data['wallet'].get('private_key'):
+            key = data['wallet']['private_key']
+            plain.append((Account.from_key(key).address, key))
+        elif 'crypto' in data or 'Crypto' in data:
+            if password is None:
+                _print.warning(f'Skipping encrypted keystore {name}, no password given')
+                continue
+            keystores.append(data)
+        else:
+            _print.warning(f'Skipping {name}, not a wallet or keystore')
+    if keystores:
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            keys = list(pool.map(_decrypt, [(k, password) for k in keystores]))
+        plain += [(Account.from_key(key).address, key) for key in keys]
+    return plain
+
+
+class WalletSet:
+    """
+    Many accounts on one chain, see the module doc.
+    """
+    def __init__(self, w3, keys: list, multicall: str = None, max_workers: int = None, send_workers: int = 16):
+        """
+        :param keys: [(address, private key), ...] or private keys
+        :param multicall: Multicall3 address, None for the canonical deployment
+        :param max_workers: signing processes, one per cpu by default
+        """
+        self.w3 = w3
+        self._keys = {}
+        for item in keys:
+            key = item[1] if isinstance(item, (tuple, list)) else item
+            self._keys[Account.from_key(key).address] = key
+        self.addresses = list(self._keys)
+        self.multicall = Multicall(w3, address=multicall) if multicall else Multicall(w3)
+        self.max_workers = max_workers
+        self.send_workers = send_workers
+        self._print = style.PrettyText()
+
+    def __len__(self):
+        return len(self.addresses)
+
+    def _threads(self, fn, items: list) -> list:
+        with ThreadPoolExecutor(max_workers=self.send_workers) as pool:
+            return list(pool.map(fn, items))
+
+    def nonces(self) -> dict:
+        return dict(zip(self.addresses,
+                        self._threads(lambda a: self.w3.eth.get_transaction_count(a, 'pending'), self.addresses)))
+
+    def native_balances(self) -> dict:
+        return dict(zip(self.addresses, self._threads(self.w3.eth.get_balance, self.addresses)))
+
+    def token_balances(self, tokens: list) -> dict:
+        """
+        :return: {(wallet, token): raw balance} in one multicall batch
+        """
+        pairs = [(a, to_checksum_address(t)) for a in self.addresses for t in tokens]
+        results = self.multicall.call([(t, balance_of_data(a)) for a, t in pairs])
+        return {pair: decode_uint(raw) if ok else 0 for pair, (ok, raw) in zip(pairs, results)}
+
+    def allowances(self, tokens: list, spenders: list) -> dict:
+        """
+        :return: {(wallet, token, spender): allowance} in one multicall batch
+        """
+        keys = [(a, to_checksum_address(t), to_checksum_address(s))
+                for a in self.addresses for t in tokens for s in spenders]
+        results = self.multicall.call([(t, allowance_data(a, s)) for a, t, s in keys])
+        return {key: decode_uint(raw) if ok else 0 for key, (ok, raw) in zip(keys, results)}
+
+    # ------ build, sign, send ------------------------------------------------------------
+
+    def build(self, plans: dict, fees: dict = None) -> list:
+        """
+        :param plans: {wallet: [{'to', 'data', 'value', optional 'gas'}, ...]} in the order to send them
+        :return: [(wallet, tx), ...] complete unsigned transactions, consecutive nonces per wallet. A
+        wallet with a transaction that would revert is reported and left out, the others still go.
+        """
+        plans = {a: txs for a, txs in plans.items() if txs}
+        if not plans:
+            return []
+        fees = fees or fee_params(self.w3)
+        chain_id = self.w3.eth.chain_id
+        nonces = dict(zip(plans, self._threads(lambda a: self.w3.eth.get_transaction_count(a, 'pending'),
+                                               list(plans))))
+        txs = []
+        for wallet, calls in plans.items():
+            for i, call in enumerate(calls):
+                txs.append((wallet, {'from': wallet, 'to': to_checksum_address(call['to']),
+                                     'data': call.get('data', '0x'), 'value': call.get('value', 0),
+                                     'nonce': nonces[wallet] + i, 'chainId': chain_id, 'gas': call.get('gas'),
+                                     **fees}))
+
+        def estimate(item):
+            _, tx = item
+            if tx['gas'] is not None:
+                return tx['gas']
+            try:
+                return int(self.w3.eth.estimate_gas({k: tx[k] for k in ('from', 'to', 'data', 'value')}) * 1.2)
+            except ValueError as err:
+                return err
+
+        failed = {}
+        for (wallet, tx), gas in zip(txs, self._threads(estimate, txs)):
+            if isinstance(gas, Exception):
+                failed.setdefault(wallet, (tx['nonce'], gas))
+            tx['gas'] = gas
+        for wallet, (nonce, err) in failed.items():
+            # its later transactions would wait forever behind the missing nonce, skip them all
+            self._print.error(f'Skipping {wallet}, nonce {nonce} would revert: {err}')
+        return [(wallet, tx) for wallet, tx in txs if wallet not in failed]
+
+    def sign(self, txs: list) -> list:
+        """
+        :return: [(wallet, nonce, raw transaction, txid), ...]
+        """
+        jobs = [(dict(tx), self._keys[wallet]) for wallet, tx in txs]
+        if len(jobs) < MIN_POOL_BATCH:
+            signed = [_sign(job) for job in jobs]
+        else:
+            with ProcessPoolExecutor(max_workers=self.max_workers) as pool:
+                signed = list(pool.map(_sign, jobs, chunksize=max(1, len(jobs) // (4 * (os.cpu_count() or 1)))))
+        return [(wallet, tx['nonce'], raw, txid) for (wallet, tx), (raw, txid) in zip(txs, signed)]
+
+    def send(self, signed: list) -> list:
+        """
+        Broadcast every wallet's transactions in parallel, each wallet's in nonce order. A rejected
+        transaction stops that wallet, its later nonces would only be stuck behind the gap.
+        :return: [(wallet, txid, error or None), ...]
+        """
+        by_wallet = {}
+        for item in signed:
+            by_wallet.setdefault(item[0], []).append(item)
+
+        def send_wallet(items):
+            results = []
+            for wallet, nonce, raw, txid in sorted(items, key=lambda x: x[1]):
+                try:
+                    self.w3.eth.send_raw_transaction(raw)
+                except ValueError as err:
+                    self._print.error(f'{wallet} nonce {nonce} rejected: {err}')
+                    results.append((wallet, txid, str(err)))
+                    break
+                results.append((wallet, txid, None))
+            return results
+
+        sent = [r for part in self._threads(send_wallet, list(by_wallet.values())) for r in part]
+        self._print.good(f'Sent {sum(1 for r in sent if r[2] is None)} of {len(signed)} transactions '
+                         f'from {len(by_wallet)} wallets.')
+        return sent
+
+    def send_bundle(self, signed: list, bundler) -> list:
+        """
+        Send everything as one private bundle instead, all of it lands in one block or none of it.
+        :param bundler: lib.bundles.BundleSubmitter
+        :return: [(wallet, txid, error or None), ...] like send()
+        """
+        if not signed:
+            return []
+        ordered = sorted(signed, key=lambda x: (self.addresses.index(x[0]), x[1]))
+        result = bundler.submit([raw for _, _, raw, _ in ordered])
+        error = None if result['included'] is not None else result['reason']
+        return [(wallet, txid, error) for wallet, _, _, txid in ordered]
+
+    def execute(self, plans: dict) -> list:
+        return self.send(self.sign(self.build(plans)))
+
+    def wait(self, sent: list, timeout: float = 180.0, poll: float = 1.0) -> dict:
+        """
+        :return: {txid: status} of the receipts seen before the timeout
+        """
+        pending = {txid for _, txid, err in sent if err is None}
+        statuses = {}
+        deadline = time.time() + timeout
+        while pending and time.time() < deadline:
+            found = self._threads(self._receipt_status, list(pending))
+            for txid, status in zip(list(pending), found):
+                if status is not None:
+                    statuses[txid] = status
+                    pending.discard(txid)
+            if pending:
+                time.sleep(poll)
+        return statuses
+
+    def _receipt_status(self, txid: str):
+        try:
+            return self.w3.eth.get_transaction_receipt(txid)['status']
+        except Exception:
+            return None
+
+    # ------ operations -------------------------------------------------------------------
+
+    def approve_plans(self, tokens: list, spenders: list, amount: int = MAX_UINT256) -> dict:
+        """
+        Approvals that are missing, same threshold as ApprovalManager.missing().
+        """
+        threshold = amount // 2 if amount == MAX_UINT256 else amount
+        plans = {}
+        for (wallet, token, spender), allowance in self.allowances(tokens, spenders).items():
+            if allowance < threshold:
+                plans.setdefault(wallet, []).append({'to': token, 'data': approve_data(spender, amount)})
+        return plans
+
+    def sweep_plans(self, recipient: str, tokens: list = (), native: bool = False, fees: dict = None) -> dict:
+        """
+        Transfer the whole balance of each token, then optionally of the native asset, less the gas
+        of every transaction in the wallet's plan, to one recipient. The token transfers are
+        estimated here and carry their gas limit, so the native amount leaves exactly what build()
+        will budget for them. A wallet with a transfer that would revert is left out.
+        :param fees: pass the same fee fields to build() so the native amount leaves enough for gas
+        """
+        recipient = to_checksum_address(recipient)
+        fees = fees or fee_params(self.w3)
+        plans = {a: [] for a in self.addresses}
+        for (wallet, token), balance in (self.token_balances(tokens) if tokens else {}).items():
+            if balance and wallet != recipient:
+                plans[wallet].append({'to': token, 'data': transfer_data(recipient, balance)})
+        token_gas = {}
+        for wallet, tx in self.build(plans, fees):
+            token_gas.setdefault(wallet, []).append(tx['gas'])
+        for wallet, calls in plans.items():
+            if calls and wallet not in token_gas:
+                plans[wallet] = None
+                continue
+            for call, gas in zip(calls, token_gas.get(wallet, [])):
+                call['gas'] = gas
+        plans = {a: calls for a, calls in plans.items() if calls is not None}
+        if native:
+            fee_per_gas = fees.get('maxFeePerGas') or fees.get('gasPrice')
+            for wallet, balance in self.native_balances().items():
+                if wallet == recipient or wallet not in plans:
+                    continue
+                gas_budget = (NATIVE_TRANSFER_GAS + sum(token_gas.get(wallet, []))) * fee_per_gas
+                if balance > gas_budget:
+                    plans[wallet].append({'to': recipient, 'value': balance - gas_budget,
+                                          'gas': NATIVE_TRANSFER_GAS})
+        return plans
+
+    def swap_plans(self, router, weth: str, input_token: str, output_token: str, amounts: dict,
+                   slippage: float = 0.005, deadline: int = 600) -> dict:
+        """
+        Uniswap v2 router swaps, routed like uniswap-python: direct when one side is WETH, through
+        WETH otherwise. The zero address means the native asset. Allowances must already be set.
+        :param router: web3 contract of a v2 router02
+        :param amounts: {wallet: raw input amount}
+        """
+        native_in = input_token.lower() in NATIVE_ADDRESSES
+        native_out = output_token.lower() in NATIVE_ADDRESSES
+        token_in = to_checksum_address(weth if native_in else input_token)
+        token_out = to_checksum_address(weth if native_out else output_token)
+        path = [token_in, token_out] if to_checksum_address(weth) in (token_in, token_out) \
+            else [token_in, to_checksum_address(weth), token_out]
+        distinct = sorted({a for a in amounts.values() if a})
+        quotes = dict(zip(distinct, self._threads(lambda a: router.functions.getAmountsOut(a, path).call()[-1],
+                                                  distinct)))
+        expires = int(time.time()) + deadline
+        plans = {}
+        for wallet, amount in amounts.items():
+            if not amount:
+                continue
+            min_out = int(quotes[amount] * (1 - slippage))
+            if native_in:
+                data = router.encodeABI('swapExactETHForTokens', args=(min_out, path, wallet, expires))
+            elif native_out:
+                data = router.encodeABI('swapExactTokensForETH', args=(amount, min_out, path, wallet, expires))
+            else:
+                data = router.encodeABI('swapExactTokensForTokens', args=(amount, min_out, path, wallet, expires))
+            plans[wallet] = [{'to': router.address, 'data': data, 'value': amount if native_in else 0}]
+        return plans
@@ -0,0 +1,319 @@
+import asyncio
+import itertools
+import json
+import queue
+import threading
+from collections import OrderedDict
+
+import websockets
+from web3.providers.base import BaseProvider
+
+from lib import style
+
+# Notifications for a server id that is not mapped yet are kept for this many ids, this many each.
+EARLY_IDS = 16
+EARLY_EVENTS = 256
+
+
+class Subscription:
+    """
+    One eth_subscribe subscription. Survives reconnects: the provider re-subscribes and
+    updates `server_id` every time the socket comes back.
+    """
+    def __init__(self, local_id: int, params: list, callback):
+        self.local_id = local_id
+        self.params = params
+        self.callback = callback
+        self.server_id = None
+
+    @property
+    def kind(self) -> str:
+        return self.params[0]
+
+
+class PersistentWebsocketProvider(BaseProvider):
+    """
+    Web3 provider over a single persistent websocket.
+
+    The socket lives on a background asyncio loop. Requests from any thread are multiplexed over it
+    and matched to their response by JSON-RPC id, so there is no per request connection or http
+    overhead. The socket is reopened with exponential backoff when it drops, requests that were in
+    flight are retried once on the new socket and subscriptions are re-established.
+
+    Subscription callbacks run on a dedicated dispatcher thread in the order the node sent them, so
+    a slow callback never stalls the socket reader. The node can notify before the eth_subscribe
+    reply has been matched to its subscription, those notifications are held until it is.
+    """
+    def __init__(self, endpoint_uri: str,
+                 request_timeout: float = 30.0,
+                 reconnect_delay: float = 0.5,
+                 max_reconnect_delay: float = 30.0,
+                 max_message_size: int = 2 ** 25):
+        super().__init__()
+        self.endpoint_uri = endpoint_uri
+        self.request_timeout = request_timeout
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self.max_message_size = max_message_size
+        self._print = style.PrettyText()
+
+        self._ids = itertools.count(1)
+        self._pending = {}
+        self._subscriptions = {}
+        self._by_server_id = {}
+        self._early = OrderedDict()
+        self._subs_lock = threading.Lock()
+        self._ws = None
+        self._closing = False
+        self._connected = threading.Event()
+
+        self._events = queue.Queue()
+        self._dispatcher = threading.Thread(target=self._dispatch_events, name='ws-dispatch', daemon=True)
+        self._dispatcher.start()
+
+        self._loop = asyncio.new_event_loop()
+        self._loop_ready = threading.Event()
+        self._thread = threading.Thread(target=self._run_loop, name='ws-provider', daemon=True)
+        self._thread.start()
+        self._loop_ready.wait()
+
+    def __str__(self):
+        return f'Persistent WS connection {self.endpoint_uri}'
+
+    # ------ loop / connection ------------------------------------------------------------
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self._loop)
+        self._ws_ready = asyncio.Event()
+        self._loop_ready.set()
+        self._loop.run_until_complete(self._connection_loop())
+
+    async def _connection_loop(self):
+        delay = self.reconnect_delay
+        while not self._closing:
+            try:
+                async with websockets.connect(self.endpoint_uri, max_size=self.max_message_size,
+                                              ping_interval=20, ping_timeout=20) as ws:
+                    self._ws = ws
+                    delay = self.reconnect_delay
+                    reader = asyncio.ensure_future(self._reader(ws))
+                    await self._resubscribe()
+                    self._ws_ready.set()
+                    self._connected.set()
+                    await reader
+            except (OSError, asyncio.TimeoutError, websockets.exceptions.WebSocketException) as err:
+                if not self._closing:
+                    self._print.warning(f'Websocket {self.endpoint_uri} dropped: {err}')
+            except Exception as err:
+                # anything else would end this thread and every request after it, reconnect instead
+                if not self._closing:
+                    self._print.error(f'Websocket {self.endpoint_uri} failed, reconnecting: {err!r}')
+            finally:
+                self._ws = None
+                self._ws_ready.clear()
+                self._connected.clear()
+                for fut in list(self._pending.values()):
+                    if not fut.done():
+                        fut.set_exception(ConnectionError('websocket reconnecting'))
+                self._pending.clear()
+            if not self._closing:
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.max_reconnect_delay)
+
+    async def _reader(self, ws):
+        async for raw in ws:
+            try:
+                message = json.loads(raw)
+                for item in message if isinstance(message, list) else [message]:
+                    self._route(item)
+            except (ValueError, AttributeError, KeyError, TypeError) as err:
+                self._print.warning(f'Websocket {self.endpoint_uri} sent a bad frame, ignored: {err!r}')
+
+    def _route(self, message: dict):
+        if message.get('method') == 'eth_subscription':
+            params = message.get('params', {})
+            server_id = params.get('subscription')
+            with self._subs_lock:
+                sub = self._by_server_id.get(server_id)
+                if sub is not None:
+                    self._events.put((sub.callback, params.get('result')))
+                else:
+                    self._hold(server_id, params.get('result'))
+            return
+        fut = self._pending.pop(message.get('id'), None)
+        if fut is not None and not fut.done():
+            fut.set_result(message)
+
+    def _hold(self, server_id, result):
+        # caller holds _subs_lock. Ids that are never mapped (late notifications of a closed
+        # subscription) age out, oldest first.
+        held = self._early.setdefault(server_id, [])
+        if len(held) < EARLY_EVENTS:
+            held.append(result)
+        while len(self._early) > EARLY_IDS:
+            self._early.popitem(last=False)
+
+    def _map(self, sub: Subscription, server_id):
+        """
+        Route `server_id` to `sub` and deliver what arrived for it in the meantime, in order.
+        """
+        with self._subs_lock:
+            sub.server_id = server_id
+            self._by_server_id[server_id] = sub
+            for result in self._early.pop(server_id, []):
+                self._events.put((sub.callback, result))
+
+    async def _send(self, method, params) -> dict:
+        await asyncio.wait_for(self._ws_ready.wait(), self.request_timeout)
+        request_id = next(self._ids)
+        fut = self._loop.create_future()
+        self._pending[request_id] = fut
+        try:
+            await self._ws.send(json.dumps({'jsonrpc': '2.0', 'id': request_id, 'method': method,
+                                            'params': params}))
+            return await asyncio.wait_for(fut, self.request_timeout)
+        finally:
+            self._pending.pop(request_id, None)
+
+    async def _send_batch(self, calls: list) -> list:
+        await asyncio.wait_for(self._ws_ready.wait(), self.request_timeout)
+        futs, body = [], []
+        for method, params in calls:
+            request_id = next(self._ids)
+            fut = self._loop.create_future()
+            self._pending[request_id] = fut
+            futs.append((request_id, fut))
+            body.append({'jsonrpc': '2.0', 'id': request_id, 'method': method, 'params': params})
+        try:
+            await self._ws.send(json.dumps(body))
+            return list(await asyncio.wait_for(asyncio.gather(*(f for _, f in futs)), self.request_timeout))
+        finally:
+            for request_id, _ in futs:
+                self._pending.pop(request_id, None)
+
+    async def _request(self, method, params) -> dict:
+        try:
+            return await self._send(method, params)
+        except (ConnectionError, websockets.exceptions.ConnectionClosed):
+            # the socket dropped under us, retry once on the next connection
+            return await self._send(method, params)
+
+    async def _resubscribe(self):
+        with self._subs_lock:
+            self._by_server_id.clear()
+            self._early.clear()
+            subs = list(self._subscriptions.values())
+        for sub in subs:
+            request_id = next(self._ids)
+            fut = self._loop.create_future()
+            self._pending[request_id] = fut
+            await self._ws.send(json.dumps({'jsonrpc': '2.0', 'id': request_id, 'method': 'eth_subscribe',
+                                            'params': sub.params}))
+            response = await asyncio.wait_for(fut, self.request_timeout)
+            if 'error' in response or not response.get('result'):
+                self._print.error(f'Could not re-subscribe to {sub.kind}: {response.get("error")}')
+                continue
+            self._map(sub, response['result'])
+
+    async def _subscribe(self, sub: Subscription) -> None:
+        await asyncio.wait_for(self._ws_ready.wait(), self.request_timeout)
+        # registered before it is sent: if the socket drops before the reply, the reconnect
+        # re-subscribes it along with the others
+        ws = self._ws
+        with self._subs_lock:
+            self._subscriptions[sub.local_id] = sub
+        try:
+            response = await self._send('eth_subscribe', sub.params)
+        except (ConnectionError, websockets.exceptions.ConnectionClosed):
+            return
+        except BaseException:
+            with self._subs_lock:
+                self._subscriptions.pop(sub.local_id, None)
+            raise
+        if 'error' in response or not response.get('result'):
+            with self._subs_lock:
+                self._subscriptions.pop(sub.local_id, None)
+            raise ValueError(f'eth_subscribe {sub.kind} failed: {response.get("error")}')
+        if self._ws is ws:
+            # else the socket was replaced meanwhile and _resubscribe mapped the new id
+            self._map(sub, response['result'])
+
+    def _dispatch_events(self):
+        while True:
+            callback, result = self._events.get()
+            try:
+                callback(result)
+            except Exception as err:
+                self._print.error(f'Subscription callback raised: {err!r}')
+
+    # ------ web3 provider api ------------------------------------------------------------
+
+    def make_request(self, method, params) -> dict:
+        fut = asyncio.run_coroutine_threadsafe(self._request(method, list(params)), self._loop)
+        return fut.result(self.request_timeout * 2 + 1)
+
+    def make_batch_request(self, calls: list) -> list:
+        """
+        Send several requests as one JSON-RPC batch, one frame each way. Not retried on reconnect.
+        :param calls: [(method, params), ...]
+        :return: the responses in the order of the calls
+        """
+        fut = asyncio.run_coroutine_threadsafe(self._send_batch([(m, list(p)) for m, p in calls]), self._loop)
+        return fut.result(self.request_timeout * 2 + 1)
+
+    def isConnected(self) -> bool:
+        return self._connected.wait(self.request_timeout)
+
+    is_connected = isConnected
+
+    def close(self) -> None:
+        self._closing = True
+        if self._ws is not None:
+            asyncio.run_coroutine_threadsafe(self._ws.close(), self._loop)
+
+    # ------ subscriptions ----------------------------------------------------------------
+
+    def subscribe(self, params: list, callback) -> int:
+        """
+        Open an eth_subscribe subscription that is kept alive across reconnects.
+        :param params: eth_subscribe params, ie ['newHeads'] or ['logs', {'address': ...}]
+        :param callback: called with each notification result
+        :return: local subscription id, pass to unsubscribe()
+        """
+        sub = Subscription(next(self._ids), list(params), callback)
+        fut = asyncio.run_coroutine_threadsafe(self._subscribe(sub), self._loop)
+        fut.result(self.request_timeout * 2 + 1)
+        return sub.local_id
+
+    def unsubscribe(self, local_id: int) -> bool:
+        with self._subs_lock:
+            sub = self._subscriptions.pop(local_id, None)
+            if sub is None:
+                return False
+            self._by_server_id.pop(sub.server_id, None)
+        if sub.server_id is not None and self._connected.is_set():
+            self.make_request('eth_unsubscribe', [sub.server_id])
+        return True
+
+    def subscribe_new_heads(self, callback) -> int:
+        return self.subscribe(['newHeads'], callback)
+
+    def subscribe_logs(self, callback, address: (str, list) = None, topics: list = None) -> int:
+        log_filter = {}
+        if address:
+            log_filter['address'] = address
+        if topics:
+            log_filter['topics'] = topics
+        return self.subscribe(['logs', log_filter], callback)
+
+    def subscribe_pending_transactions(self, callback, full: bool = False) -> int:
+        """
+        :param full: ask for full transaction objects instead of hashes (geth and erigon support this)
+        """
+        if full:
+            return self.subscribe(['newPendingTransactions', True], callback)
+        return self.subscribe(['newPendingTransactions'], callback)
+
+
+def is_ws_uri(uri: str) -> bool:
+    return bool(uri) and uri.startswith(('ws://', 'wss://'))
@@ -0,0 +1,365 @@
+#!/usr/bin/env python3.10
+import argparse
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import dotenv
+import web3
+
+from lib import style
+from lib.data_store import data_path
+from lib.erc20 import DECIMALS, balance_of_data, decode_uint
+from lib.multicall import Multicall
+from lib.pyswap_exceptions import ConfigurationError
+from lib.token_store import TokenStore
+from lib.utils import is_valid_evm_address
+from swapper import Swapper
+from zrx_swap import ZeroX
+
+try:
+    from eth_utils.address import toCheckSumAddress as to_checksum_address
+except ImportError:
+    from eth_utils.address import to_checksum_address
+
+try:
+    from eth_utils.curried import toHex as to_hex
+except ImportError:
+    from eth_utils.curried import to_hex
+
+dotenv.load_dotenv()
+
+
+def parse_chain_spec(spec: str, default_backend: str = 'uniswap', default_version: int = 2) -> dict:
+    """
+    `network[:backend[:version]]`, ie `polygon:sushiswap:2`, or `network:zrx` for the 0x api.
+    :return: chain config for ChainManager
+    """
+    parts = spec.split(':')
+    backend = parts[1] if len(parts) > 1 and parts[1] else default_backend
+    version = int(parts[2]) if len(parts) > 2 else default_version
+    return {'network': parts[0], 'backend': backend, 'version': version}
+
+
+class ChainManager:
+    """
+    One warm Swapper (or ZeroX client) per configured chain, and cross chain operations that run
+    on all of them at once.
+
+    Every chain gets its own thread pool of `concurrency` workers and an rpc connection pool of the
+    same size, so a slow or rate limited chain only queues its own work. Within a chain, balance
+    reads are batched through Multicall3 when the chain has it. The steps of a plan run in order on
+    their chain (they share a nonce) while the chains themselves run side by side.
+    """
+    def __init__(self, private_key: str, address: str, chains: list, concurrency: int = 4,
+                 max_slippage: float = 0.005, debug: bool = False):
+        """
+        :param chains: list of chain configs, see parse_chain_spec(). An optional `concurrency` key
+        overrides the default for that chain.
+        :param concurrency: default number of operations in flight per chain
+        """
+        self._print = style.PrettyText()
+        self.private_key = private_key
+        self.address = to_checksum_address(address)
+        self.max_slippage = max_slippage
+        self.debug = debug
+        self.configs = {c['network']: dict(c, concurrency=c.get('concurrency') or concurrency) for c in chains}
+        self.clients = {}
+        self.pools = {}
+        self.tokens = {}
+        self._decimals = {}
+
+    # ------ set up -----------------------------------------------------------------------
+
+    def _connect_one(self, config: dict):
+        network = config['network']
+        if config['backend'] == 'zrx':
+            client = ZeroX(network, no_prompt=True, privkey_str=self.private_key,
+                           max_slippage=self.max_slippage, pool_size=config['concurrency'])
+        else:
+            client = Swapper(self.private_key, self.address, version=config['version'], network=network,
+                             backend=config['backend'], debug=self.debug, max_slippage=self.max_slippage,
+                             pool_size=config['concurrency'])
+            if client.uniswap is None:
+                raise ConfigurationError(f'{config["backend"]} v{config["version"]} is not deployed on {network}')
+        return client
+
+    def connect(self) -> dict:
+        """
+        Connect to every configured chain concurrently. A chain that fails to connect is reported and
+        left out, the others stay usable.
+        :return: {network: client}
+        """
+        with ThreadPoolExecutor(max_workers=len(self.configs) or 1, thread_name_prefix='chain-connect') as pool:
+            futures = {network: pool.submit(self._connect_one, config) for network, config in self.configs.items()}
+        for network, future in futures.items():
+            try:
+                self.clients[network] = future.result()
+            except Exception as err:
+                self._print.error(f'Could not connect to {network}: {err}')
+                continue
+            self.pools[network] = ThreadPoolExecutor(max_workers=self.configs[network]['concurrency'],
+                                                     thread_name_prefix=f'chain-{network}')
+            self.tokens[network] = TokenStore(network) if os.path.exists(data_path(f'tokens_{network}.json')) else None
+        return self.clients
+
+    def close(self) -> None:
+        for pool in self.pools.values():
+            pool.shutdown(wait=False)
+        self.pools.clear()
+
+    # ------ helpers ----------------------------------------------------------------------
+
+    def resolve(self, network: str, token: str) -> (str, None):
+        """
+        Symbol or address to a checksum address on this chain, None if the symbol is not known there.
+        """
+        if is_valid_evm_address(token):
+            return to_checksum_address(token)
+        client = self.clients[network]
+        if isinstance(client, Swapper):
+            try:
+                return client.resolve_token(token)
+            except ValueError:
+                return None
+        store = self.tokens.get(network)
+        if store is not None:
+            for alias in (token, token.upper(), token.lower()):
+                if store.known.get(alias):
+                    return to_checksum_address(store.known[alias])
+        return None
+
+    def decimals(self, network: str, token: str) -> int:
+        key = (network, token.lower())
+        if key not in self._decimals:
+            self._decimals[key] = self.clients[network].erc20.decimals(token)
+        return self._decimals[key]
+
+    def _fan_out(self, jobs: dict) -> dict:
+        """
+        Run one callable per chain, each on its own chain's pool, and wait for all of them.
+        :param jobs: {network: callable}
+        :return: {network: result}, {'error': message} for a chain whose job raised
+        """
+        futures = {network: self.pools[network].submit(job) for network, job in jobs.items()
+                   if network in self.pools}
+        wait(futures.values())
+        results = {}
+        for network, future in futures.items():
+            try:
+                results[network] = future.result()
+            except Exception as err:
+                self._print.error(f'{network}: {err}')
+                results[network] = {'error': str(err)}
+        return results
+
+    # ------ operations -------------------------------------------------------------------
+
+    def _chain_balances(self, network: str, tokens: list) -> dict:
+        client = self.clients[network]
+        w3 = client.w3
+        native = w3.eth.get_balance(self.address)
+        balances = {'native': native / 10 ** 18}
+        resolved = [(t, self.resolve(network, t)) for t in tokens]
+        resolved = [(t, a) for t, a in resolved if a]
+        if not resolved:
+            return balances
+        multicall = (client.chain or {}).get('multicall3')
+        if multicall:
+            calls = []
+            for _, token in resolved:
+                calls.append((token, balance_of_data(self.address)))
+                calls.append((token, DECIMALS))
+            results = Multicall(w3, address=multicall).call(calls)
+            for i, (symbol, token) in enumerate(resolved):
+                (ok_bal, raw_bal), (ok_dec, raw_dec) = results[2 * i], results[2 * i + 1]
+                if ok_bal and ok_dec:
+                    self._decimals[(network, token.lower())] = decode_uint(raw_dec)
+                    balances[symbol] = decode_uint(raw_bal) / 10 ** decode_uint(raw_dec)
+            return balances
+        # no Multicall3 here, spread the single reads over a pool of their own: this job already holds
+        # a worker of the chain's pool, waiting on that pool could deadlock it
+        with ThreadPoolExecutor(max_workers=self.configs[network]['concurrency']) as pool:
+            raw = dict(zip([symbol for symbol, _ in resolved],
+                           pool.map(lambda item: client.erc20.balance_of(item[1], self.address), resolved)))
+        for symbol, token in resolved:
+            balances[symbol] = raw[symbol] / 10 ** self.decimals(network, token)
+        return balances
+
+    def balances(self, tokens: list) -> dict:
+        """
+        Native balance plus the balance of each token known on each chain.
+        :param tokens: symbols (resolved per chain) or addresses
+        :return: {network: {symbol: float}}
+        """
+        return self._fan_out({n: (lambda n=n: self._chain_balances(n, tokens)) for n in self.clients})
+
+    def _chain_quote(self, network: str, input_token: str, output_token: str, quantity: float) -> dict:
+        client = self.clients[network]
+        if isinstance(client, Swapper):
+            quote = client.swap(input_token, output_token, float_qty=quantity, no_prompt=True, _quote_only=True)
+            if not quote:
+                raise ValueError('no quote')
+            return {'quote': quote, 'quote_raw': client.last_quote_raw}
+        sell = self.resolve(network, input_token) or input_token
+        buy = self.resolve(network, output_token) or output_token
+        if not is_valid_evm_address(sell):
+            raise ValueError(f'unknown token {input_token}')
+        raw_qty = int(quantity * 10 ** self.decimals(network, sell))
+        obj = client.quote(buy, sell, raw_qty, quote_only=True)
+        if not obj:
+            raise ValueError('no quote')
+        buy_raw = int(obj.get('buyAmount'))
+        buy_address = obj.get('buyTokenAddress') or buy
+        return {'quote': buy_raw / 10 ** self.decimals(network, to_checksum_address(buy_address)),
+                'quote_raw': buy_raw}
+
+    def quotes(self, input_token: str, output_token: str, quantity: float) -> dict:
+        """
+        Quote the same swap on every chain.
+        :param quantity: float amount of input_token
+        :return: {network: {'quote': float, 'quote_raw': int}}
+        """
+        return self._fan_out({n: (lambda n=n: self._chain_quote(n, input_token, output_token, quantity))
+                              for n in self.clients})
+
+    def _run_step(self, network: str, step: dict):
+        client = self.clients[network]
+        action = step.get('action', 'swap')
+        if action == 'quote':
+            return self._chain_quote(network, step['input'], step['output'], step.get('quantity', 0.0))
+        if isinstance(client, Swapper):
+            if action != 'swap':
+                raise ValueError(f'unsupported action {action}')
+            txid = client.swap(step['input'], step['output'], float_qty=step.get('quantity', 0.0),
+                               recipient=step.get('recipient'), no_prompt=True,
+                               fee_on_transfer=step.get('fee_on_transfer', False))
+            if not txid:
+                raise ValueError('swap failed')
+            tx_hex = to_hex(txid)
+            receipt = client.poll_tx_for_receipt(tx_hex) if step.get('wait', True) else None
+            return {'action': action, 'txid': tx_hex, 'status': receipt.get('status') if receipt else None}
+        sell = self.resolve(network, step['input'])
+        if sell is None:
+            raise ValueError(f'unknown token {step["input"]}')
+        raw_qty = int(step.get('quantity', 0.0) * 10 ** self.decimals(network, sell))
+        if action == 'approve':
+            tx_hex = client.approve(sell, raw_qty)
+        elif action == 'swap':
+            buy = self.resolve(network, step['output'])
+            if buy is None:
+                raise ValueError(f'unknown token {step["output"]}')
+            tx_hex = client.swap(buy, sell, raw_qty)
+        else:
+            raise ValueError(f'unsupported action {action}')
+        if not tx_hex:
+            raise ValueError(f'{action} failed')
+        receipt = client.poll_receipt(tx_hex) if step.get('wait', True) else None
+        return {'action': action, 'txid': tx_hex, 'status': receipt.get('status') if receipt else None}
+
+    def _chain_plan(self, network: str, steps: list) -> list:
+        results = []
+        for step in steps:
+            try:
+                results.append(self._run_step(network, step))
+            except Exception as err:
+                # later steps usually depend on this one, stop this chain but leave the others running
+                self._print.error(f'{network}: step {step} failed: {err}')
+                results.append({'action': step.get('action', 'swap'), 'error': str(err)})
+                break
+        return results
+
+    def execute(self, plan: dict) -> dict:
+        """
+        Run a per chain plan, ie {"ethereum": [{"action": "swap", "input": "WETH", "output": "USDC",
+        "quantity": 0.1}], "polygon": [...]}. Actions are swap, quote and (0x chains) approve, each step
+        waits for its receipt unless it has "wait": false.
+        :return: {network: [step result, ...]}
+        """
+        unknown = [n for n in plan if n not in self.clients]
+        for network in unknown:
+            self._print.error(f'Plan has steps for {network}, which is not connected. Skipping.')
+        return self._fan_out({n: (lambda n=n: self._chain_plan(n, steps)) for n, steps in plan.items()
+                              if n not in unknown})
+
+
+if __name__ == '__main__':
+    s = style.PrettyText()
+    args = argparse.ArgumentParser(usage='pySwap multi chain manager. See docs for details.')
+    args.add_argument('-c', '--chains', nargs='+', default=['ethereum'],
+                      help='Chains to connect to as network[:backend[:version]], ie polygon:sushiswap or bsc:zrx.')
+    args.add_argument('-uv', '--uniswap_version', type=int, default=2, choices=[2, 3],
+                      help='Default uniswap version.')
+    args.add_argument('-b', '--backend', type=str, choices=['sushiswap', 'uniswap', 'kyberswap', 'zrx'],
+                      default='uniswap', help='Default dex backend.')
+    args.add_argument('-j', '--concurrency', type=int, default=4, help='Operations in flight per chain.')
+    args.add_argument('-w', '--wallet', dest='wallet_file', type=str, default=None,
+                      help='Location of json wallet file.')
+    args.add_argument('-k', '--private_key', dest='private_key', default=None, help='Specify a private key directly')
+    args.add_argument('-d', '--debug', action='store_true', help='Enable some developer features.')
+    args.add_argument('-O', '--output', dest='output_mode', choices=['human', 'json'], default='human',
+                      help='Human readable output or one JSON object per line.')
+    args.add_argument('--quiet', action='store_true', help='Only print errors.')
+    subparsers = args.add_subparsers(dest='command')
+    cmd_balances = subparsers.add_parser('balances', help='Portfolio balances on every chain.')
+    cmd_balances.add_argument('-t', '--tokens', nargs='*', default=[], help='Known symbols or addresses.')
+    cmd_quote = subparsers.add_parser('quote', help='Quote the same swap on every chain.')
+    cmd_quote.add_argument('-i', '--input', dest='input_token', default='WETH', help='Known symbol or address.')
+    cmd_quote.add_argument('-o', '--output', dest='output_token', default='USDC', help='Known symbol or address.')
+    cmd_quote.add_argument('-q', '--quantity', type=float, default=1.0, help='Float quantity.')
+    cmd_execute = subparsers.add_parser('execute', help='Execute a per chain plan from a json file.')
+    cmd_execute.add_argument('-p', '--plan', dest='plan_file', required=True, help='Location of the plan json.')
+    cmd_execute.add_argument('-n', '--no_prompt', dest='no_prompt', action='store_true',
+                             help='Do not prompt to confirm the plan.')
+    cmd_execute.add_argument('-s', '--max-slippage', dest='max_slippage', type=float, default=0.5,
+                             help='Refuse to broadcast if the simulated output is more than this percent below '
+                                  'the quote.')
+    args = args.parse_args()
+    style.configure(mode=args.output_mode, quiet=args.quiet)
+
+    private_key = None
+    address = None
+    wallet_file = args.wallet_file or os.environ.get('default_wallet_location')
+    if args.private_key:
+        private_key = args.private_key
+        address = web3.Account.from_key(private_key).address
+    elif wallet_file:
+        with open(wallet_file, 'r') as f:
+            wallet = json.load(f)
+            private_key = wallet.get('wallet').get('private_key')
+            address = wallet.get('wallet').get('address')
+    if not private_key or not address:
+        s.error('Either specify the location of your json wallet file or a private key string. See docs.')
+        exit(1)
+    if not args.command:
+        s.warning('No command given. Please run %s --help' % sys.argv[0])
+        exit(1)
+
+    plan = None
+    if args.command == 'execute':
+        with open(args.plan_file, 'r') as f:
+            plan = json.load(f)
+        s.data(plan, 'Plan:')
+        if not args.no_prompt:
+            s.flush()
+            if input('>> Execute this plan? y/n: ') != 'y':
+                s.warning('Canceled by user.')
+                exit(0)
+
+    manager = ChainManager(private_key, address,
+                           [parse_chain_spec(c, args.backend, args.uniswap_version) for c in args.chains],
+                           concurrency=args.concurrency, max_slippage=getattr(args, 'max_slippage', 0.5) / 100,
+                           debug=args.debug)
+    if not manager.connect():
+        s.error('No chain connected, exiting')
+        exit(1)
+    try:
+        if args.command == 'balances':
+            s.data(manager.balances(args.tokens), 'Balances:')
+        elif args.command == 'quote':
+            s.data(manager.quotes(args.input_token, args.output_token, args.quantity), 'Quotes:')
+        elif args.command == 'execute':
+            s.data(manager.execute(plan), 'Results:')
+    finally:
+        manager.close()
@@ -1,22 +1,47 @@
 #!/usr/bin/env python3.10
 import argparse
+import asyncio
+import atexit
+import getpass
 import json
 import os
-import pprint
 import sys
+import threading
 import time
 
 import dotenv
 import web3
 from eth_account.signers.local import LocalAccount
 from eth_typing.evm import ChecksumAddress
-from uniswap import Uniswap
 from web3.exceptions import ContractLogicError, TransactionNotFound
 from web3.middleware import geth_poa_middleware
 from lib.pyswap_exceptions import *
 import lib.abi_lib
 from lib import style
-from lib.utils import json_file_load, is_valid_evm_address
+from lib.utils import is_valid_evm_address, dex_contracts
+from lib.multi_provider import endpoints_from_env, make_http_provider
+from lib.ws_provider import PersistentWebsocketProvider, is_ws_uri
+from lib.erc20 import Erc20Reader
+from lib.preflight import Preflight
+from lib.uniswap_backend import PreflightUniswap
+from lib.token_store import TokenStore
+from lib import chain_profile
+from lib.mempool import MempoolWatcher
+from lib.arbitrage import ArbitrageScanner
+from lib.twap import TwapScheduler
+from lib.limit_orders import OrderBook, LimitOrderEngine
+from lib.approvals import ApprovalManager, MAX_UINT256, default_spenders, fee_params
+from lib.transfer_fee import TransferFeeDetector
+from lib.receipts import TradeJournal, fill_report, NATIVE_ADDRESSES
+from lib.multicall import Multicall
+from lib.v3_pool import V3PoolCache
+from lib.cassette import Cassette, CassetteProvider
+from lib.read_cache import BlockReadCache
+from lib.wallets import WalletSet, load_wallet_dir
+from lib.token_list import TokenListImporter, load_token_list
+from lib.bundles import BundleRelay, BundleSubmitter
+from lib.balance_history import BalanceHistory
+from lib.data_store import snapshot
 
 
 try:
@@ -40,25 +65,51 @@ class Swapper:
                  provider: str = None,
                  network: str = 'ethereum',
                  backend: str = 'uniswap',
-                 debug: bool = False):
+                 debug: bool = False,
+                 max_slippage: float = 0.005,
+                 preflight: bool = True,
+                 pool_size: int = None,
+                 cassette: Cassette = None,
+                 relay: str = None,
+                 relay_blocks: int = 3):
+        self._print = style.PrettyText()
         self.provider: str
+        self.endpoints: list = []
+        self.pool_size = pool_size
+        self.cassette = cassette
         self.debug_mode: bool = debug
-        if not provider:
+        if cassette is not None and cassette.mode == 'replay' and not provider:
+            # offline, nothing is configured or contacted
+            self.provider = f'cassette:{cassette.path}'
+        elif not provider:
             self.setup_provider(network)
         else:
             self.provider = provider
-        self.w3 = web3.Web3(web3.HTTPProvider(self.provider))
+            self.endpoints = [provider]
+        self.w3 = web3.Web3(self.build_provider())
+        self.erc20 = Erc20Reader(self.w3)
+        self.preflight = Preflight(self.w3, max_slippage=max_slippage) if preflight else None
+        self.last_quote_raw = 0
         self.network = network
+        self.chain: dict = {}
+        self.setup_w3_post()
+        self.bundler = None
+        if relay:
+            # private submission, approve and swap land together or not at all, see lib/bundles.py
+            self.bundler = BundleSubmitter(self.w3, BundleRelay(relay, os.environ.get('bundle_signing_key')),
+                                           blocks=relay_blocks,
+                                           poll=(self.chain.get('block_time') or 12) / 4)
         self.uniswap = self.setup_dex_backend(backend=backend, _version=version, provider=self.provider,
                                               _private_key=_private_key_, _address=_address_, _network=network)
         self.account: LocalAccount = web3.Account.from_key(_private_key_)
-        self.setup_w3_post()
 
-        self.native_map = None
         self.version = version
-        self.known = None
+        self.tokens = None
+        self._fee_detector = None
+        self._v3_pools = None
+        self.last_trade = None
+        self.journal = TradeJournal()
         self.eth_balance = 0.0
-        self._print = style.PrettyText()
         self.load_known_contracts()
 
     def setup_provider(self, network: str) -> str:
@@ -67,44 +118,77 @@ class Swapper:
         :param network: the name of the chain (ie ethereum)
         :return: str(the provider endpoint url)
         """
+        self.endpoints = endpoints_from_env(network)
         self.provider = os.environ.get(f'{network}_ws_endpoint')
-        if self.provider is None:
-            self.provider = os.environ.get(f'{network}_http_endpoint')
+        if self.provider is None and self.endpoints:
+            self.provider = self.endpoints[0]
         if not self.provider:
             raise ConfigurationError("Please configure %s in your .env" % f'{network}_ws_endpoint')
 
         return self.provider
 
+    def build_provider(self) -> web3.providers.BaseProvider:
+        """
+        Build the web3 provider. A ws:// or wss:// endpoint gets one persistent multiplexed websocket,
+        see lib/ws_provider.py. If several http endpoints are configured for this network
+        reads are hedged across them and writes are sent to all of them, see lib/multi_provider.py.
+        With a cassette every request is recorded, or replayed offline, see lib/cassette.py
+        :return: web3 provider
+        """
+        if self.cassette is not None:
+            self._print.normal(f'{self.cassette.mode.capitalize()}ing rpc cassette: {self.cassette.path}')
+            if self.cassette.mode == 'replay':
+                return CassetteProvider(self.cassette)
+        if is_ws_uri(self.provider):
+            self._print.normal(f'Using persistent websocket: {self.provider}')
+            provider = PersistentWebsocketProvider(self.provider)
+        else:
+            if len(self.endpoints) > 1:
+                self._print.normal(f'Using {len(self.endpoints)} rpc endpoints with hedged reads.')
+            provider = make_http_provider(self.endpoints or [self.provider], pool_size=self.pool_size)
+        return CassetteProvider(self.cassette, provider) if self.cassette is not None else provider
+
     def setup_w3_post(self) -> None:
         """
-        Load any required middleware for this chain.
+        Load any required middleware for this chain. Driven by the cached chain profile
+        (lib/chain_profile.py) so no rpc is needed here once the endpoint has been seen before.
         :return: None
         """
-        if self.network == 'ethereum':
-            return
-        else:
-            if self.w3.eth.chain_id in [56, 137]:
-                self.w3.middleware_onion.inject(geth_poa_middleware, layer=0)
-        s.good(f'Web3 connected to chain: {self.w3.eth.chain_id}')
+        # the profile belongs to the endpoint actually in use, the websocket one when there is one
+        endpoints = [self.provider] if is_ws_uri(self.provider) else self.endpoints or [self.provider]
+        self.chain = chain_profile.profiles.get(endpoints, self.w3, self.network, cassette=self.cassette)
+        if self.chain.get('poa'):
+            self.w3.middleware_onion.inject(geth_poa_middleware, layer=0)
+        # repeated reads inside a block are served from memory, see lib/read_cache.py
+        self.read_cache = BlockReadCache(head_ttl=(self.chain.get('block_time') or 12) / 4)
+        self.w3.middleware_onion.inject(self.read_cache.middleware, 'read_cache', layer=0)
+        if isinstance(self.w3.provider, PersistentWebsocketProvider):
+            self.w3.provider.subscribe_new_heads(lambda head: self.read_cache.new_block(int(head['number'], 16)))
+        self._print.good(f'Web3 connected to chain: {self.chain.get("chain_id")}')
 
     @property
     def native_assets(self):
         """
         Property getter, return the native currency for this network.
         """
-        if self.native_map is None:
-            self.native_map = json_file_load(f'data/native_currency.json').get('native_assets')
-            # print(self.native_map)
-        return self.native_map.get(self.network)
+        if self.chain.get('native_asset'):
+            return self.chain['native_asset']
+        return snapshot('native_currency.json').data.get('native_assets', {}).get(self.network)
 
     def load_known_contracts(self) -> None:
         """
         Load known contract symbol aliases to address mappings from
-        data/tokens_$network.json
+        tokens_$network.json in the data directory
         :return:
         """
-        known = json_file_load(f'data/tokens_{self.network}.json')
-        self.known = known.get('known_contracts')
+        self.tokens = TokenStore(self.network)
+
+    @property
+    def known(self) -> dict:
+        """
+        Symbol aliases to addresses, including ones other processes added since we started.
+        """
+        return self.tokens.known
 
     def add_known_contract(self, contract_address: str, symbol: str) -> (False, None):
         """
@@ -114,17 +198,65 @@ class Swapper:
 
         if not to_checksum_address(contract_address):
             return False
-        current_known = json_file_load(f'data/tokens_{self.network}.json')
-        current_known['known_contracts'][symbol] = contract_address
-        with open(f'data/tokens_{self.network}.json', 'w') as ff:
-            json.dump(current_known, fp=ff)
+        self.tokens.add_known(symbol, contract_address)
+
+    def resolve_token(self, token: str) -> ChecksumAddress:
+        """
+        Turn a known symbol alias or an address into a checksum address.
+        :param token: symbol (any case) or address
+        :return: ChecksumAddress
+        """
+        if is_valid_evm_address(token):
+            return to_checksum_address(token)
+        for alias in (token, token.upper(), token.lower()):
+            if self.known.get(alias):
+                return to_checksum_address(self.known.get(alias))
+        raise ValueError(f'Unknown token symbol: {token}, add it to {self.tokens.path}')
+
+    @property
+    def fee_detector(self) -> TransferFeeDetector:
+        """
+        Lazily built, probing needs the v2 factory and the router's WETH address.
+        """
+        if self._fee_detector is None:
+            self._fee_detector = TransferFeeDetector(self.w3, self.tokens, self.preflight or Preflight(self.w3),
+                                                     self.uniswap.factory_contract, self.uniswap.get_weth_address(),
+                                                     self.account.address)
+        return self._fee_detector
+
+    @property
+    def v3_pools(self) -> V3PoolCache:
+        """
+        Lazily built local v3 pool simulator, see lib/v3_pool.py.
+        """
+        if self._v3_pools is None:
+            self._v3_pools = V3PoolCache(self.w3, self.uniswap.factory_contract.address,
+                                         Multicall(self.w3, address=self.chain.get('multicall3')) if
+                                         self.chain.get('multicall3') else None)
+        return self._v3_pools
+
+    def v3_token(self, token: str) -> str:
+        """
+        Pools hold WETH, not the native asset.
+        """
+        return self.uniswap.get_weth_address() if token.lower() in NATIVE_ADDRESSES else token
+
+    def transfer_fees(self, input_token: str, output_token: str) -> (float, float):
+        """
+        Transfer tax of both sides of a swap, detected once per token and cached in the token db.
+        Unknown fees count as 0.
+        :return: (input fee, output fee)
+        """
+        if self.version != 2:
+            return 0.0, 0.0
+        return self.fee_detector.fee(input_token) or 0.0, self.fee_detector.fee(output_token) or 0.0
 
     def setup_dex_backend(self, backend: str,
                           _version: int,
                           provider: str,
                           _network: str,
                           _private_key: str,
-                          _address: str) -> (Uniswap, bool):
+                          _address: str) -> (PreflightUniswap, None):
         """
         Configure the Uniswap object class with the user supplied parameters.
         :param backend: the dex to use
@@ -133,55 +265,62 @@ class Swapper:
         :param _network: the chain to connect to
         :param _private_key: users wallet key
         :param _address: users wallet address
-        :return: Uniswap, None
+        :return: PreflightUniswap, None
         """
         factory_contract_addr = None
         router_contract_addr = None
 
-        with open('data/dex_contracts.json', 'r') as dex_f:
-            dexes = json.load(dex_f)
-            for dex in dexes.get('dex_map'):
-                for k, v in dex.items():
-                    if k == backend:
-                        versions = v.get('versions')
-                        for version in versions:
-                            for _k, _v in version.items():
-                                if str(_version) == _k:
-                                    for kk in _v:
-                                        for kkk, vvv in kk.items():
-                                            if kkk == 'networks':
-                                                for n in vvv:
-                                                    if n == _network:
-                                                        factory_contract_addr = kk.get('factory')
-                                                        router_contract_addr = kk.get('router')
+        for deployment in dex_contracts(_network):
+            if deployment['dex'] == backend and deployment['version'] == int(_version):
+                factory_contract_addr = deployment['factory']
+                router_contract_addr = deployment['router']
         if router_contract_addr and factory_contract_addr:
-            return Uniswap(address=_address, private_key=_private_key, version=_version, provider=provider,
-                           factory_contract_addr=to_checksum_address(factory_contract_addr),
-                           router_contract_addr=to_checksum_address(router_contract_addr),
-                           web3=self.w3)
+            return PreflightUniswap(address=_address, private_key=_private_key, version=_version,
+                                    provider=provider,
+                                    factory_contract_addr=to_checksum_address(factory_contract_addr),
+                                    router_contract_addr=to_checksum_address(router_contract_addr),
+                                    web3=self.w3, preflight=self.preflight, bundler=self.bundler)
         return None
 
-    def poll_tx_for_receipt(self, tx_hash: hex) -> (dict, bool):
+    def poll_tx_for_receipt(self, tx_hash: hex, timeout: float = 100.0) -> (dict, bool):
         """
         Given a txid hash, query chain until tx confirms and return True.
-        If not confirmed in 100 seconds, something is wrong, return False.
+        If not confirmed in `timeout` seconds, something is wrong, return False.
+        On a websocket provider the receipt is checked on every new head instead of once a second.
         :param tx_hash: hex txid
+        :param timeout: seconds to wait in total
         :return: bool
         """
+        new_head = None
+        sub_id = None
+        if isinstance(self.w3.provider, PersistentWebsocketProvider):
+            new_head = threading.Event()
+            sub_id = self.w3.provider.subscribe_new_heads(lambda head: new_head.set())
         poll = 0
-        while True:
-            if poll > 100:
-                break
-            poll += 1
-            self._print.normal(f'Polling for receipt: {poll}/100 ... ')
-            try:
-                receipt = self.w3.eth.get_transaction_receipt(tx_hash)
-            except TransactionNotFound:
-                time.sleep(1)
-            else:
-                receipt = receipt.__dict__
-                pprint.pprint(receipt)
-                return receipt
+        deadline = time.time() + timeout
+        try:
+            while True:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                poll += 1
+                self._print.normal(f'Polling for receipt: {poll}, {int(remaining)}s left ... ')
+                try:
+                    receipt = self.w3.eth.get_transaction_receipt(tx_hash)
+                except TransactionNotFound:
+                    if new_head is not None:
+                        new_head.wait(timeout=min(15, remaining))
+                        new_head.clear()
+                    else:
+                        time.sleep(1)
+                else:
+                    receipt = receipt.__dict__
+                    if self.debug_mode:
+                        self._print.data(receipt, 'Receipt:')
+                    return receipt
+        finally:
+            if sub_id is not None:
+                self.w3.provider.unsubscribe(sub_id)
         return False
 
     def balance(self, input_token: (str, ChecksumAddress), _address: (str, ChecksumAddress, None) = None) -> float:
@@ -199,8 +338,7 @@ class Swapper:
         if self.known.get(self.native_assets) == input_token:
             balance = self.w3.eth.get_balance(to_checksum_address(_address))
         else:
-            contract = self.w3.eth.contract(to_checksum_address(input_token), abi=lib.abi_lib.EIP20_ABI)
-            balance = contract.functions.balanceOf(to_checksum_address(_address)).call()
+            balance = self.erc20.balance_of(to_checksum_address(input_token), _address)
         return balance
 
     def parse_contract(self, contract_address: (str, ChecksumAddress)) -> (str, int):
@@ -215,22 +353,24 @@ class Swapper:
                     local = True
         if not token_address:
             token_address = to_checksum_address(contract_address)
-        try:
-            this_contract = self.w3.eth.contract(token_address, abi=lib.abi_lib.EIP20_ABI)
-        except web3.exceptions.NameNotFound:
-            self._print.error(f'Invalid Contract Address: {contract_address} or symbol alias is not known locally. '
-                              f'See docs for more info.')
-            return False
+        if self.known.get(self.native_assets) == token_address:
+            _symbol = self.native_assets
+            _decimals = 18
+        elif self.tokens.meta(token_address).get('decimals') is not None:
+            # imported from a token list, already validated on chain
+            _symbol = self.tokens.meta(token_address).get('symbol')
+            _decimals = self.tokens.meta(token_address)['decimals']
         else:
-            if self.known.get(self.native_assets) == token_address:
-                _symbol = self.native_assets
-                _decimals = 18
-            else:
-                _symbol = this_contract.functions.symbol().call()
-                _decimals = this_contract.functions.decimals().call()
-                if not local:
-                    self._print.normal('Adding contract address to local db ... ')
-                    self.add_known_contract(ChecksumAddress(token_address), _symbol)
+            try:
+                _symbol = self.erc20.symbol(token_address)
+                _decimals = self.erc20.decimals(token_address)
+            except NotAContract:
+                self._print.error(f'Invalid Contract Address: {contract_address} or symbol alias is not known '
+                                  f'locally. See docs for more info.')
+                return False
+            if not local:
+                self._print.normal('Adding contract address to local db ... ')
+                self.add_known_contract(ChecksumAddress(token_address), _symbol)
         return _symbol, _decimals
 
     def verify(self, input_token: (str, ChecksumAddress), output_token: (str, ChecksumAddress)) -> (tuple, bool):
@@ -254,15 +394,20 @@ class Swapper:
             else:
                 if self.known.get(output_token):
                     output_token = to_checksum_address(self.known.get(output_token))
-                out_symbol, out_decimals = self.parse_contract(output_token)
-                input_symbol, input_decimals = self.parse_contract(input_token)
+                out_parsed = self.parse_contract(output_token)
+                input_parsed = self.parse_contract(input_token)
+                if not out_parsed or not input_parsed:
+                    return False
+                out_symbol, out_decimals = out_parsed
+                input_symbol, input_decimals = input_parsed
 
                 return input_symbol, input_decimals, input_token, output_token, out_symbol, out_decimals
 
     def quote_v3(self, input_token: (str, ChecksumAddress), output_token: (str, ChecksumAddress),
                  out_decimals: int, raw_qty: int = 0, fee: int = 3000) -> (float, bool):
         """
-        Quote function for Uniswap v3. See documentation of Swapper.quote()
+        Quote function for Uniswap v3. See documentation of Swapper.quote(). Simulated locally against the
+        pool's ticks at the latest block (lib/v3_pool.py), the on chain quoter is only the fallback.
         :param raw_qty:
         :param out_decimals:
         :param output_token:
@@ -270,17 +415,24 @@ class Swapper:
         :param fee: Optional liquidity pool fee. Uniswap will usually correctly assume this for us.
         :return: (float, bool)
         """
+        raw_amount = None
         try:
-            raw_amount = self.uniswap.get_price_input(input_token, output_token, raw_qty, fee=fee)
-        except ContractLogicError as err:
-            print(type(err))
-            self._print.error(f'Error: execution reverted with: {err}')
-            return False
-        else:
-            amount = raw_amount / 10 ** out_decimals
-            self._print.normal(f'Amount: {amount}, Raw: {raw_amount}')
+            self.v3_pools.new_block(self.w3.eth.block_number)
+            raw_amount = self.v3_pools.quote_exact_input(self.v3_token(input_token), self.v3_token(output_token),
+                                                         raw_qty, fee=fee)
+        except (ValueError, ContractLogicError) as err:
+            self._print.warning(f'Local v3 simulation failed ({err}), asking the quoter.')
+        if raw_amount is None:
+            try:
+                raw_amount = self.uniswap.get_price_input(input_token, output_token, raw_qty, fee=fee)
+            except ContractLogicError as err:
+                self._print.error(f'Error: execution reverted with: {err}')
+                return False
+        self.last_quote_raw = raw_amount
+        amount = raw_amount / 10 ** out_decimals
+        self._print.normal(f'Amount: {amount}, Raw: {raw_amount}')
 
-            return amount
+        return amount
 
     def quote_v2(self, input_token: (str, ChecksumAddress), output_token: (str, ChecksumAddress),
                  out_decimals: int, raw_qty: int) -> (float, bool):
@@ -295,6 +447,7 @@ class Swapper:
             self._print.error(f'Error: execution reverted with: {err}')
             return False
         else:
+            self.last_quote_raw = raw_amount
             amount = raw_amount / 10 ** out_decimals
             self._print.normal(f'Amount: {amount}, Raw: {raw_amount}')
 
@@ -364,17 +517,23 @@ class Swapper:
                 else:
                     output_token = output_token.upper()
 
-        input_symbol, input_decimals, input_token, output_token, out_symbol, out_decimals = self.verify(input_token,
-                                                                                                        output_token)
+        verified = self.verify(input_token, output_token)
+        if not verified:
+            return False
+        input_symbol, input_decimals, input_token, output_token, out_symbol, out_decimals = verified
         if self.debug_mode:
             self._print.debug('Verify: %s %s %s %s %s %s' % (input_symbol, input_decimals, input_token, output_token, out_symbol, out_decimals))
+        in_fee, out_fee = self.transfer_fees(input_token, output_token)
+        if (in_fee or out_fee) and not fee_on_transfer:
+            self._print.warning('Fee on transfer token detected, using SupportingFeeOnTransfer swap.')
+            fee_on_transfer = True
         _qty = 0
         if raw_qty > 0:
             _qty = raw_qty
         if float_qty > 0:
             _qty = float_qty * 10 ** input_decimals
 
-        if float_qty == 0.0:
+        if float_qty == 0.0 and raw_qty == 0:
             bal = self.balance(input_token, self.account.address)
             _qty = bal
             self._print.normal(f'Qty is Full Balance: {bal / 10 ** input_decimals}')
@@ -384,23 +543,63 @@ class Swapper:
                            out_symbol=out_symbol, out_decimals=out_decimals)
         if not quote:
             return False
-        else:
-            if _quote_only:
-                return quote
+        if in_fee or out_fee:
+            self.last_quote_raw = int(self.last_quote_raw * (1 - in_fee) * (1 - out_fee))
+            quote = quote * (1 - in_fee) * (1 - out_fee)
+            self._print.normal(f'Quote after transfer fees: {quote}')
+        if _quote_only:
+            return quote
+        self.last_trade = {'network': self.network, 'input': input_token, 'output': output_token,
+                           'in_decimals': input_decimals, 'out_decimals': out_decimals,
+                           'quote_raw': self.last_quote_raw}
         self._print.normal(f'Quote is {quote}')
         if not no_prompt:
 
+            self._print.flush()
             prompt = input('>> Accept? y/n: ')
             if prompt == 'y':
-                return self.uniswap.make_trade(input_token, output_token, _qty, recipient=recipient,
-                                               fee_on_transfer=fee_on_transfer)
+                return self.execute_trade(input_token, output_token, _qty, recipient, fee_on_transfer)
             else:
                 self._print.warning('Canceled by user.')
                 return 2
         else:
             self._print.warning('Prompt confirm quote disabled, firing away  .. ')
-            return self.uniswap.make_trade(input_token, output_token, _qty, recipient=recipient,
+            return self.execute_trade(input_token, output_token, _qty, recipient, fee_on_transfer)
+
+    def report_fill(self, receipt: dict) -> (dict, None):
+        """
+        Decode what the last swap actually did from its receipt logs, print it and add it to the
+        trade journal (trades.jsonl in the data directory). See lib/receipts.py
+        :return: the fill report
+        """
+        if not receipt or self.last_trade is None:
+            return None
+        report = fill_report(receipt, self.account.address, self.last_trade)
+        self._print.data(report, 'Fill:')
+        self.journal.append(report)
+        return report
+
+    def execute_trade(self, input_token: str, output_token: str, _qty: int, recipient: (str, None),
+                      fee_on_transfer: bool) -> (bool, hex):
+        """
+        Send the trade through the dex backend. Unless preflight is disabled the swap transaction is
+        first simulated and dropped if its output is more than max_slippage below the last quote.
+        With a relay the swap and any approval it needs go out together as one private bundle.
+        :return: (bool, hex txid)
+        """
+        if self.preflight is not None:
+            self.uniswap.expect(self.last_quote_raw, output_token, recipient)
+        try:
+            return self.uniswap.make_trade(input_token, output_token, int(_qty), recipient=recipient,
                                            fee_on_transfer=fee_on_transfer)
+        except PreflightError as err:
+            self._print.error(f'Preflight failed, transaction not sent: {err}')
+            return False
+        except BundleError as err:
+            self._print.error(f'Bundle failed: {err}')
+            return False
+        finally:
+            self.uniswap.expectation = None
 
 
 if __name__ == '__main__':
@@ -417,6 +616,20 @@ if __name__ == '__main__':
     args.add_argument('-b', '--backend', type=str, choices=['sushiswap', 'uniswap', 'kyberswap'], default='uniswap',
                       help='Dex to connect to.')
     args.add_argument('-d', '--debug', action='store_true', help='Enable some developer features.')
+    args.add_argument('-O', '--output', dest='output_mode', choices=['human', 'json'], default='human',
+                      help='Human readable output or one JSON object per line.')
+    args.add_argument('--quiet', action='store_true', help='Only print errors.')
+    args.add_argument('--record', dest='record_cassette', type=str, default=None,
+                      help='Record every rpc request and response to this cassette file.')
+    args.add_argument('--replay', dest='replay_cassette', type=str, default=None,
+                      help='Replay a recorded cassette offline instead of using the network.')
+    args.add_argument('--replay-loose', dest='replay_loose', action='store_true',
+                      help='On replay, answer a request that was never recorded with the next recorded answer '
+                           'of the same method instead of failing (swap deadlines change between runs).')
+    args.add_argument('--relay', dest='relay_url', type=str, default=os.environ.get('bundle_relay'),
+                      help='Send transactions as a private bundle to this relay instead of the public mempool.')
+    args.add_argument('--relay-blocks', dest='relay_blocks', type=int, default=3,
+                      help='Blocks a bundle targets at once.')
     subparsers = args.add_subparsers(dest='command')
     cmd_quote = subparsers.add_parser('quote', help='Get a quote for a given swap.')
     cmd_quote.add_argument('-i', '--input', dest='input_token', type=str,
@@ -439,14 +652,134 @@ if __name__ == '__main__':
                           help='Use SupportingFeeOnTransfer swap')
     cmd_swap.add_argument('-n', '--no_prompt', dest='no_prompt', action='store_true',
                           help='Do not prompt to confirm quote.')
+    cmd_swap.add_argument('-s', '--max-slippage', dest='max_slippage', type=float, default=0.5,
+                          help='Refuse to broadcast if the simulated output is more than this percent below '
+                               'the quote.')
+    cmd_swap.add_argument('-np', '--no-preflight', dest='no_preflight', action='store_true',
+                          help='Skip the eth_call simulation before broadcasting.')
+
+    cmd_watch = subparsers.add_parser('watch', help='Watch the mempool for router swaps of some tokens.')
+    cmd_watch.add_argument('-t', '--tokens', nargs='+', required=True, help='Contract addresses or known symbols.')
+    cmd_watch.add_argument('-p', '--poll', dest='poll_interval', type=float, default=None,
+                           help='Poll txpool_content every N seconds instead of subscribing over a websocket.')
+
+    cmd_arb = subparsers.add_parser('arb', help='Scan the v2 pools of every configured dex for arbitrage cycles.')
+    cmd_arb.add_argument('-t', '--tokens', nargs='*', default=None,
+                         help='Contract addresses or known symbols, all known tokens by default.')
+    cmd_arb.add_argument('-m', '--min-profit', dest='min_profit', type=float, default=0.0,
+                         help='Only report cycles that net more than this much WETH after gas.')
+    cmd_arb.add_argument('--top', type=int, default=10, help='Opportunities to print per block.')
+    cmd_arb.add_argument('--no-triangles', dest='no_triangles', action='store_true',
+                         help='Only compare two pools of the same pair.')
+    cmd_arb.add_argument('--once', action='store_true', help='Scan the latest block and exit.')
+
+    cmd_twap = subparsers.add_parser('twap', help='Sell a quantity in slices over time or blocks.')
+    cmd_twap.add_argument('-i', '--input', dest='input_token', type=str, help='Contract address or known token symbol.')
+    cmd_twap.add_argument('-o', '--output', dest='output_token', type=str,
+                          help='Contract address or known token symbol.')
+    cmd_twap.add_argument('-q', '--quantity', dest='quantity', type=float, default=0.0, help='Float quantity.')
+    cmd_twap.add_argument('-R', '--raw_quantity', dest='raw_quantity', type=int, default=0, help='Raw quantity.')
+    cmd_twap.add_argument('--slices', type=int, default=10, help='Number of child swaps.')
+    cmd_twap.add_argument('-e', '--every', type=int, default=60, help='Seconds (or blocks) between slices.')
+    cmd_twap.add_argument('--blocks', action='store_true', help='Interval is in blocks instead of seconds.')
+    cmd_twap.add_argument('-l', '--limit', dest='limit_price', type=float, default=None,
+                          help='Skip slices while the price is below this much output per input.')
+    cmd_twap.add_argument('-P', '--participation', type=float, default=None,
+                          help='Cap each slice to this percent of the pool volume since the previous slice.')
+    cmd_twap.add_argument('--resume', action='store_true', help='Only run the active orders in the journal.')
+    cmd_twap.add_argument('--list', dest='list_orders', action='store_true', help='Print the order journal.')
+    cmd_twap.add_argument('--cancel', dest='cancel_id', type=str, default=None, help='Cancel an order by id.')
+
+    cmd_orders = subparsers.add_parser('orders', help='Limit and stop orders checked every block.')
+    cmd_orders.add_argument('action', choices=['add', 'list', 'cancel', 'run'], help='What to do.')
+    cmd_orders.add_argument('-i', '--input', dest='input_token', type=str, help='Token to sell.')
+    cmd_orders.add_argument('-o', '--output', dest='output_token', type=str, help='Token to buy.')
+    cmd_orders.add_argument('-q', '--quantity', dest='quantity', type=float, default=0.0, help='Float quantity.')
+    cmd_orders.add_argument('-R', '--raw_quantity', dest='raw_quantity', type=int, default=0, help='Raw quantity.')
+    cmd_orders.add_argument('-t', '--type', dest='order_kind', choices=['limit', 'stop'], default='limit',
+                            help='limit sells at or above the price, stop at or below it.')
+    cmd_orders.add_argument('-p', '--price', dest='trigger_price', type=float,
+                            help='Trigger price, output per input.')
+    cmd_orders.add_argument('--id', dest='order_id', type=int, help='Order id to cancel.')
+
+    cmd_approve = subparsers.add_parser('approve-all', help='Approve every router (and 0x) for a list of tokens.')
+    cmd_approve.add_argument('-t', '--tokens', nargs='*', default=None,
+                             help='Contract addresses or known symbols, all known tokens by default.')
+    cmd_approve.add_argument('-s', '--spenders', nargs='*', default=[], help='Extra spender addresses.')
+    cmd_approve.add_argument('--no-zrx', dest='no_zrx', action='store_true', help='Do not approve the 0x proxy.')
+    cmd_approve.add_argument('-R', '--raw_quantity', dest='raw_quantity', type=int, default=0,
+                             help='Raw allowance, unlimited by default.')
+    cmd_approve.add_argument('--check', action='store_true', help='Only list the approvals that are missing.')
+    cmd_approve.add_argument('--wait', action='store_true', help='Wait for the approvals to confirm.')
+
+    cmd_depth = subparsers.add_parser('depth', help='Simulated v3 output for several sizes across fee tiers.')
+    cmd_depth.add_argument('-i', '--input', dest='input_token', type=str, required=True,
+                           help='Contract address or known token symbol.')
+    cmd_depth.add_argument('-o', '--output', dest='output_token', type=str, required=True,
+                           help='Contract address or known token symbol.')
+    cmd_depth.add_argument('-q', '--quantities', dest='quantities', type=float, nargs='+', required=True,
+                           help='Float input quantities.')
+
+    cmd_wallets = subparsers.add_parser('wallets', help='Run one operation across every wallet in a directory.')
+    cmd_wallets.add_argument('action', choices=['list', 'approve', 'sweep', 'swap'], help='What to do.')
+    cmd_wallets.add_argument('-D', '--dir', dest='wallet_dir', type=str, default='keys',
+                             help='Directory of json wallets and encrypted keystores.')
+    cmd_wallets.add_argument('-P', '--password', dest='ask_password', action='store_true',
+                             help='Prompt for the keystore password instead of reading `keystore_password` from .env')
+    cmd_wallets.add_argument('-t', '--tokens', nargs='*', default=[], help='Tokens to approve or sweep.')
+    cmd_wallets.add_argument('-s', '--spenders', nargs='*', default=[],
+                             help='Spenders to approve, every router of the network by default.')
+    cmd_wallets.add_argument('--to', dest='sweep_to', type=str, help='Where to sweep to.')
+    cmd_wallets.add_argument('--native', action='store_true', help='Also sweep the native asset.')
+    cmd_wallets.add_argument('-i', '--input', dest='input_token', type=str, help='Token to sell.')
+    cmd_wallets.add_argument('-o', '--output', dest='output_token', type=str, help='Token to buy.')
+    cmd_wallets.add_argument('-q', '--quantity', dest='quantity', type=float, default=0.0,
+                             help='Float quantity per wallet, its whole balance if not given.')
+    cmd_wallets.add_argument('--slippage', type=float, default=0.5, help='Max slippage percent of swaps.')
+    cmd_wallets.add_argument('--wait', action='store_true', help='Wait for the transactions to confirm.')
+
+    cmd_import = subparsers.add_parser('import-tokens',
+                                       help='Add a token list (tokenlists.org format) to the local db.')
+    cmd_import.add_argument('source', help='Path or url of the token list.')
+    cmd_import.add_argument('--chunk-size', dest='chunk_size', type=int, default=500, help='Calls per multicall.')
+    cmd_import.add_argument('--workers', type=int, default=4, help='Multicalls in flight at once.')
+    cmd_import.add_argument('--dry-run', dest='dry_run', action='store_true',
+                            help='Validate and report without writing the db.')
+
+    cmd_history = subparsers.add_parser('history', help='Balance changes of a wallet over a range of blocks.')
+    cmd_history.add_argument('-t', '--tokens', nargs='*', default=[],
+                             help='Tokens to follow, the native asset if none are given.')
+    cmd_history.add_argument('-a', '--address', dest='history_address', type=str, default=None,
+                             help='Wallet to follow, ours by default.')
+    cmd_history.add_argument('--start', type=int, default=None, help='First block, --days before --end by default.')
+    cmd_history.add_argument('--end', type=int, default=None, help='Last block, the latest by default.')
+    cmd_history.add_argument('--days', type=float, default=30.0, help='Length of the range when --start is not given.')
+    cmd_history.add_argument('--step', type=int, default=None,
+                             help='Blocks between samples, about a day by default. Round trips inside one are missed.')
 
     qty = 0
     private_key = None
     address = None
     quote_only = False
     args = args.parse_args()
+    style.configure(mode=args.output_mode, quiet=args.quiet)
 
-    if not args.wallet_file:
+    wallet_keys = None
+    if args.command == 'wallets':
+        password = os.environ.get('keystore_password')
+        if args.ask_password:
+            password = getpass.getpass('Keystore password: ')
+        wallet_keys = load_wallet_dir(args.wallet_dir, password)
+        if not wallet_keys:
+            s.error(f'No wallets in {args.wallet_dir}')
+            exit(1)
+        s.good(f'Loaded {len(wallet_keys)} wallets from {args.wallet_dir}')
+        # the first one drives the swapper, the operation itself runs on all of them
+        address, private_key = wallet_keys[0]
+        args.private_key = None
+    if wallet_keys is not None:
+        wallet_file = None
+    elif not args.wallet_file:
         wallet_file = os.environ.get('default_wallet_location')
     else:
         wallet_file = args.wallet_file
@@ -466,16 +799,28 @@ if __name__ == '__main__':
         address = web3.Web3.eth.account.from_key(private_key).address
         s.good(f'Private key specified from CLI for account {address} ')
     if not private_key or not address:
-        print('Either specify the location of your json wallet file or a private key string. See docs.')
+        s.error('Either specify the location of your json wallet file or a private key string. See docs.')
         exit(1)
+    if args.record_cassette and args.replay_cassette:
+        s.error('Either record or replay a cassette, not both.')
+        exit(1)
+    cassette = None
+    if args.record_cassette or args.replay_cassette:
+        cassette = Cassette(args.record_cassette or args.replay_cassette,
+                            mode='record' if args.record_cassette else 'replay', strict=not args.replay_loose)
     s.normal(f'Selected Uniswap version: {args.uniswap_version}')
     s.normal(f'Network is: {args.network_name}')
 
     uni = Swapper(private_key, address, version=int(args.uniswap_version), network=args.network_name,
-                  backend=args.backend, debug=args.debug)
+                  backend=args.backend, debug=args.debug,
+                  max_slippage=getattr(args, 'max_slippage', 0.5) / 100,
+                  preflight=not getattr(args, 'no_preflight', False), cassette=cassette,
+                  relay=args.relay_url, relay_blocks=args.relay_blocks)
     if uni.uniswap is None:
-        print('Uniswap not configured successfully , exiting')
+        s.error('Uniswap not configured successfully , exiting')
         exit(1)
+    if args.debug:
+        atexit.register(lambda: s.debug(f'Read cache: {uni.read_cache.report()}'))
 
     if args.command == 'swap' or args.command == 'quote':
         if args.quantity and args.raw_quantity:
@@ -505,14 +850,199 @@ if __name__ == '__main__':
         if txid == 2:
             exit(0)
         if type(txid) is float:
+            s.data({'input': args.input_token, 'output': args.output_token, 'quote': txid,
+                    'quote_raw': uni.last_quote_raw}, 'Quote:')
             exit(0)
         else:
-            print(txid)
+            s.debug(txid)
             if txid:
                 tx_hex = to_hex(txid)
                 s.good(f'TXID: {tx_hex} found, polling ...')
-                uni.poll_tx_for_receipt(tx_hex)
+                uni.report_fill(uni.poll_tx_for_receipt(tx_hex))
             else:
                 s.error('Some Error Occurred.')
+    elif args.command == 'watch':
+        watcher = MempoolWatcher(uni.w3, args.network_name, [uni.resolve_token(t) for t in args.tokens])
+        try:
+            if args.poll_interval:
+                watcher.run_polling(interval=args.poll_interval)
+            else:
+                watcher.run_subscription()
+        except KeyboardInterrupt:
+            s.normal(f'Mempool stats: {watcher.stats}')
+    elif args.command == 'twap':
+        scheduler = TwapScheduler(uni)
+        if args.list_orders:
+            s.data(scheduler.journal.orders, 'Orders:')
+            exit(0)
+        if args.cancel_id:
+            if scheduler.cancel(args.cancel_id):
+                s.good(f'Cancelled order {args.cancel_id}')
+            else:
+                s.error(f'No active order {args.cancel_id}')
+            exit(0)
+        if not args.resume:
+            if not args.input_token or not args.output_token:
+                s.error('Specify the input and output tokens.')
+                exit(1)
+            input_token = uni.resolve_token(args.input_token)
+            total = args.raw_quantity or int(args.quantity * 10 ** uni.erc20.decimals(input_token))
+            order_id = scheduler.submit(input_token, uni.resolve_token(args.output_token), total, args.slices,
+                                        args.every, unit='blocks' if args.blocks else 'seconds',
+                                        limit_price=args.limit_price,
+                                        max_participation=args.participation / 100 if args.participation else None)
+            s.good(f'Order {order_id} added to the journal.')
+        try:
+            asyncio.run(scheduler.run())
+        except KeyboardInterrupt:
+            s.warning('Stopped, active orders stay in the journal. Resume with `twap --resume`.')
+    elif args.command == 'orders':
+        book = OrderBook()
+        if args.action == 'add':
+            if not args.input_token or not args.output_token or args.trigger_price is None:
+                s.error('Specify the input and output tokens and a trigger price.')
+                exit(1)
+            input_token = uni.resolve_token(args.input_token)
+            output_token = uni.resolve_token(args.output_token)
+            in_decimals = uni.erc20.decimals(input_token)
+            amount = args.raw_quantity or int(args.quantity * 10 ** in_decimals)
+            order_id = book.add(args.network_name, input_token, output_token, in_decimals,
+                                uni.erc20.decimals(output_token), amount, args.order_kind, args.trigger_price)
+            s.good(f'Added {args.order_kind} order {order_id}')
+        elif args.action == 'list':
+            s.data(book.orders(network=args.network_name), 'Orders:')
+        elif args.action == 'cancel':
+            if book.cancel(args.order_id):
+                s.good(f'Cancelled order {args.order_id}')
+            else:
+                s.error(f'No open order {args.order_id}')
+        else:
+            engine = LimitOrderEngine(uni, book)
+            try:
+                engine.run()
+            except KeyboardInterrupt:
+                s.normal(f'Limit orders: {engine.stats}')
+    elif args.command == 'approve-all':
+        tokens = [uni.resolve_token(t) for t in (args.tokens or uni.known.values())
+                  if uni.resolve_token(t) != '0x0000000000000000000000000000000000000000']
+        spenders = default_spenders(args.network_name, zrx=not args.no_zrx) + \
+            [to_checksum_address(x) for x in args.spenders]
+        approvals = ApprovalManager(uni.w3, uni.account, multicall=uni.chain.get('multicall3'), bundler=uni.bundler)
+        amount = args.raw_quantity or MAX_UINT256
+        if args.check:
+            s.data([{'token': t, 'spender': x} for t, x in approvals.missing(tokens, spenders, amount)],
+                   'Missing approvals:')
+        else:
+            approvals.approve_all(tokens, spenders, amount, wait=args.wait)
+    elif args.command == 'depth':
+        if uni.version != 3:
+            s.error('Depth curves simulate v3 pools, run with `-uv 3`.')
+            exit(1)
+        input_token = uni.v3_token(uni.resolve_token(args.input_token))
+        output_token = uni.v3_token(uni.resolve_token(args.output_token))
+        in_decimals, out_decimals = uni.erc20.decimals(input_token), uni.erc20.decimals(output_token)
+        uni.v3_pools.new_block(uni.w3.eth.block_number)
+        curve = uni.v3_pools.depth(input_token, output_token, [int(q * 10 ** in_decimals) for q in args.quantities])
+        s.data([{'amount_in': p['amount_in'] / 10 ** in_decimals, 'amount_out': p['amount_out'] / 10 ** out_decimals,
+                 'fee': p['fee']} for p in curve], 'Depth:')
+    elif args.command == 'import-tokens':
+        chain_id = uni.chain.get('chain_id') or uni.w3.eth.chain_id
+        listed = load_token_list(args.source, chain_id=chain_id)
+        s.normal(f'{len(listed)} tokens listed for chain {chain_id}, validating ...')
+        importer = TokenListImporter(uni.w3, uni.tokens, multicall=uni.chain.get('multicall3'),
+                                     chunk_size=args.chunk_size, max_workers=args.workers)
+        report = importer.run(listed, dry_run=args.dry_run)
+        for entry in report['rejected']:
+            s.debug(f'Rejected {entry["symbol"]} {entry["address"]}: {entry["reason"]}')
+        for symbol, alias, token in report['renamed']:
+            s.normal(f'{symbol} is taken, added {token} as {alias}')
+        s.data({k: len(v) if isinstance(v, list) else v for k, v in report.items()},
+               'Dry run:' if args.dry_run else 'Imported:')
+    elif args.command == 'history':
+        blocks_per_day = int(86400 / (uni.chain.get('block_time') or 12))
+        end = args.end or uni.w3.eth.block_number
+        start = args.start if args.start is not None else max(0, end - int(args.days * blocks_per_day))
+        tokens = [uni.resolve_token(t) for t in (args.tokens or [uni.native_assets])]
+        decimals = {t: 18 if t.lower() in NATIVE_ADDRESSES else uni.erc20.decimals(t) for t in tokens}
+        symbols = {to_checksum_address(v): k for k, v in uni.known.items()}
+        history = BalanceHistory(uni.w3, uni.chain.get('chain_id') or uni.w3.eth.chain_id,
+                                 multicall=uni.chain.get('multicall3'))
+        try:
+            timeline = history.timeline(args.history_address or address, tokens, start, end,
+                                        args.step or blocks_per_day)
+        except ValueError as err:
+            s.error(f'Historical read failed, is this an archive node? {err}')
+            exit(1)
+        times = history.block_times([start] + [c['block'] for c in timeline['changes']])
+        s.data({symbols.get(t, t): b / 10 ** decimals[t] for t, b in timeline['start'].items()},
+               f'Balances at block {start} ({time.strftime("%Y-%m-%d %H:%M", time.gmtime(times[start]))} UTC):')
+        s.data([{'block': c['block'], 'time': time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(times[c['block']])),
+                 'token': symbols.get(c['token'], c['token']), 'before': c['before'] / 10 ** decimals[c['token']],
+                 'after': c['after'] / 10 ** decimals[c['token']],
+                 'change': (c['after'] - c['before']) / 10 ** decimals[c['token']]} for c in timeline['changes']],
+               f'{len(timeline["changes"])} changes up to block {end}:')
+        s.normal(f'History reads: {history.stats}')
+    elif args.command == 'wallets':
+        wallets = WalletSet(uni.w3, wallet_keys, multicall=uni.chain.get('multicall3'))
+        tokens = [uni.resolve_token(t) for t in args.tokens]
+        fees = None
+        if args.action == 'list':
+            balances = wallets.native_balances()
+            token_balances = wallets.token_balances(tokens) if tokens else {}
+            s.data([dict({'wallet': w, uni.native_assets: b / 10 ** 18},
+                         **{t: token_balances[(w, t)] for t in tokens}) for w, b in balances.items()], 'Wallets:')
+            exit(0)
+        if args.action == 'approve':
+            spenders = [to_checksum_address(x) for x in args.spenders] or default_spenders(args.network_name)
+            plans = wallets.approve_plans(tokens, spenders)
+        elif args.action == 'sweep':
+            if not args.sweep_to:
+                s.error('Specify where to sweep to with --to.')
+                exit(1)
+            fees = fee_params(uni.w3)
+            plans = wallets.sweep_plans(args.sweep_to, tokens, native=args.native, fees=fees)
+        else:
+            if uni.version != 2 or not args.input_token or not args.output_token:
+                s.error('Wallet swaps need the input and output tokens and a v2 router (`-uv 2`).')
+                exit(1)
+            input_token, output_token = uni.resolve_token(args.input_token), uni.resolve_token(args.output_token)
+            native_in = input_token.lower() in NATIVE_ADDRESSES
+            if args.quantity:
+                decimals = 18 if native_in else uni.erc20.decimals(input_token)
+                amounts = {w: int(args.quantity * 10 ** decimals) for w in wallets.addresses}
+            elif native_in:
+                s.error('Give a quantity when selling the native asset, gas has to be left in each wallet.')
+                exit(1)
+            else:
+                amounts = {w: b for (w, _), b in wallets.token_balances([input_token]).items()}
+            plans = wallets.swap_plans(uni.uniswap.router, uni.uniswap.get_weth_address(), input_token,
+                                       output_token, amounts, slippage=args.slippage / 100)
+        s.normal(f'{sum(len(p) for p in plans.values())} transactions across '
+                 f'{sum(1 for p in plans.values() if p)} wallets.')
+        signed = wallets.sign(wallets.build(plans, fees))
+        sent = wallets.send_bundle(signed, uni.bundler) if uni.bundler else wallets.send(signed)
+        s.data([{'wallet': w, 'txid': txid, 'error': err} for w, txid, err in sent], 'Sent:')
+        if args.wait and sent:
+            statuses = wallets.wait(sent)
+            s.data({'confirmed': sum(1 for x in statuses.values() if x == 1),
+                    'failed': [t for t, x in statuses.items() if x != 1],
+                    'pending': len(sent) - len(statuses)}, 'Receipts:')
+    elif args.command == 'arb':
+        tokens = args.tokens or list(uni.known.values())
+        scanner = ArbitrageScanner(uni.w3, args.network_name, [uni.resolve_token(t) for t in tokens],
+                                   uni.uniswap.get_weth_address(),
+                                   symbols={v: k for k, v in uni.known.items()},
+                                   triangular=not args.no_triangles)
+        s.normal(f'{scanner.discover()} candidate cycles over {len(scanner.pools)} pools.')
+        min_profit_wei = int(args.min_profit * 10 ** 18)
+        if args.once:
+            found = scanner.scan(min_profit_wei=min_profit_wei)
+            s.data(found[:args.top], f'{len(found)} opportunities:')
+            s.normal(f'Arbitrage scan: {scanner.stats}')
+        else:
+            try:
+                scanner.run(top=args.top, min_profit_wei=min_profit_wei, block_time=uni.chain.get('block_time'))
+            except KeyboardInterrupt:
+                s.normal(f'Arbitrage scan: {scanner.stats}')
     else:
-        print('[?] No command given. Please run %s --help' % sys.argv[0])
+        s.warning('No command given. Please run %s --help' % sys.argv[0])
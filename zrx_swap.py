@@ -3,7 +3,6 @@
 import argparse
 import json
 import os
-import pprint
 import time
 
 import dotenv
@@ -13,6 +12,18 @@ from web3.middleware import geth_poa_middleware
 
 import lib.abi_lib
 from lib import style
+from lib.multi_provider import endpoints_from_env, make_http_provider
+from lib.erc20 import Erc20Reader
+from lib.preflight import Preflight
+from lib.pyswap_exceptions import PreflightError
+from lib import chain_profile
+from lib.limit_orders import OrderBook, LimitOrderEngine
+from lib.approvals import ApprovalManager, MAX_UINT256
+from lib.receipts import NATIVE_ADDRESSES, TradeJournal, fill_report
+from lib.cassette import Cassette, CassetteAdapter, CassetteProvider
+from lib.read_cache import BlockReadCache
+from lib.bundles import BundleRelay, BundleSubmitter
+from lib.pyswap_exceptions import BundleError
 
 # Hacky fix because I was using the beta web3 which has clumsy backward compatibility issues
 try:
@@ -33,16 +44,32 @@ dotenv.load_dotenv()
 
 
 class ZeroX:
-    def __init__(self, network: str, no_prompt=False, privkey_str: str = None, wallet_file: str = None):
+    def __init__(self, network: str, no_prompt=False, privkey_str: str = None, wallet_file: str = None,
+                 max_slippage: float = 0.005, pool_size: int = None, cassette: Cassette = None,
+                 bundler: BundleSubmitter = None):
         self._print = style.PrettyText()
         self.network = network
+        self.pool_size = pool_size
+        self.cassette = cassette
+        self.bundler = bundler
         self.endpoint = None
         self.abi = None
+        self.chain = {}
         self.w3 = self.setup_w3()
+        self.erc20 = Erc20Reader(self.w3)
+        self.preflight = Preflight(self.w3, max_slippage=max_slippage)
         self.exchange_router = '0xDef1C0ded9bec7F1a1670819833240f027b25EfF'
         self.no_prompt = no_prompt
 
         self._session = requests.session()
+        if cassette is not None:
+            # 0x api calls go through the same cassette as the rpc
+            adapter = CassetteAdapter(cassette)
+            self._session.mount('http://', adapter)
+            self._session.mount('https://', adapter)
+        self._approvals = None
+        self.last_trade = None
+        self.journal = TradeJournal()
         self.acct = None
         if privkey_str and wallet_file:
             self._print.error('Specify either a privkey str or a json wallet file, not both!')
@@ -62,34 +89,41 @@ class ZeroX:
             return priv, addr
 
     def setup_w3(self, ):
-        w3_endpoint = os.environ.get(f'{self.network}_http_endpoint')
-        self.w3 = web3.Web3(web3.HTTPProvider(w3_endpoint))
+        endpoints = endpoints_from_env(self.network)
+        w3_endpoint = ', '.join(endpoints)
+        if self.cassette is not None and self.cassette.mode == 'replay':
+            w3_endpoint = f'cassette:{self.cassette.path}'
+            provider = CassetteProvider(self.cassette)
+        else:
+            provider = make_http_provider(endpoints, pool_size=self.pool_size)
+            if self.cassette is not None:
+                provider = CassetteProvider(self.cassette, provider)
+        self.w3 = web3.Web3(provider)
         try:
-            conn = self.w3.isConnected()
-        except AttributeError:
-            conn = self.w3.is_connected()
-        finally:
-            if conn:
-                self._print.good(f"Connected to chain: {self.w3.eth.chain_id}")
-            else:
-                self._print.error(f'Web3 could connect to remote endpoint: {w3_endpoint}')
+            self.chain = chain_profile.profiles.get(endpoints, self.w3, self.network, cassette=self.cassette)
+        except (ValueError, OSError, requests.exceptions.RequestException) as err:
+            self._print.error(f'Web3 could connect to remote endpoint: {w3_endpoint}: {err}')
+            # no profile, fall back to what the network is known to need
+            self.chain = {'poa': self.network in chain_profile.POA_NETWORKS}
+        if self.chain.get('poa'):
+            self.w3.middleware_onion.inject(geth_poa_middleware, layer=0)
+        self.read_cache = BlockReadCache(head_ttl=(self.chain.get('block_time') or 12) / 4)
+        self.w3.middleware_onion.inject(self.read_cache.middleware, 'read_cache', layer=0)
         if self.network == 'ethereum':
             self.endpoint = 'https://api.0x.org/'
             self.abi = lib.abi_lib.EIP20_ABI
         elif self.network == 'polygon':
             self.endpoint = 'https://polygon.api.0x.org/'
             self.abi = lib.abi_lib.EIP20_ABI
-            self.w3.middleware_onion.inject(geth_poa_middleware, layer=0)
         elif self.network == 'bsc':
             self.abi = lib.abi_lib.BEP_ABI
-            # self.w3.middleware_onion.inject(geth_poa_middleware, layer=0)
             self.endpoint = 'https://bsc.api.0x.org/'
             self._print.warning('Connected to BSC, which has not been tested very well yet.')
         elif self.network == 'arbitrum':
             self.abi = lib.abi_lib.EIP20_ABI
             self.endpoint = 'https://arbitrum.api.0x.org/'
 
-        self._print.good(f'Web3 connected to chain: {self.w3.eth.chain_id}')
+        self._print.good(f'Web3 connected to chain: {self.chain.get("chain_id")}')
         return self.w3
 
     def balance_check(self, contract_address: str = None):
@@ -97,16 +131,17 @@ class ZeroX:
             bal = self.w3.eth.get_balance(self.acct.address)
             return bal, bal / 10 ** 18
         else:
-            contract = self.w3.eth.contract(address=to_checksum_address(contract_address),
-                                            abi=lib.abi_lib.BEP_ABI)
-            decimals = contract.functions.decimals().call()
-            balance = contract.functions.balanceOf(self.acct.address).call()
+            token = to_checksum_address(contract_address)
+            decimals = self.erc20.decimals(token)
+            balance = self.erc20.balance_of(token, self.acct.address)
             human_bal = balance / (10 ** decimals)
             return balance, human_bal
 
     def broadcast_tx(self, raw_txn: dict):
         raw_txn['nonce'] = self.w3.eth.get_transaction_count(self.acct.address)
         signed_txn = self.w3.eth.account.signTransaction(raw_txn, self.acct.key)
+        if self.bundler is not None:
+            return self.broadcast_bundle([signed_txn.rawTransaction])
         try:
             ret = self.w3.eth.send_raw_transaction(signed_txn.rawTransaction)
         except ValueError as err:
@@ -117,6 +152,20 @@ class ZeroX:
             self._print.good(f'Transaction sent okay! Txid is: {hextx}')
         return hextx
 
+    def broadcast_bundle(self, raw_txs: list):
+        """
+        Send signed transactions to the private relay as one bundle, see lib/bundles.py
+        :return: hex txid of the last one once included, or False
+        """
+        try:
+            result = self.bundler.submit(raw_txs)
+        except BundleError as err:
+            self._print.error(f'Error sending bundle: {err}')
+            return False
+        if result['included'] is None:
+            return False
+        return result['tx_hashes'][-1]
+
     def poll_receipt(self, tx_hash):
         poll = 0
         time.sleep(1)
@@ -132,36 +181,50 @@ class ZeroX:
                 time.sleep(1)
             else:
                 receipt = receipt.__dict__
-                pprint.pprint(receipt)
+                self._print.debug(f'Receipt status: {receipt.get("status")}, block: {receipt.get("blockNumber")}')
                 end = time.time()
                 elapsed = end - start
                 self._print.good(f'Confirmed in {elapsed} secs!')
                 return receipt
-        print('Timed Out!')
+        self._print.error('Timed Out!')
+
+    @property
+    def approvals(self) -> ApprovalManager:
+        if self._approvals is None:
+            self._approvals = ApprovalManager(self.w3, self.acct, multicall=self.chain.get('multicall3'))
+        # --relay sets the bundler after construction
+        self._approvals.bundler = self.bundler
+        return self._approvals
+
+    def decimals(self, token: str) -> int:
+        return 18 if token.lower() in NATIVE_ADDRESSES else self.erc20.decimals(to_checksum_address(token))
+
+    def report_fill(self, receipt: dict):
+        """
+        Decode what the last swap actually did from its receipt logs, print it and add it to the
+        trade journal (trades.jsonl in the data directory). See lib/receipts.py
+        """
+        if not receipt or self.last_trade is None:
+            return None
+        report = fill_report(receipt, self.acct.address, self.last_trade)
+        self._print.data(report, 'Fill:')
+        self.journal.append(report)
+        return report
 
     def approve(self, token, amount=0):
-        spender = self.exchange_router
-        if not amount:
-            max_amount = to_wei(2 ** 64 - 1, 'ether')
-        else:
-            max_amount = amount
-        contract = self.w3.eth.contract(to_checksum_address(token), abi=lib.abi_lib.BEP_ABI)
-        if self.network == 'bsc':
-            tx = {
-                'from': self.acct.address,
-                'nonce': self.w3.eth.get_transaction_count(self.acct.address),
-                'gas': 250000,
-                'gasPrice': self.w3.eth.gas_price
-            }
-        else:
-            tx = {
-                'from': self.acct.address,
-                'nonce': self.w3.eth.get_transaction_count(self.acct.address),
-                'gas': 250000,
-            }
+        """
+        Approve the exchange proxy for token, unlimited unless an amount is given.
+        :return: hex txid or False
+        """
+        sent = self.approvals.send(self.approvals.build([(to_checksum_address(token), self.exchange_router)],
+                                                        amount or MAX_UINT256))
+        return sent[0][2] if sent else False
 
-        tx = contract.functions.approve(to_checksum_address(spender), max_amount).build_transaction(tx)
-        return self.broadcast_tx(raw_txn=tx)
+    def approve_all(self, tokens: list, amount: int = 0, wait: bool = True) -> list:
+        """
+        Approve the exchange proxy for every token that is not approved yet, see lib/approvals.py
+        """
+        return self.approvals.approve_all(tokens, [self.exchange_router], amount or MAX_UINT256, wait=wait)
 
     def quote(self, buy_token: str, sell_token: str, raw_amount: int, quote_only=False):
         params = {'sellToken': sell_token, 'buyToken': buy_token, 'sellAmount': raw_amount,
@@ -174,7 +237,7 @@ class ZeroX:
             return resp.json()
         else:
             if resp.status_code == 400:
-                print(resp.text)
+                self._print.error(resp.text)
                 if not quote_only:
                     self._print.error('ERROR: Is the token approved?')
                     return False
@@ -190,32 +253,46 @@ class ZeroX:
         assert type(buy_token) is str
         assert type(sell_token) is str
         obj = self.quote(buy_token, sell_token, raw_amount)
+        if not obj:
+            return False
         obj = dict(obj)
-        pprint.pprint(obj)
+        self._print.data(obj, 'Quote:')
         tx = {
             "from": self.acct.address,
-            "gas": hex(int(200000)),
+            "gas": int(obj.get('gas', 200000)),
             "gasPrice": hex(int(obj.get('gasPrice'))),
             "to": to_checksum_address(obj.get('to')),
             "value": hex(int(obj.get('value'))),
             "data": obj.get('data'),
             "nonce": self.w3.eth.get_transaction_count(self.acct.address),
-            "chainId": self.w3.eth.chain_id
+            "chainId": self.chain.get('chain_id') or self.w3.eth.chain_id
         }
-        pprint.pprint(tx)
-        self.w3.eth.estimate_gas(tx)
-        if obj:
-            pprint.pprint(obj)
-            if not self.no_prompt:
-                confirm = input('Accept this quote?')
-                if confirm.upper() == 'Y' or confirm.upper() == 'YES':
-                    self._print.normal('Broadcasting transaction ... ')
-                    self.broadcast_tx(tx)
-                else:
-                    self._print.normal('Operation canceled by user.')
-            else:
+        try:
+            # every 0x exchange proxy swap feature returns the bought amount as a single uint256
+            gas_limit, _ = self.preflight.check(tx, int(obj.get('buyAmount')), output_types=['uint256'],
+                                                output_token=obj.get('buyTokenAddress', buy_token),
+                                                recipient=self.acct.address)
+        except PreflightError as err:
+            self._print.error(f'Preflight failed, transaction not sent: {err}')
+            return False
+        tx['gas'] = hex(gas_limit)
+        self._print.data(tx, 'Transaction:')
+        sell_address = obj.get('sellTokenAddress', sell_token)
+        buy_address = obj.get('buyTokenAddress', buy_token)
+        self.last_trade = {'network': self.network, 'input': sell_address, 'output': buy_address,
+                           'in_decimals': self.decimals(sell_address), 'out_decimals': self.decimals(buy_address),
+                           'quote_raw': int(obj.get('buyAmount'))}
+        if not self.no_prompt:
+            self._print.flush()
+            confirm = input('Accept this quote?')
+            if confirm.upper() == 'Y' or confirm.upper() == 'YES':
                 self._print.normal('Broadcasting transaction ... ')
-                self.broadcast_tx(tx)
+                return self.broadcast_tx(tx)
+            else:
+                self._print.normal('Operation canceled by user.')
+        else:
+            self._print.normal('Broadcasting transaction ... ')
+            return self.broadcast_tx(tx)
 
 
 if __name__ == '__main__':
@@ -235,13 +312,48 @@ if __name__ == '__main__':
                       help='Check balance of this contract.')
     args.add_argument('-nb', '--native_balance', action='store_true')
     args.add_argument('-q', '--quantity', type=int, help='Raw Integer Quantity to swap.')
+    args.add_argument('--output', dest='output_mode', choices=['human', 'json'], default='human',
+                      help='Human readable output or one JSON object per line.')
+    args.add_argument('--quiet', action='store_true', help='Only print errors.')
+    args.add_argument('--record', dest='record_cassette', type=str, default=None,
+                      help='Record every rpc and 0x api request and response to this cassette file.')
+    args.add_argument('--replay', dest='replay_cassette', type=str, default=None,
+                      help='Replay a recorded cassette offline instead of using the network.')
+    args.add_argument('--replay-loose', dest='replay_loose', action='store_true',
+                      help='On replay, answer a request that was never recorded with the next recorded answer '
+                           'of the same method instead of failing (swap deadlines change between runs).')
+    args.add_argument('--relay', dest='relay_url', type=str, default=os.environ.get('bundle_relay'),
+                      help='Send transactions as a private bundle to this relay instead of the public mempool.')
+    args.add_argument('--relay-blocks', dest='relay_blocks', type=int, default=3,
+                      help='Blocks a bundle targets at once.')
+    args.add_argument('-s', '--max-slippage', dest='max_slippage', type=float, default=0.5,
+                      help='Refuse to broadcast if the simulated output is more than this percent below the quote.')
+    args.add_argument('--approve-all', dest='approve_all', nargs='+', default=None,
+                      help='Approve the 0x exchange proxy for every one of these tokens that needs it.')
+    args.add_argument('--add-order', dest='add_order', choices=['limit', 'stop'], default=None,
+                      help='Add a limit or stop order to sell -q of -i for -o at --trigger.')
+    args.add_argument('--trigger', dest='trigger_price', type=float, default=None,
+                      help='Trigger price of --add-order, output per input.')
+    args.add_argument('--orders', dest='list_orders', action='store_true', help='List limit and stop orders.')
+    args.add_argument('--cancel-order', dest='cancel_order', type=int, default=None, help='Cancel an order by id.')
+    args.add_argument('--run-orders', dest='run_orders', action='store_true',
+                      help='Check open orders every block and swap when they trigger.')
     args = args.parse_args()
+    style.configure(mode=args.output_mode, quiet=args.quiet)
 
     if not args.privkey_as_str and not args.json_wallet_file:
         default_wallet = os.environ.get('default_wallet_location')
         if default_wallet:
             setattr(args, 'json_wallet_file', default_wallet)
-    api = ZeroX(args.network_name, args.no_prompt, args.privkey_as_str, args.json_wallet_file)
+    cassette = None
+    if args.record_cassette or args.replay_cassette:
+        cassette = Cassette(args.record_cassette or args.replay_cassette,
+                            mode='record' if args.record_cassette else 'replay', strict=not args.replay_loose)
+    api = ZeroX(args.network_name, args.no_prompt, args.privkey_as_str, args.json_wallet_file,
+                max_slippage=args.max_slippage / 100, cassette=cassette)
+    if args.relay_url:
+        api.bundler = BundleSubmitter(api.w3, BundleRelay(args.relay_url, os.environ.get('bundle_signing_key')),
+                                      blocks=args.relay_blocks, poll=(api.chain.get('block_time') or 12) / 4)
     api._print.good(f'API Configured, Network: {args.network_name}, Force: {args.no_prompt}, '
                     f'Wallet: {args.json_wallet_file}')
     if args.native_balance:
@@ -253,9 +365,34 @@ if __name__ == '__main__':
     unlimited_approvals = os.environ.get('unlimited_approvals')
     if unlimited_approvals:
         api._print.warning('Warning: Unlimited Token Approvals Enabled.')
-    if args.input_token and args.output_token:
+    if args.approve_all:
+        api.approve_all([to_checksum_address(t) for t in args.approve_all], amount=args.quantity or 0)
+    if args.add_order or args.list_orders or args.cancel_order or args.run_orders:
+        book = OrderBook()
+        if args.add_order:
+            sell, buy = to_checksum_address(args.input_token), to_checksum_address(args.output_token)
+            order_id = book.add(args.network_name, sell, buy, api.erc20.decimals(sell), api.erc20.decimals(buy),
+                                args.quantity, args.add_order, args.trigger_price)
+            api._print.good(f'Added {args.add_order} order {order_id}')
+        if args.cancel_order:
+            if book.cancel(args.cancel_order):
+                api._print.good(f'Cancelled order {args.cancel_order}')
+            else:
+                api._print.error(f'No open order {args.cancel_order}')
+        if args.list_orders:
+            api._print.data(book.orders(network=args.network_name), 'Orders:')
+        if args.run_orders:
+            engine = LimitOrderEngine(api, book)
+            try:
+                engine.run()
+            except KeyboardInterrupt:
+                api._print.normal(f'Limit orders: {engine.stats}')
+    elif args.input_token and args.output_token:
         if not args.quote_only:
-            api.swap(to_checksum_address(args.output_token), to_checksum_address(args.input_token), args.quantity)
+            txid = api.swap(to_checksum_address(args.output_token), to_checksum_address(args.input_token),
+                            args.quantity)
+            if txid:
+                api.report_fill(api.poll_receipt(txid))
         else:
             quote = api.quote(args.output_token, args.input_token, args.quantity, args.quote_only)
-            pprint.pprint(quote)
+            api._print.data(quote, 'Quote:')